@@ -4,8 +4,10 @@ from flask import Flask
 from flask_cors import CORS
 from flask_restplus import Api
 
-from app.db.database import DataCleaner
-from app.utils.device_pool import DevicePoll
+from app.db.database import DataCleaner, Database
+from app.db.write_behind import WriteBehindQueue
+from app.utils.device_pool import DevicePoll, DevicePoolMaintainer
+from app.utils.fields import fields_parameter_to_header
 from config.application import DEVICES_IN_POOL, USE_CACHING
 from flask_executor import Executor
 
@@ -14,12 +16,16 @@ cors = CORS()
 flask_api = Api()
 
 def create_app():
+    # devices may be loaded from the database, so tables must exist before device pool
+    Database().create_tables()
     DevicePoll(DEVICES_IN_POOL)
+    DevicePoolMaintainer().start()
 
     app = Flask(__name__)
     app.config['EXECUTOR_TYPE'] = 'thread'
     app.config['EXECUTOR_MAX_WORKERS'] = 50
     executor = Executor(app)
+    app.before_request(fields_parameter_to_header)
 
     # Init logger
     logging.basicConfig(level=logging.WARN)
@@ -32,10 +38,9 @@ def create_app():
     cors.init_app(app)
     RestExecutorWrapper(executor)
 
-    from app.db.database import Database
     app.database = Database()
-    app.database.create_tables()
     if USE_CACHING:
+        WriteBehindQueue().start()
         DataCleaner().start()
 
     return app
@@ -1,19 +1,41 @@
-from concurrent.futures import wait, FIRST_COMPLETED
+import dataclasses
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Response, stream_with_context, has_request_context
 from flask_executor import Executor
 
-from flask_restplus import Resource, Namespace, fields
+from flask_restplus import Resource, Namespace, fields, marshal
 
 from app.api.types_.search import *
-from app.db.database import Database
+from app.db.database import Database, DataCleaner
+from app.db.write_behind import WriteBehindQueue
+from app.utils.batch import BatchExecutor, unique
+from app.utils.deadline import Deadline, DeadlineExceeded
 from app.utils.device_pool import DevicePoll
+from app.utils.fields import FieldMask, request_mask
+from app.utils.event_loop import WorkerLoop
+from app.utils.hedging import hedged_call, hedged_call_async
+from app.utils.http_pool import AsyncClientPool
+from app.utils.links import link_to_aweme_id, payload_to_aweme_id
+from app.utils.pagination import PageState
+from app.utils.prefetch import prefetch_pages
+from app.utils.revalidate import Revalidator
+from app.utils.short_links import fill_short_links
+from app.utils.single_flight import SingleFlight
 
 from app.utils.factory_search import SearchBySidCreator, \
     SearchPostByShareLinkCreator, \
-    SearchLikedPostsCreator, \
-    BuildSearchBySidCreator, BuildSearchPostByShareLinkCreator, BuildSearchPostsBySidCreator
-from app.utils.user_search import SearchException, get_sec_uid_by_username
+    SearchLikedPostsPageCreator, \
+    BuildSearchBySidCreator, BuildSearchPostByShareLinkCreator, BuildSearchPostsBySidCreator, fetch_cached_user, \
+    SearchPostsPageCreator, cached_posts, cache_posts, convert_aweme, hedged_page_fetcher, fetch_posts, \
+    fetch_liked_posts
+from app.utils.user_search import SearchException, get_sec_uid_by_username, get_sec_uid_by_username_async
 from app.utils.utils import singleton
-from config.application import USE_CACHING
+from config.application import USE_CACHING, ASYNC_MODE, BATCH_MAX_ITEMS, BATCH_MAX_PARALLEL, \
+    POST_CACHE_SAFETY_MARGIN_SEC, POSTS_STALE_WHILE_REVALIDATE, BATCH_MAX_WORKERS, REVALIDATE_MAX_WORKERS, \
+    HEDGE_MAX_IN_FLIGHT
 
 
 @dataclass
@@ -31,6 +53,247 @@ class RestExecutorWrapper:
 
     def __init__(self, executor):
         self.executor = executor
+        # flask executor copies request context into every task, so it can't be used by batch items
+        # and background refreshes: their threads have no request context
+        self.background_executor = ThreadPoolExecutor(
+            max_workers=(BATCH_MAX_WORKERS + REVALIDATE_MAX_WORKERS) * HEDGE_MAX_IN_FLIGHT,
+            thread_name_prefix="upstream")
+
+    def current(self):
+        """! Executor for upstream attempts of the calling thread. """
+        return self.executor if has_request_context() else self.background_executor
+
+
+def request_from_payload(request_class):
+    """! Request dataclass built from payload validated by `ns.expect`, keys it doesn't know are ignored. """
+    names = {field.name for field in dataclasses.fields(request_class)}
+    return request_class(**{key: value for key, value in ns.payload.items() if key in names})
+
+
+def user_is_secret(result) -> bool:
+    """! Sometimes tiktok sends that user is secret but it's not, so such answer needs one more confirmation. """
+    return result.user.secret == 1
+
+
+def search_by_sid(payload, deadline: Deadline = None):
+    """! Search user and posts by `sid` hedging upstream attempts and cache found user.
+        Every page of posts is fetched with its own hedged attempts, see `hedged_page_fetcher`.
+        Concurrent identical searches of the worker share one upstream operation.
+        When `deadline` runs out posts fetched so far are returned with `partial`.
+    """
+    executor = RestExecutorWrapper().current()
+    creator = SearchBySidCreator()
+    sid = payload.get("sid", None)
+    amount = payload.get("amount_of_posts", None) or 0
+    fields = FieldMask(payload.get("fields", None))
+
+    def search():
+        result = hedged_call(executor, lambda: creator.search(payload, proxy_on=True, deadline=deadline),
+                             name="search_by_sid", needs_confirmation=user_is_secret, deadline=deadline)
+        if result is None:
+            raise SearchException("search-by-sid failed", 404)
+        # user taken from cache is not written again, otherwise it would never expire
+        if USE_CACHING and result.user.stale is None:
+            WriteBehindQueue().cache_user_full_info(result.user)
+        # posts cut by the mask aren't fetched at all
+        if amount > 0 and result.user.secret != 1 and fields.wants("posts"):
+            fetch_page = hedged_page_fetcher(RestExecutorWrapper().background_executor, SearchPostsPageCreator(),
+                                             sid, "posts_page", deadline)
+            result.posts, result.partial = fetch_posts(fetch_page, sid, amount, fields.nested("posts"), deadline)
+        return result
+
+    key = ("search_by_sid", sid, payload.get("amount_of_posts", 0), payload.get("fields", None))
+    return SingleFlight().do(key, search, deadline)
+
+
+def resolve_sec_uid(username: str, deadline: Deadline = None) -> str:
+    """! Resolve `sec_uid` by username using cache or hedged requests to tiktok web. """
+    sec_uid = Database().fetch_cached_sec_uid_by_username(username)
+    if sec_uid is not None:
+        return sec_uid
+
+    executor = RestExecutorWrapper().current()
+    proxy_service = DevicePoll().proxy_service
+
+    def resolve():
+        if ASYNC_MODE:
+            # all attempts are coroutines on the worker loop, so no executor thread is blocked on proxied I/O
+            resolved = WorkerLoop().run(hedged_call_async(
+                lambda: get_sec_uid_by_username_async(username, None, proxy_service, deadline),
+                name="sec_uid_by_username", deadline=deadline))
+        else:
+            resolved = hedged_call(executor,
+                                   lambda: get_sec_uid_by_username(None, username, None, proxy_service, deadline),
+                                   name="sec_uid_by_username", deadline=deadline)
+        if resolved is None:
+            raise SearchException("user not found", 404)
+        WriteBehindQueue().cache_user_info(username, resolved)
+        return resolved
+
+    return SingleFlight().do(("sec_uid_by_username", username), resolve, deadline)
+
+
+def search_by_username(payload, deadline: Deadline = None):
+    """! Search user and posts by `username`. """
+    sec_uid = resolve_sec_uid(payload.get("username", None), deadline)
+    return search_by_sid({"sid": sec_uid, "amount_of_posts": payload.get("amount_of_posts", 0),
+                          "fields": payload.get("fields", None)}, deadline)
+
+
+def search_post(payload, deadline: Deadline = None):
+    """! Search post by any of links in payload. Post is taken from cache by its aweme_id if it's there. """
+    aweme_id = payload_to_aweme_id(payload) if USE_CACHING else None
+    if aweme_id is None:
+        return fetch_post(payload, deadline)
+    post = fetch_cached_post(aweme_id)
+    if post is not None:
+        return ApiPostSearchResponse(post)
+    return fetch_post({"aweme_id": aweme_id}, deadline)
+
+
+def fetch_post(payload, deadline: Deadline = None):
+    """! Fetch post from tiktok hedging upstream attempts and cache it. """
+    executor = RestExecutorWrapper().current()
+    creator = SearchPostByShareLinkCreator()
+    key = ("post", payload.get("aweme_id", None), payload.get("share_link", None),
+           payload.get("web_link", None), payload.get("short_link", None))
+    result = SingleFlight().do(
+        key, lambda: hedged_call(executor, lambda: creator.search(payload, proxy_on=True, deadline=deadline),
+                                 name="post", deadline=deadline), deadline)
+    if result is None:
+        raise SearchException("item not found", 404)
+    if USE_CACHING:
+        WriteBehindQueue().cache_post_info(result.posts)
+    return result
+
+
+def fetch_cached_post(aweme_id: str):
+    """! Cached post if its urls are valid long enough. With stale-while-revalidate, post which urls
+        expire soon is returned too and refreshed in background.
+    """
+    cached = Database().fetch_cached_post(aweme_id)
+    if cached is None:
+        return None
+    post, urls_expire_time = cached
+    if urls_expire_time is None or time.time() < int(urls_expire_time) - POST_CACHE_SAFETY_MARGIN_SEC:
+        return post
+    if POSTS_STALE_WHILE_REVALIDATE:
+        Revalidator().submit(("post", aweme_id), lambda: fetch_post({"aweme_id": aweme_id}))
+        return post
+    return None
+
+
+def with_short_links(result, deadline: Deadline = None):
+    """! Fill short links of posts in search result if X-Fields mask of the request needs them. """
+    posts = result.posts if isinstance(result.posts, list) else [result.posts]
+    fill_short_links(posts, FieldMask(request_mask()).nested("posts"), deadline)
+    return result
+
+
+def fetch_cached_search_by_sid(sid: str, amount_of_posts: int, fields: FieldMask = FieldMask()):
+    """! Build search response only from cache. Returns None if something is missing in cache. """
+    if not USE_CACHING:
+        return None
+    user = fetch_cached_user(sid)
+    if user is None:
+        return None
+    posts = None
+    if amount_of_posts > 0 and user.secret != 1 and fields.wants("posts"):
+        posts = Database().fetch_latest_cached_posts(sid, amount_of_posts)
+        if len(posts) == 0:
+            return None
+    return ApiSearchResponse(user, posts)
+
+
+def stream_batch(inputs: list, fetch_cached, search, model, fields: FieldMask = FieldMask(),
+                 deadline: Deadline = None):
+    """! Stream NDJSON line per unique input. Inputs found by `fetch_cached` are sent right away,
+        misses are searched with bounded parallelism and sent as soon as each is done.
+        `fields` mask is applied to every result. Misses not found before `deadline` get 504 error.
+    """
+    def line(item, result, ex):
+        if ex is None:
+            data = {"input": item, "result": marshal(result, model, skip_none=True, mask=fields.mask)}
+        elif isinstance(ex, SearchException):
+            data = {"input": item, "error": ex.error_str, "code": ex.http_code}
+        else:
+            data = {"input": item, "error": str(ex), "code": 500}
+        return json.dumps(data) + "\n"
+
+    def generate():
+        misses = list()
+        for item in unique(inputs):
+            result = fetch_cached(item)
+            if result is None:
+                misses.append(item)
+            else:
+                yield line(item, result, None)
+        for item, result, ex in BatchExecutor().as_completed(search, misses, BATCH_MAX_PARALLEL, deadline):
+            yield line(item, result, ex)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
+def iter_search_posts(sid: str, amount: int, fields: FieldMask = FieldMask(), deadline: Deadline = None):
+    """! Generator version of posts search: yields lists of latest posts of user.
+        Cached posts go first, then every page of the feed right when it's converted. Every page is
+        fetched with hedged attempts on devices of the pool, so a slow device doesn't stall the stream,
+        and converted while the next page is fetched. Without caching only `fields` of posts are filled.
+        DeadlineExceeded is raised after the last page fetched in time if feed has more posts.
+    """
+    state = None
+    sent = 0
+    if USE_CACHING:
+        cached, state, complete = cached_posts(sid, amount)
+        if complete:
+            yield cached[:amount]
+            return
+        if state is not None:
+            # posts before the cursor are cached, fetching continues after them
+            resumed = [post for post in cached if post.aweme_id in set(state.ids)]
+            sent = len(resumed)
+            if sent != 0:
+                yield resumed
+
+    # pages are fetched on prefetch thread, which has no request context
+    fetch_page = hedged_page_fetcher(RestExecutorWrapper().background_executor, SearchPostsPageCreator(), sid,
+                                     "posts_page", deadline)
+    convert = convert_aweme if USE_CACHING else lambda aweme: convert_aweme(aweme, fields)
+    for posts, state in prefetch_pages(fetch_page, convert, amount, state, deadline=deadline):
+        if USE_CACHING:
+            cache_posts(sid, posts, state)
+        posts = posts[:amount - sent]
+        if len(posts) != 0:
+            sent += len(posts)
+            yield posts
+    state = state if state is not None else PageState()
+    if deadline is not None and deadline.expired() and state.has_more and sent < amount:
+        raise DeadlineExceeded("posts")
+
+
+def stream_search(sid: str, amount: int, deadline: Deadline = None):
+    """! Stream NDJSON search result: `user` line, then `posts` line per page as soon as it's fetched.
+        Error after the stream started is sent as the last line with `error` and `code`.
+    """
+    result = search_by_sid({"sid": sid, "amount_of_posts": 0}, deadline)
+    fields = FieldMask(request_mask())
+    posts_fields = fields.nested("posts")
+
+    def generate():
+        yield json.dumps({"user": marshal(result.user, user_info, skip_none=True,
+                                          mask=fields.nested("user").mask)}) + "\n"
+        if amount <= 0 or result.user.secret == 1 or not fields.wants("posts"):
+            return
+        try:
+            for posts in iter_search_posts(sid, amount, posts_fields, deadline):
+                fill_short_links(posts, posts_fields, deadline)
+                yield json.dumps({"posts": marshal(posts, post_info_full, mask=posts_fields.mask)}) + "\n"
+        except SearchException as ex:
+            yield json.dumps({"error": ex.error_str, "code": ex.http_code}) + "\n"
+        except Exception as ex:
+            yield json.dumps({"error": str(ex), "code": 500}) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 # Namespace for all endpoints with `api/` path
@@ -48,6 +311,32 @@ search_request = ns.model(
                 readonly=True, required=False, description='Number of posts'),
     })
 
+# Describe model of request. Duplicate class `ApiSearchBatchRequest` for Flask and Swagger.
+search_batch_request = ns.model(
+    'SearchBatchRequest', {
+        'usernames':
+            fields.List(fields.String,
+                        readonly=True,
+                        required=True,
+                        description='Usernames of searching users'),
+        'amount_of_posts':
+            fields.Integer(
+                readonly=True, required=False, description='Number of posts'),
+    })
+
+# Describe model of request. Duplicate class `ApiSearchSidBatchRequest` for Flask and Swagger.
+search_sid_batch_request = ns.model(
+    'SearchSidBatchRequest', {
+        'sids':
+            fields.List(fields.String,
+                        readonly=True,
+                        required=True,
+                        description='Secure user IDs of searching users'),
+        'amount_of_posts':
+            fields.Integer(
+                readonly=True, required=False, description='Number of posts'),
+    })
+
 # Describe model of request. Duplicate class `ApiSearchRequest` for Flask and Swagger.
 search_sid_request = ns.model(
     'SearchSidRequest', {
@@ -226,6 +515,9 @@ user_info = ns.model(
         'secret':
             fields.Integer(
                 readonly=True, description='if this user hidden on tiktok'),
+        'stale':
+            fields.Boolean(
+                readonly=True, description='user is taken from expired cache and is being refreshed'),
     })
 
 # Describe model of response. Duplicate class `ApiSearchResponse` for Flask and Swagger.
@@ -233,6 +525,9 @@ search_response = ns.model(
     'SearchResponse', {
         'user': fields.Nested(user_info, allow_null=False, skip_none=True),
         'posts': fields.List(fields.Nested(post_info), allow_null=False, skip_none=True),
+        'partial':
+            fields.Boolean(
+                readonly=True, description='request deadline ran out, feed has more posts than returned'),
         'error':
             fields.String(
                 readonly=True,
@@ -245,6 +540,9 @@ search_response_full = ns.model(
     'SearchResponseFull', {
         'user': fields.Nested(user_info, allow_null=False, skip_none=True),
         'posts': fields.List(fields.Nested(post_info_full)),
+        'partial':
+            fields.Boolean(
+                readonly=True, description='request deadline ran out, feed has more posts than returned'),
         'error':
             fields.String(
                 readonly=True,
@@ -262,6 +560,30 @@ post_search_response = ns.model('PostSearchResponse',
                                      )
                                  })
 
+# Describe model of request. Duplicate class `ApiPostBatchRequest` for Flask and Swagger.
+post_batch_request = ns.model(
+    'PostBatchRequest', {
+        'links': fields.List(fields.String, readonly=True, required=True,
+                             description='Aweme IDs, share, web or short links'),
+    })
+
+# Describe model of response. Duplicate class `ApiPostBatchItem` for Flask and Swagger.
+post_batch_item = ns.model(
+    'PostBatchItem', {
+        'input': fields.String(readonly=True, required=True, description='Link from request'),
+        'aweme_id': fields.String(readonly=True, description='Aweme ID of link'),
+        'post': fields.Nested(post_info_full, allow_null=True, skip_none=True),
+        'error': fields.String(readonly=True, description='Error during proccessing'),
+        'code': fields.Integer(readonly=True, description='Http code of error'),
+    })
+
+# Describe model of response. Duplicate class `ApiPostBatchResponse` for Flask and Swagger.
+post_batch_response = ns.model(
+    'PostBatchResponse', {
+        'posts': fields.List(fields.Nested(post_batch_item, skip_none=True)),
+        'error': fields.String(readonly=True, description='Error during proccessing'),
+    })
+
 # Describe model of response. Duplicate class `ApiLikedPostSearchResponse` for Flask and Swagger.
 
 liked_posts_response = ns.model(
@@ -276,6 +598,7 @@ builded_request = ns.model('BuildedRequest',
 @ns.route('/search_by_sid')
 @ns.response(404, 'item not found')
 @ns.response(500, 'multiple retries failed')
+@ns.response(504, 'request deadline exceeded')
 class SearchUserAPI(Resource):
     """! Search user information and posts by `sec_user_id`. """
 
@@ -283,34 +606,8 @@ class SearchUserAPI(Resource):
     @ns.marshal_with(search_response, code=200)
     @ns.expect(search_sid_request, skip_none=True)
     def post(self):
-        executor = RestExecutorWrapper().executor
         try:
-            creator = SearchBySidCreator()
-            # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-            futures = [executor.submit(lambda: creator.search(ns.payload, proxy_on=True)) for _ in range(4)]
-            user_is_secret_counter = 0
-            while True:
-                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                futures = not_done
-                if len(done) != 0:
-                    future = done.pop()
-                    if not future.cancelled() and not future.exception():
-                        result = future.result()
-                        if result.user.secret == 1:
-                            user_is_secret_counter += 1
-                            if user_is_secret_counter >= 2:  # use 2-time verification cause sometimes tiktok sends that it's secret but it's not
-                                break
-                        else:
-                            break
-                    if len(done) == 0 and len(not_done) == 0:
-                        result = None
-                        break
-            if result is None:
-                raise SearchException("search-by-sid failed", 404)
-            else:
-                if USE_CACHING:
-                    Database().cache_user_full_info(result.user)
-                return result
+            return search_by_sid(dict(ns.payload, fields=request_mask()), Deadline.from_request())
         except SearchException as ex:
             return {"error": ex.error_str}, ex.http_code
 
@@ -344,6 +641,7 @@ class BuildSearchPostsAPI(Resource):
 @ns.route('/search')
 @ns.response(404, 'item not found')
 @ns.response(500, 'multiple retries failed')
+@ns.response(504, 'request deadline exceeded')
 class SearchUserAPI(Resource):
     """! Search user information and posts by `username`. """
 
@@ -351,61 +649,8 @@ class SearchUserAPI(Resource):
     @ns.marshal_with(search_response, code=200)
     @ns.expect(search_request, skip_none=True)
     def post(self):
-        executor = RestExecutorWrapper().executor
-
         try:
-            username = ns.payload.get("username", None)
-            sec_uid = Database().fetch_cached_sec_uid_by_username(username)
-            if sec_uid is None:
-                proxy_service = DevicePoll().proxy_service
-                # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-                futures = [executor.submit(lambda f: get_sec_uid_by_username(*f),
-                                           (None, username, None, proxy_service)) for _ in range(4)]
-                while True:
-                    done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                    futures = not_done
-                    if len(done) != 0:
-                        future = done.pop()
-                        if not future.cancelled() and not future.exception():
-                            sec_uid = future.result()
-                            break
-                        if len(done) == 0 and len(not_done) == 0:
-                            sec_uid = None
-                            break
-
-                if sec_uid is None:
-                    raise SearchException("user not found", 404)
-                else:
-                    Database().cache_user_info(username, sec_uid)
-
-            creator = SearchBySidCreator()
-            payload = {"sid": sec_uid, "amount_of_posts": ns.payload.get("amount_of_posts", 0)}
-
-            # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-            futures = [executor.submit(lambda: creator.search(payload, proxy_on=True)) for _ in range(4)]
-            user_is_secret_counter = 0
-            while True:
-                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                futures = not_done
-                if len(done) != 0:
-                    future = done.pop()
-                    if not future.cancelled() and not future.exception():
-                        result = future.result()
-                        if result.user.secret == 1:
-                            user_is_secret_counter += 1
-                            if user_is_secret_counter >= 2:  # use 2-time verification cause sometimes tiktok sends that it's secret but it's not
-                                break
-                        else:
-                            break
-                    if len(done) == 0 and len(not_done) == 0:
-                        result = None
-                        break
-            if result is None:
-                raise SearchException("search-by-sid failed", 404)
-            else:
-                if USE_CACHING:
-                    Database().cache_user_full_info(result.user)
-                return result
+            return search_by_username(dict(ns.payload, fields=request_mask()), Deadline.from_request())
         except SearchException as ex:
             return {"error": ex.error_str}, ex.http_code
 
@@ -413,6 +658,7 @@ class SearchUserAPI(Resource):
 @ns.route('/search_full')
 @ns.response(404, 'item not found')
 @ns.response(500, 'multiple retries failed')
+@ns.response(504, 'request deadline exceeded')
 class SearchFullUserAPI(Resource):
     """! Search user inforamtion and posts(with full inforamtion) by `username`. """
 
@@ -420,68 +666,89 @@ class SearchFullUserAPI(Resource):
     @ns.marshal_with(search_response_full, code=200)
     @ns.expect(search_request, skip_none=True)
     def post(self):
-        executor = RestExecutorWrapper().executor
+        try:
+            deadline = Deadline.from_request()
+            return with_short_links(search_by_username(dict(ns.payload, fields=request_mask()), deadline), deadline)
+        except SearchException as ex:
+            return {"error": ex.error_str}, ex.http_code
+
 
+@ns.route('/search_full_stream')
+@ns.response(404, 'item not found')
+@ns.response(500, 'multiple retries failed')
+@ns.response(504, 'request deadline exceeded')
+class SearchFullUserStreamAPI(Resource):
+    """! Search user inforamtion and posts(with full inforamtion) by `username` streaming posts page by page. """
+
+    @ns.doc("Find user and full info about it. Streams NDJSON: line with `user` at first, "
+            "then line with `posts` per page of posts as soon as it's fetched")
+    @ns.expect(search_request, skip_none=True)
+    def post(self):
         try:
-            username = ns.payload.get("username", None)
-            sec_uid = Database().fetch_cached_sec_uid_by_username(username)
-            if sec_uid is None:
-                proxy_service = DevicePoll().proxy_service
-                # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-                futures = [executor.submit(lambda f: get_sec_uid_by_username(*f),
-                                           (None, username, None, proxy_service)) for _ in range(4)]
-                while True:
-                    done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                    futures = not_done
-                    if len(done) != 0:
-                        future = done.pop()
-                        if not future.cancelled() and not future.exception():
-                            sec_uid = future.result()
-                            break
-                        if len(done) == 0 and len(not_done) == 0:
-                            sec_uid = None
-                            break
-
-                if sec_uid is None:
-                    raise SearchException("user not found", 404)
-                else:
-                    Database().cache_user_info(username, sec_uid)
-
-            creator = SearchBySidCreator()
-            payload = {"sid": sec_uid, "amount_of_posts": ns.payload.get("amount_of_posts", 0)}
-
-            # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-            futures = [executor.submit(lambda: creator.search(payload, proxy_on=True)) for _ in range(4)]
-            while True:
-                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                futures = not_done
-                if len(done) != 0:
-                    future = done.pop()
-                    user_is_secret_counter = 0
-                    if not future.cancelled() and not future.exception():
-                        result = future.result()
-                        if result.user.secret == 1:
-                            user_is_secret_counter += 1
-                            if user_is_secret_counter >= 2:  # use 2-time verification cause sometimes tiktok sends that it's secret but it's not
-                                break
-                        else:
-                            break
-                    if len(done) == 0 and len(not_done) == 0:
-                        result = None
-                        break
-            if result is None:
-                raise SearchException("search-by-sid failed", 404)
-            else:
-                if USE_CACHING:
-                    Database().cache_user_full_info(result.user)
-                return result
+            deadline = Deadline.from_request()
+            sid = resolve_sec_uid(ns.payload.get("username", None), deadline)
+            return stream_search(sid, ns.payload.get("amount_of_posts", None) or 0, deadline)
         except SearchException as ex:
             return {"error": ex.error_str}, ex.http_code
 
 
+@ns.route('/search_by_sid_batch')
+@ns.response(400, 'invalid request or too many items')
+class SearchUserBatchAPI(Resource):
+    """! Search users information and posts by list of `sec_user_id`. """
+
+    @ns.doc("Find users and info about them by list of `sec_user_id`. "
+            "Streams NDJSON line with `input` and `result` or `error` per unique sid as soon as it's found")
+    @ns.expect(search_sid_batch_request, skip_none=True, validate=True)
+    def post(self):
+        request = request_from_payload(ApiSearchSidBatchRequest)
+        sids = request.sids or []
+        if len(sids) > BATCH_MAX_ITEMS:
+            return {"error": "max {} items per request".format(BATCH_MAX_ITEMS)}, 400
+
+        mask = request_mask()
+        fields = FieldMask(mask)
+        deadline = Deadline.from_request()
+        return stream_batch(sids,
+                            lambda sid: fetch_cached_search_by_sid(sid, request.amount_of_posts, fields),
+                            lambda sid: search_by_sid({"sid": sid, "amount_of_posts": request.amount_of_posts,
+                                                       "fields": mask}, deadline),
+                            search_response, fields, deadline)
+
+
+@ns.route('/search_batch')
+@ns.response(400, 'invalid request or too many items')
+class SearchUsernameBatchAPI(Resource):
+    """! Search users information and posts by list of `username`. """
+
+    @ns.doc("Find users and info about them by list of `username`. "
+            "Streams NDJSON line with `input` and `result` or `error` per unique username as soon as it's found")
+    @ns.expect(search_batch_request, skip_none=True, validate=True)
+    def post(self):
+        request = request_from_payload(ApiSearchBatchRequest)
+        usernames = request.usernames or []
+        if len(usernames) > BATCH_MAX_ITEMS:
+            return {"error": "max {} items per request".format(BATCH_MAX_ITEMS)}, 400
+
+        mask = request_mask()
+        fields = FieldMask(mask)
+        deadline = Deadline.from_request()
+
+        def fetch_cached(username):
+            sid = Database().fetch_cached_sec_uid_by_username(username)
+            return fetch_cached_search_by_sid(sid, request.amount_of_posts, fields) if sid is not None else None
+
+        def search(username):
+            sid = resolve_sec_uid(username, deadline)
+            return search_by_sid({"sid": sid, "amount_of_posts": request.amount_of_posts, "fields": mask}, deadline)
+
+        return stream_batch(usernames, fetch_cached, search, search_response, fields, deadline)
+
+
 @ns.route('/post')
 @ns.response(404, 'item not found')
 @ns.response(500, 'multiple retries failed')
+@ns.response(504, 'request deadline exceeded')
 class SearchPostAPI(Resource):
     """! Search user posts by `link`. """
 
@@ -489,30 +756,61 @@ class SearchPostAPI(Resource):
     @ns.marshal_with(post_search_response, code=200)
     @ns.expect(post_request, skip_none=True)
     def post(self):
-        executor = RestExecutorWrapper().executor
-        creator = SearchPostByShareLinkCreator()
         try:
-            # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-            futures = [executor.submit(lambda: creator.search(ns.payload, proxy_on=True)) for _ in range(4)]
-            while True:
-                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                futures = not_done
-                if len(done) != 0:
-                    future = done.pop()
-                    if not future.cancelled() and not future.exception():
-                        result = future.result()
-                        break
-                    if len(done) == 0 and len(not_done) == 0:
-                        result = None
-                        break
-            if result is None:
-                raise SearchException("item not found", 404)
-            else:
-                return result
+            deadline = Deadline.from_request()
+            return with_short_links(search_post(ns.payload, deadline), deadline)
         except SearchException as ex:
             return {"error": ex.error_str}, ex.http_code
 
 
+@ns.route('/post_batch')
+@ns.response(400, 'invalid request or too many items')
+class SearchPostBatchAPI(Resource):
+    """! Search posts by list of links of any type. """
+
+    @ns.doc("Find posts by list of aweme ids, share, web or short links. Results are in order of links")
+    @ns.marshal_with(post_batch_response, code=200)
+    @ns.expect(post_batch_request, skip_none=True, validate=True)
+    def post(self):
+        request = request_from_payload(ApiPostBatchRequest)
+        links = request.links or []
+        if len(links) > BATCH_MAX_ITEMS:
+            return {"error": "max {} items per request".format(BATCH_MAX_ITEMS)}, 400
+
+        deadline = Deadline.from_request()
+        # every link is normalized to aweme_id first, so the same post is fetched once
+        aweme_ids = dict()
+        errors = dict()
+        for link, aweme_id, ex in BatchExecutor().as_completed(link_to_aweme_id, unique(links), BATCH_MAX_PARALLEL,
+                                                               deadline):
+            if ex is None and aweme_id is not None:
+                aweme_ids[link] = aweme_id
+            elif isinstance(ex, DeadlineExceeded):
+                errors[link] = ex
+            else:
+                errors[link] = SearchException("failed to parse link", 404)
+
+        posts = dict()
+        fetch = lambda aweme_id: search_post({"aweme_id": aweme_id}, deadline).posts
+        for aweme_id, post, ex in BatchExecutor().as_completed(fetch, unique(aweme_ids.values()), BATCH_MAX_PARALLEL,
+                                                               deadline):
+            if ex is None:
+                posts[aweme_id] = post
+            else:
+                errors[aweme_id] = ex if isinstance(ex, SearchException) else SearchException(str(ex))
+        fill_short_links(list(posts.values()), FieldMask(request_mask()).nested("posts").nested("post"), deadline)
+
+        items = list()
+        for link in links:
+            aweme_id = aweme_ids.get(link)
+            if aweme_id in posts:
+                items.append(ApiPostBatchItem(link, aweme_id, posts[aweme_id]))
+            else:
+                ex = errors.get(link) or errors.get(aweme_id)
+                items.append(ApiPostBatchItem(link, aweme_id, error=ex.error_str, code=ex.http_code))
+        return ApiPostBatchResponse(items)
+
+
 @ns.route('/post_build_request')
 class BuildSearchPostAPI(Resource):
     """! build request to search user posts by `link`. """
@@ -534,25 +832,44 @@ class SearchLikedPostsAPI(Resource):
     @ns.marshal_with(liked_posts_response, code=200)
     @ns.expect(search_sid_request, skip_none=True)
     def post(self):
-        executor = RestExecutorWrapper().executor
+        payload = dict(ns.payload, fields=request_mask())
+        deadline = Deadline.from_request()
         try:
-            creator = SearchLikedPostsCreator()
-            # use parallel execution cause sometimes TT throws captcha or proxied conneciton hangs up. this way we fetch the fastest result
-            futures = [executor.submit(lambda: creator.search(ns.payload, proxy_on=True)) for _ in range(4)]
-            while True:
-                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-                futures = not_done
-                if len(done) != 0:
-                    future = done.pop()
-                    if not future.cancelled() and not future.exception():
-                        result = future.result()
-                        break
-                    if len(done) == 0 and len(not_done) == 0:
-                        result = None
-                        break
-            if result is None:
-                raise SearchException("search-by-sid failed", 404)
-            else:
-                return result
+            sid = payload.get("sid", None)
+            # every page is fetched with its own hedged attempts on prefetch thread without request context
+            fetch_page = hedged_page_fetcher(RestExecutorWrapper().background_executor, SearchLikedPostsPageCreator(),
+                                             sid, "liked_page", deadline)
+            key = ("liked", sid, payload.get("amount_of_posts", 0), payload.get("fields", None))
+            result = SingleFlight().do(
+                key, lambda: fetch_liked_posts(fetch_page, payload.get("amount_of_posts", None) or 0,
+                                               FieldMask(payload["fields"]).nested("posts"), deadline), deadline)
+            return with_short_links(result, deadline)
         except SearchException as ex:
             return {"error": ex.error_str}, ex.http_code
+
+
+@ns.route('/metrics')
+class MetricsAPI(Resource):
+    """! Internal counters of the worker. """
+
+    @ns.doc("Get internal counters of the worker")
+    def get(self):
+        return {"l1_cache": Database().cache_stats(),
+                "single_flight_in_flight": SingleFlight().in_flight(),
+                "http_pool": AsyncClientPool().stats(),
+                "device_pool": DevicePoll().stats(),
+                "proxies": DevicePoll().proxy_service.stats(),
+                "revalidator": Revalidator().stats(),
+                "data_cleaner": DataCleaner().stats(),
+                "write_behind": WriteBehindQueue().stats()}
+
+
+@ns.route('/health')
+class HealthAPI(Resource):
+    """! Readiness of the worker. """
+
+    @ns.doc("Check that worker is ready to serve requests")
+    @ns.response(503, 'no devices loaded yet')
+    def get(self):
+        readiness = DevicePoll().readiness()
+        return readiness, 200 if readiness["ready"] else 503
@@ -17,9 +17,24 @@ class ApiScheduleViewsRequest:
 
 @dataclass
 class ApiSearchSidRequest:
-    """! Dataclass request for /search, /search_full, /liked, /liked_full. """
+    """! Dataclass request for /search, /search_full, /liked, /liked_full.
+        `fields` is X-Fields mask of response, fields cut by it aren't fetched.
+    """
     sid: str = None
     amount_of_posts: int = 0
+    fields: str = None
+
+@dataclass
+class ApiSearchSidBatchRequest:
+    """! Dataclass request for /search_by_sid_batch. """
+    sids: List[str] = None
+    amount_of_posts: int = 0
+
+@dataclass
+class ApiSearchBatchRequest:
+    """! Dataclass request for /search_batch. """
+    usernames: List[str] = None
+    amount_of_posts: int = 0
 
 @dataclass
 class ApiSearchBuildSidRequest(ApiSearchSidRequest):
@@ -35,6 +50,11 @@ class ApiPostSearchRequest:
     short_link: str = None
     aweme_id: str = None
 
+@dataclass
+class ApiPostBatchRequest:
+    """! Dataclass request for /post_batch. """
+    links: List[str] = None
+
 @dataclass
 class ApiPostSearchBuildRequest(ApiPostSearchRequest):
     """! Dataclass request for /post. """
@@ -45,10 +65,12 @@ class ApiSearchResponse:
     """! Dataclass response for /search, /search_full. """
     user: UserInfo
     posts: List
+    partial: bool
 
-    def __init__(self, user, posts):
+    def __init__(self, user, posts, partial=None):
         self.user = user
         self.posts = posts
+        self.partial = partial
 
 
 @dataclass
@@ -60,6 +82,25 @@ class ApiPostSearchResponse:
         self.posts = posts
 
 
+@dataclass
+class ApiPostBatchItem:
+    """! Dataclass of one link result in /post_batch response. """
+    input: str
+    aweme_id: str = None
+    post: PostInfo = None
+    error: str = None
+    code: int = None
+
+
+@dataclass
+class ApiPostBatchResponse:
+    """! Dataclass response for /post_batch. """
+    posts: List[ApiPostBatchItem]
+
+    def __init__(self, posts):
+        self.posts = posts
+
+
 @dataclass
 class ApiLikedPostSearchResponse:
     """! Dataclass response for /liked, /liked_full. """
@@ -0,0 +1,42 @@
+import json
+import zlib
+from typing import Optional
+
+# Signed tiktok cdn urls share hosts, paths and query parameters. zlib gets them as preset dictionary,
+# so even a single post is compressed well. Never change the dictionary of a released version:
+# add new dictionary with new version byte instead, otherwise stored posts can't be decoded.
+URLS_FORMAT_VERSION = 1
+URLS_ZDICT = (
+    b'"https://p16-sign-va.tiktokcdn.com/obj/tos-maliva-p-0068/'
+    b'"https://p16-sign-va.tiktokcdn-us.com/tos-useast5-p-0068-tx/'
+    b'"https://p16-sign-sg.tiktokcdn.com/obj/tos-alisg-p-0037/'
+    b'"https://p77-sign-va.tiktokcdn.com/tos-maliva-p-0068/~tplv-dmt-logom:tos-useast2a-pve-0068/.image'
+    b'~tplv-photomode-zoomcover:720:720.jpeg~tplv-tiktokx-360p.webp?x-expires=&x-signature='
+    b'"https://v16-webapp.tiktok.com/"https://v19-webapp.tiktok.com/"https://v16m.tiktokcdn.com/'
+    b'"https://v77.tiktokcdn.com/"https://v19.tiktokcdn-us.com/"https://v16m-default.akamaized.net/'
+    b'/video/tos/useast2a/tos-useast2a-pve-0068/video/tos/useast5/tos-useast5-pve-0068-tx/'
+    b'video/tos/alisg/tos-alisg-pve-0037/video/tos/maliva/tos-maliva-ve-0068c799-us/'
+    b'/?a=1233&ch=0&cr=0&dr=0&lr=all&cd=0%7C0%7C0%7C0&cv=1&br=&bt=&cs=0&ds=3&ft=&mime_type=video_mp4'
+    b'&qs=0&rc=&l=&btag=80000&vl=&vr=&net=0&pl=0&er=&cc=3&tk=tt_chain_token&policy=2&signature=&tk=0'
+    b'?x-expires=&x-signature=%3D%2B%2F",", null, ["], ["'
+)
+
+
+def pack_urls(cover: Optional[str], animated_cover: Optional[str],
+              download_links: Optional[list], play_links: Optional[list]) -> bytes:
+    """! Compress post urls into blob: version byte and zlib compressed json list. """
+    compressor = zlib.compressobj(level=9, zdict=URLS_ZDICT)
+    data = json.dumps([cover, animated_cover, download_links or [], play_links or []]).encode()
+    return bytes([URLS_FORMAT_VERSION]) + compressor.compress(data) + compressor.flush()
+
+
+def unpack_urls(blob: bytes) -> tuple:
+    """! Returns (cover, animated_cover, download_links, play_links) packed by `pack_urls`. """
+    if blob is None:
+        return None, None, [], []
+    if blob[0] != URLS_FORMAT_VERSION:
+        raise ValueError("unknown urls format version {}".format(blob[0]))
+    decompressor = zlib.decompressobj(zdict=URLS_ZDICT)
+    cover, animated_cover, download_links, play_links = json.loads(
+        decompressor.decompress(blob[1:]) + decompressor.flush())
+    return cover, animated_cover, download_links, play_links
@@ -2,73 +2,196 @@ import json
 import logging
 import threading
 import time
+from collections import OrderedDict
 
 import sqlalchemy
-from sqlalchemy import create_engine, engine
 import base64
 import re
 
 from tiktok_mobile.models.tiktok_apk import TikTokApk
 from tiktok_mobile.models.tiktok_phone import TikTokPhone
 
+from app.db.compact import pack_urls, unpack_urls
+from app.db.engine import create_sqlite_engine
+from app.db.storage import CacheStorage, SQLiteCacheStorage, MemoryCacheStorage, RedisCacheStorage
+from app.utils.pagination import PageState
 from app.utils.user_search import PostInfo, UserInfo
+from app.utils.process_lock import ProcessLock
 from app.utils.utils import singleton
+from config.application import L1_CACHE_MAX_ENTRIES, L1_ACCOUNTS_TTL_SEC, L1_ACCOUNTS_FULL_TTL_SEC, \
+    L1_POSTS_TTL_SEC, USERS_STALE_WHILE_REVALIDATE, USER_STALE_SEC, CLEANER_INTERVAL_SEC, CLEANER_BATCH_SIZE, \
+    CLEANER_LOCK_FILE, DATABASE_PATH, CACHE_BACKEND, CACHE_REDIS_URL, CACHE_REDIS_PREFIX, SHORT_LINK_LIFETIME_SEC
+
+# DataCleaner removes cached users and posts older than this
+CACHED_DATA_LIFETIME_MIN = 15
+# expired users are kept for stale-while-revalidate
+ACCOUNTS_FULL_LIFETIME_SEC = CACHED_DATA_LIFETIME_MIN * 60 + (USER_STALE_SEC if USERS_STALE_WHILE_REVALIDATE else 0)
+
+
+class LocalCache:
+    """! Bounded in-process LRU cache. Every entry expires after `ttl_sec` or at its own expire time. """
+
+    def __init__(self, max_entries: int, ttl_sec: int):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expire_at, value = entry
+            if expire_at <= time.time():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, expire_at: float = None):
+        """! Put value. `expire_at` is unix time when value becomes invalid (f.e. signed urls expiration). """
+        expire_at = min(time.time() + self.ttl_sec, expire_at or float("inf"))
+        with self._lock:
+            self._entries[key] = (expire_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+def _expire_time(add_time, urls_expire_time, lifetime_sec: int = CACHED_DATA_LIFETIME_MIN * 60) -> float:
+    """! Time when cached row becomes invalid: removed by DataCleaner or its urls expired. """
+    expire_at = float("inf")
+    if add_time is not None:
+        expire_at = int(add_time) + lifetime_sec
+    if urls_expire_time is not None:
+        expire_at = min(expire_at, int(urls_expire_time))
+    return expire_at
+
+
+def _row_to_device(row) -> TikTokPhone:
+    """! Build device from (apk, install_id, device_id) row. """
+    return TikTokPhone(apk=TikTokApk(json.loads(base64.b64decode(row[0]))), device_id=row[2], install_id=row[1])
+
+
+def _row_to_user(row) -> UserInfo:
+    user = UserInfo()
+    user.sid = row[0]
+    user.login_name = row[2]
+    user.name = row[3]
+    user.followers = row[4]
+    user.following = row[5]
+    user.likes = row[6]
+    user.avatar = row[7]
+    user.secret = row[8]
+    return user
+
+
+def _row_to_post(row) -> PostInfo:
+    post = PostInfo()
+    post.aweme_id = row[0]
+    post.create_time = row[2]
+    post.author_sec_user_id = row[3]
+    post.cover, post.animated_cover, post.download_links, post.play_links = unpack_urls(row[4])
+    post.share_link = row[5]
+    post.web_link = row[6]
+    post.short_link = row[7]
+    post.comment_count = row[8]
+    post.digg_count = row[9]
+    post.download_count = row[10]
+    post.forward_count = row[11]
+    post.lose_comment_count = row[12]
+    post.lose_count = row[13]
+    post.play_count = row[14]
+    post.share_count = row[15]
+    post.whatsapp_share_count = row[16]
+    post.description = row[17]
+    return post
+
+
+def _urls_expire_time(url: str):
+    """! Expire time of signed tiktok url or None. """
+    try:
+        return int(re.findall(r"x-expires=(\d+)", url)[0])
+    except Exception as ex:
+        logging.error("failed fetching urls expire date. error {}".format(str(ex)))
+        return None
+
+
+def _user_to_row(user: UserInfo) -> tuple:
+    """! Row in ACCOUNT_FULL_COLUMNS order. """
+    return (user.sid, round(time.time()), user.login_name, user.name, user.followers, user.following, user.likes,
+            user.avatar, user.secret, _urls_expire_time(user.avatar))
+
+
+def _post_to_row(post: PostInfo) -> tuple:
+    """! Row in POST_COLUMNS order. """
+    return (post.aweme_id, round(time.time()), post.create_time, post.author_sec_user_id,
+            pack_urls(post.cover, post.animated_cover, post.download_links, post.play_links),
+            post.share_link, post.web_link, post.short_link,
+            post.comment_count, post.digg_count, post.download_count, post.forward_count,
+            post.lose_comment_count, post.lose_count,
+            post.play_count, post.share_count, post.whatsapp_share_count, post.description,
+            _urls_expire_time(post.cover))
 
 
 @singleton
 class Database:
 
     def __init__(self):
-        self.engine = create_engine('sqlite:///cached_data.db')
+        # devices are always kept in sqlite database of the host, cached data is kept in CACHE_BACKEND
+        self.engine = create_sqlite_engine(DATABASE_PATH)
+        self.storage = self._create_storage()
+        # rows are kept in L1 caches, so every hit builds new objects and callers can't spoil cached data
+        self.accounts_cache = LocalCache(L1_CACHE_MAX_ENTRIES, L1_ACCOUNTS_TTL_SEC)
+        self.accounts_full_cache = LocalCache(L1_CACHE_MAX_ENTRIES, L1_ACCOUNTS_FULL_TTL_SEC)
+        self.posts_cache = LocalCache(L1_CACHE_MAX_ENTRIES, L1_POSTS_TTL_SEC)
+        self.post_cache = LocalCache(L1_CACHE_MAX_ENTRIES, L1_POSTS_TTL_SEC)
+        # where fetching of user posts stopped, so deeper request continues from there instead of the first page
+        self.posts_cursor_cache = LocalCache(L1_CACHE_MAX_ENTRIES, CACHED_DATA_LIFETIME_MIN * 60)
+        self.short_links_cache = LocalCache(L1_CACHE_MAX_ENTRIES, SHORT_LINK_LIFETIME_SEC)
+
+    def _create_storage(self) -> CacheStorage:
+        if CACHE_BACKEND == "redis":
+            return RedisCacheStorage(CACHE_REDIS_URL, CACHE_REDIS_PREFIX, ACCOUNTS_FULL_LIFETIME_SEC,
+                                     CACHED_DATA_LIFETIME_MIN * 60, SHORT_LINK_LIFETIME_SEC)
+        if CACHE_BACKEND == "memory":
+            return MemoryCacheStorage()
+        if CACHE_BACKEND != "sqlite":
+            raise ValueError("unknown CACHE_BACKEND {}".format(CACHE_BACKEND))
+        return SQLiteCacheStorage(self.engine)
+
+    def cache_stats(self) -> dict:
+        return {"tiktok_accounts": self.accounts_cache.stats(),
+                "tiktok_accounts_full": self.accounts_full_cache.stats(),
+                "tiktok_posts": self.posts_cache.stats(),
+                "tiktok_posts_by_aweme_id": self.post_cache.stats(),
+                "tiktok_posts_cursor": self.posts_cursor_cache.stats(),
+                "tiktok_short_links": self.short_links_cache.stats()}
 
     def create_tables(self):
         with self.engine.connect() as con:
             con.execute('''CREATE TABLE IF NOT EXISTS devices
                    (id int primary key, apk varchar(256), install_id varchar(256), device_id varchar(256) )''')
-            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_accounts
-                           (sec_user_id varchar(256) primary key,
-                            add_time int,
-                            username varchar(256))''')
-            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_posts
-                                        (aweme_id varchar(256) primary key,
-                                        add_time int,
-                                        create_time int,
-                                        author_sec_user_id varchar(256),
-                                        cover_url varchar(1024),
-                                        animated_cover_url varchar(1024),
-                                        download_url_1 varchar(1024),
-                                        download_url_2 varchar(1024),
-                                        download_url_3 varchar(1024),
-                                        play_url_1 varchar(1024),
-                                        play_url_2 varchar(1024),
-                                        play_url_3 varchar(1024),
-                                        share_link varchar(1024),
-                                        web_link varchar(1024),
-                                        short_link varchar(256),
-                                        comment_count int,
-                                        digg_count int,
-                                        download_count int,
-                                        forward_count int,
-                                        lose_comment_count int,
-                                        lose_count int,
-                                        play_count int, 
-                                        share_count int,
-                                        whatsapp_share_count int,
-                                        description varchar(1024),
-                                        earliest_urls_expire_time int )''')
-            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_accounts_full
-                                       (sec_user_id varchar(256) primary key,
-                                        add_time int,
-                                        username varchar(256) unique,
-                                        fullname varchar(256),
-                                        followers int,
-                                        following int,
-                                        likes int,
-                                        avatar_url varchar(1024),
-                                        secret int,
-                                        earliest_urls_expire_time int)''')
-            con.execute('''DELETE from tiktok_posts''')
-            con.execute('''DELETE from tiktok_accounts_full''')
+            con.execute('''CREATE TABLE IF NOT EXISTS device_leases
+                   (device_rowid int, owner varchar(64), expire_time int, primary key (device_rowid, owner))''')
+        self.storage.create_tables()
 
     def insert_device(self, device: TikTokPhone):
         apk = base64.b64encode(json.dumps(device.apk).encode('ascii'))
@@ -81,244 +204,239 @@ class Database:
                 ''', (apk, install_id, device_id))
 
     def fetch_created_devices(self, size: int):
-        devices = list()
+        return list(self.iter_created_devices(size))
+
+    def iter_created_devices(self, size: int, exclude_ids: list = ()):
+        """! Yield random stored devices except `exclude_ids` decoding them one by one. """
         with self.engine.connect() as con:
             curs = con.execute('''
-               SELECT apk, install_id, device_id FROM devices order by random() limit ?
-               ''', (size,))
+               SELECT apk, install_id, device_id FROM devices
+               WHERE rowid IN (SELECT rowid FROM devices WHERE device_id NOT IN ({}) ORDER BY random() LIMIT ?)
+               '''.format(", ".join("?" * len(exclude_ids))), (*exclude_ids, size))
             rows = curs.fetchall()
+        for row in rows:
+            yield _row_to_device(row)
+
+    def count_devices(self) -> int:
+        with self.engine.connect() as con:
+            return con.execute('''SELECT count(*) FROM devices''').fetchone()[0]
+
+    def lease_devices(self, owner: str, size: int, lease_sec: int):
+        """! Lease up to `size` devices not leased by `owner` yet, the least leased devices go first.
+            Leases aren't exclusive: they spread workers over the shared devices evenly.
+        """
+        now = round(time.time())
+        with self.engine.begin() as con:
+            rows = con.execute('''
+                SELECT d.rowid, d.apk, d.install_id, d.device_id FROM devices d
+                WHERE d.rowid NOT IN (SELECT device_rowid FROM device_leases WHERE owner = ? AND expire_time > ?)
+                ORDER BY (SELECT count(*) FROM device_leases l WHERE l.device_rowid = d.rowid AND l.expire_time > ?),
+                    d.rowid DESC
+                LIMIT ?''', (owner, now, now, size)).fetchall()
             for row in rows:
-                devices.append(TikTokPhone(apk=TikTokApk(json.loads(base64.b64decode(row[0]))), device_id=row[1], install_id=row[2]))
+                con.execute('''
+                    INSERT OR REPLACE INTO device_leases (device_rowid, owner, expire_time) VALUES (?, ?, ?)
+                    ''', (row[0], owner, now + lease_sec))
+            return [_row_to_device(row[1:]) for row in rows]
 
-            return devices
+    def renew_device_leases(self, owner: str, lease_sec: int):
+        now = round(time.time())
+        with self.engine.begin() as con:
+            con.execute('''UPDATE device_leases SET expire_time = ? WHERE owner = ?''', (now + lease_sec, owner))
+            con.execute('''DELETE FROM device_leases WHERE expire_time <= ?''', (now,))
 
-    def cache_user_info(self, username: str, sec_uid: str):
+    def delete_device(self, device_id: str):
+        """! Delete device with its leases of all workers, f.e. when it's quarantined. """
+        with self.engine.begin() as con:
+            con.execute('''
+                DELETE FROM device_leases WHERE device_rowid IN (SELECT rowid FROM devices WHERE device_id = ?)
+                ''', (device_id,))
+            con.execute('''DELETE FROM devices WHERE device_id = ?''', (device_id,))
+
+    def release_device_lease(self, owner: str, device_id: str):
         with self.engine.connect() as con:
             con.execute('''
-                INSERT INTO tiktok_accounts (sec_user_id,
-                            add_time, username) 
-                VALUES (?,?,?)
-                ON CONFLICT(sec_user_id) DO UPDATE SET
-                    add_time = excluded.add_time,
-                    username = excluded.username
-                ''', (sec_uid,
-                      round(time.time()),
-                      username
-                      ))
+                DELETE FROM device_leases
+                WHERE owner = ? AND device_rowid IN (SELECT rowid FROM devices WHERE device_id = ?)
+                ''', (owner, device_id))
+
+    def cache_user_info(self, username: str, sec_uid: str):
+        self.cache_users_info([(username, sec_uid)])
+
+    def cache_users_info(self, users: list):
+        """! Upsert (username, sec_uid) pairs in one transaction. """
+        if len(users) == 0:
+            return
+        add_time = round(time.time())
+        self.storage.put_users([(sec_uid, add_time, username) for username, sec_uid in users])
+        for username, sec_uid in users:
+            self.accounts_cache.put(username, sec_uid)
 
     def cache_user_full_info(self, user: UserInfo):
-        earliest_expire_time = None
-        try:
-            regex = r"x-expires=(\d+)"
-            earliest_expire_time = re.findall(regex, user.avatar)[0]
-        except Exception as ex:
-            logging.error("failed fetching urls expire date", ex)
+        self.cache_users_full_info([user])
 
-        with self.engine.connect() as con:
-            con.execute('''
-                INSERT INTO tiktok_accounts_full (sec_user_id,
-                            add_time, username, fullname,
-                            followers, following, likes,
-                            avatar_url, secret, earliest_urls_expire_time) 
-                VALUES (?,?,?,?,?,?,?,?,?,?)
-                ON CONFLICT(sec_user_id) DO UPDATE SET
-                    add_time = excluded.add_time,
-                    username = excluded.username,
-                    fullname = excluded.fullname,
-                    followers = excluded.followers,
-                    following = excluded.following,
-                    likes = excluded.likes,
-                    avatar_url = excluded.avatar_url,
-                    secret = excluded.secret,
-                    earliest_urls_expire_time = excluded.earliest_urls_expire_time
-                ''', (user.sid,
-                      round(time.time()),
-                      user.login_name,
-                      user.name,
-                      user.followers,
-                      user.following,
-                      user.likes,
-                      user.avatar,
-                      user.secret,
-                      earliest_expire_time
-                      ))
+    def cache_users_full_info(self, users: list):
+        """! Upsert users in one transaction. """
+        if len(users) == 0:
+            return
+        rows = [_user_to_row(user) for user in users]
+        self.storage.put_users_full(rows)
+        for row in rows:
+            self.accounts_full_cache.put(row[0], row, expire_at=_expire_time(row[1], row[9],
+                                                                             ACCOUNTS_FULL_LIFETIME_SEC))
 
     def fetch_cached_sec_uid_by_username(self, username: str):
-        with self.engine.connect() as con:
-            curs = con.execute('''
-                    SELECT sec_user_id
-                    FROM tiktok_accounts
-                    WHERE username=?''', (username,))
-            rows = curs.fetchall()
-            if len(rows) == 0:
-                return None
-            return rows[0][0]
+        sec_uid = self.accounts_cache.get(username)
+        if sec_uid is not None:
+            return sec_uid
+        sec_uid = self.storage.get_sec_uid(username)
+        if sec_uid is not None:
+            self.accounts_cache.put(username, sec_uid)
+        return sec_uid
 
     def cache_post_info(self, post: PostInfo):
-        download_url_1 = None
-        download_url_2 = None
-        download_url_3 = None
-        play_url_1 = None
-        play_url_2 = None
-        play_url_3 = None
-        earliest_expire_time = None
-        try:
-            download_url_1 = post.download_links.pop()
-            download_url_2 = post.download_links.pop()
-            download_url_3 = post.download_links.pop()
-        except Exception as ex:
-            logging.error("download links length < 3. error {}".format(str(ex)))
-        try:
-            play_url_1 = post.play_links.pop()
-            play_url_2 = post.play_links.pop()
-            play_url_3 = post.play_links.pop()
-        except Exception as ex:
-            logging.error("play links length < 3. error {}".format(str(ex)))
-        try:
-            regex = r"x-expires=(\d+)"
-            earliest_expire_time = re.findall(regex, post.cover)[0]
-        except Exception as ex:
-            logging.error("failed fetching urls expire date. error {}".format(str(ex)))
+        self.cache_posts_info([post])
 
-        with self.engine.connect() as con:
-            con.execute('''
-                INSERT INTO tiktok_posts (aweme_id, add_time, create_time, author_sec_user_id,
-                    cover_url, animated_cover_url, download_url_1, download_url_2, download_url_3,
-                    play_url_1, play_url_2, play_url_3, share_link, web_link, short_link,
-                    comment_count, digg_count, download_count, forward_count, lose_comment_count, lose_count, 
-                    play_count, share_count, whatsapp_share_count, description, earliest_urls_expire_time) 
-                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ON CONFLICT(aweme_id) DO UPDATE SET
-                    add_time = excluded.add_time,
-                    create_time = excluded.create_time,
-                    cover_url = excluded.cover_url,
-                    animated_cover_url = excluded.animated_cover_url,
-                    download_url_1 = excluded.download_url_1,
-                    download_url_2 = excluded.download_url_2,
-                    download_url_3 = excluded.download_url_3,
-                    play_url_1 = excluded.play_url_1,
-                    play_url_2 = excluded.play_url_2,
-                    play_url_3 = excluded.play_url_3,
-                    comment_count = excluded.comment_count,
-                    digg_count = excluded.digg_count,
-                    download_count = excluded.download_count,
-                    forward_count = excluded.forward_count,
-                    lose_comment_count = excluded.lose_comment_count,
-                    lose_count = excluded.lose_count, 
-                    play_count = excluded.play_count,
-                    share_count = excluded.share_count,
-                    whatsapp_share_count = excluded.whatsapp_share_count,
-                    earliest_urls_expire_time = excluded.earliest_urls_expire_time,
-                    description = excluded.description
-                ''', (post.aweme_id, round(time.time()), post.create_time, post.author_sec_user_id,
-                      post.cover, post.animated_cover, download_url_1, download_url_2, download_url_3,
-                      play_url_1, play_url_2, play_url_3, post.share_link, post.web_link, post.short_link,
-                      post.comment_count, post.digg_count, post.download_count, post.forward_count,
-                      post.lose_comment_count, post.lose_count,
-                      post.play_count, post.share_count, post.whatsapp_share_count, post.description,
-                      earliest_expire_time
-                      ))
+    def cache_posts_info(self, posts: list):
+        """! Upsert posts in one transaction. """
+        if len(posts) == 0:
+            return
+        self.storage.put_posts([_post_to_row(post) for post in posts])
+        # invalidated after commit, so concurrent reads can't put old rows back to L1 caches
+        for post in posts:
+            self.posts_cache.invalidate(post.author_sec_user_id)
+            self.post_cache.invalidate(post.aweme_id)
 
     def fetch_latest_cached_posts(self, sec_user_id: str, amount: int):
-        with self.engine.connect() as con:
-            curs = con.execute('''
-                        SELECT aweme_id, add_time, author_sec_user_id,
-                            cover_url, animated_cover_url, download_url_1, download_url_2, download_url_3,
-                            play_url_1, play_url_2, play_url_3, share_link, web_link, short_link,
-                            comment_count, digg_count, download_count, forward_count, lose_comment_count, lose_count, 
-                            play_count, share_count, whatsapp_share_count, description,
-                            earliest_urls_expire_time
-                        FROM tiktok_posts
-                        WHERE author_sec_user_id = ?
-                        ORDER by create_time desc
-                        LIMIT ?''', (sec_user_id, amount))
-            fetched_posts = list()
-            rows = curs.fetchall()
-            for row in rows:
-                post = PostInfo()
-                post.aweme_id = row[0]
-                post.cover = row[3]
-                post.animated_cover = row[4]
-
-                download_links = list()
-                if row[5] is not None:
-                    download_links.append(row[5])
-                if row[6] is not None:
-                    download_links.append(row[6])
-                if row[7] is not None:
-                    download_links.append(row[7])
-                post.download_links = download_links
-
-                play_links = list()
-                if row[8] is not None:
-                    play_links.append(row[8])
-                if row[9] is not None:
-                    play_links.append(row[9])
-                if row[10] is not None:
-                    play_links.append(row[10])
-                post.play_links = play_links
-
-                post.share_link = row[11]
-                post.web_link = row[12]
-                post.short_link = row[13]
-                post.comment_count = row[14]
-                post.digg_count = row[15]
-                post.download_count = row[16]
-                post.forward_count = row[17]
-                post.lose_comment_count = row[18]
-                post.lose_count = row[19]
-                post.play_count = row[20]
-                post.share_count = row[21]
-                post.whatsapp_share_count = row[22]
-                post.description = row[23]
-                post.author_sec_user_id = row[2]
-                fetched_posts.append(post)
-            return fetched_posts
-
-    def fetch_cached_user_full_info(self, sec_user_id: str):
-        with self.engine.connect() as con:
-            curs = con.execute('''
-                    SELECT sec_user_id, add_time, username,
-                        fullname, followers, following, likes, avatar_url, secret,
-                        earliest_urls_expire_time
-                    FROM tiktok_accounts_full
-                    WHERE sec_user_id=?''', (sec_user_id,))
-            rows = curs.fetchall()
-            if len(rows) == 0:
+        cached = self.posts_cache.get(sec_user_id)
+        if cached is not None:
+            cached_amount, rows = cached
+            # less rows than asked means that all posts of user were fetched
+            if cached_amount >= amount or len(rows) < cached_amount:
+                return [_row_to_post(row) for row in rows[:amount]]
+
+        now = round(time.time())
+        rows = self.storage.get_latest_posts(sec_user_id, amount, now - CACHED_DATA_LIFETIME_MIN * 60, now)
+        expire_at = min([_expire_time(row[1], row[18]) for row in rows], default=None)
+        self.posts_cache.put(sec_user_id, (amount, rows), expire_at=expire_at)
+        return [_row_to_post(row) for row in rows]
+
+    def cache_posts_cursor(self, sec_user_id: str, state: PageState):
+        self.posts_cursor_cache.put(sec_user_id, state)
+
+    def fetch_posts_cursor(self, sec_user_id: str):
+        """! PageState of user posts feed or None. """
+        return self.posts_cursor_cache.get(sec_user_id)
+
+    def fetch_cached_post(self, aweme_id: str):
+        """! Get cached post by aweme_id.
+            Returns (post, earliest_urls_expire_time) or None if there is no post with valid urls.
+        """
+        row = self.post_cache.get(aweme_id)
+        if row is None:
+            row = self.storage.get_post(aweme_id)
+            if row is None or _expire_time(row[1], row[18]) <= time.time():
                 return None
-            user = UserInfo()
-            row = rows[0]
-            user.sid = row[0]
-            user.login_name = row[2]
-            user.name = row[3]
-            user.followers = row[4]
-            user.following = row[5]
-            user.likes = row[6]
-            user.avatar = row[7]
-            user.secret = row[8]
-            return user
-
-    def clean_posts_cache(self, interval_min=15):
-        with self.engine.connect() as con:
-            con.execute('''
-                    DELETE from tiktok_posts
-                    where ?-add_time>?''', (round(time.time()), interval_min*60))
+            self.post_cache.put(aweme_id, row, expire_at=_expire_time(row[1], row[18]))
+        return _row_to_post(row), row[18]
 
-    def clean_accounts_full_cache(self, interval_min=15):
-        with self.engine.connect() as con:
-            con.execute('''
-                    DELETE from tiktok_accounts_full
-                    where ?-add_time>?''', (round(time.time()), interval_min*60))
+    def cache_short_links(self, short_links: list):
+        """! Upsert (aweme_id, short_link) pairs in one transaction. """
+        if len(short_links) == 0:
+            return
+        add_time = round(time.time())
+        self.storage.put_short_links([(aweme_id, add_time, short_link) for aweme_id, short_link in short_links])
+        for aweme_id, short_link in short_links:
+            self.short_links_cache.put(aweme_id, short_link)
+
+    def fetch_cached_short_links(self, aweme_ids: list) -> dict:
+        """! Cached short links by aweme_id, posts without cached short link are missing in result. """
+        short_links = dict()
+        misses = list()
+        for aweme_id in aweme_ids:
+            short_link = self.short_links_cache.get(aweme_id)
+            if short_link is None:
+                misses.append(aweme_id)
+            else:
+                short_links[aweme_id] = short_link
+        for aweme_id, short_link in self.storage.get_short_links(misses).items():
+            self.short_links_cache.put(aweme_id, short_link)
+            short_links[aweme_id] = short_link
+        return short_links
+
+    def fetch_cached_user_full_info(self, sec_user_id: str, allow_stale: bool = False):
+        """! Get cached user. Expired user is returned marked `stale` only if `allow_stale`. """
+        row = self.accounts_full_cache.get(sec_user_id)
+        if row is None:
+            row = self.storage.get_user_full(sec_user_id)
+            if row is None:
+                return None
+            self.accounts_full_cache.put(sec_user_id, row,
+                                         expire_at=_expire_time(row[1], row[9], ACCOUNTS_FULL_LIFETIME_SEC))
+
+        if _expire_time(row[1], row[9], ACCOUNTS_FULL_LIFETIME_SEC) <= time.time():
+            return None
+        stale = _expire_time(row[1], row[9]) <= time.time()
+        if stale and not allow_stale:
+            return None
+        user = _row_to_user(row)
+        user.stale = stale
+        return user
+
+    def clean_posts_cache(self, interval_min=CACHED_DATA_LIFETIME_MIN, batch_size: int = CLEANER_BATCH_SIZE) -> int:
+        """! Remove posts older than `interval_min` or with expired urls. Returns number of removed rows. """
+        now = round(time.time())
+        return self.storage.clean_posts(now - interval_min * 60, now, batch_size)
+
+    def clean_accounts_full_cache(self, interval_min=ACCOUNTS_FULL_LIFETIME_SEC // 60,
+                                  batch_size: int = CLEANER_BATCH_SIZE) -> int:
+        """! Remove users older than `interval_min`. Returns number of removed rows. """
+        return self.storage.clean_users_full(round(time.time()) - interval_min * 60, batch_size)
+
+    def clean_short_links_cache(self, lifetime_sec: int = SHORT_LINK_LIFETIME_SEC,
+                                batch_size: int = CLEANER_BATCH_SIZE) -> int:
+        """! Remove short links older than `lifetime_sec`. Returns number of removed rows. """
+        return self.storage.clean_short_links(round(time.time()) - lifetime_sec, batch_size)
 
 
 @singleton
 class DataCleaner(threading.Thread):
+    """! Removes expired cached data. Only one worker process of the host runs cleanup of shared storage. """
+
     def __init__(self):
-        threading.Thread.__init__(self)
+        threading.Thread.__init__(self, daemon=True)
         self.database = Database()
+        self.lock = ProcessLock(CLEANER_LOCK_FILE)
+        self.runs = 0
+        self.last_duration_ms = None
+        self.last_rows_removed = None
+        self.total_rows_removed = 0
 
     def run(self):
         while True:
-            time.sleep(5*60)
-            self.database.clean_posts_cache()
-            self.database.clean_accounts_full_cache()
+            time.sleep(CLEANER_INTERVAL_SEC)
+            # storage of the worker's own is cleaned by every worker
+            if self.database.storage.shared and not self.lock.try_acquire():
+                continue
+            try:
+                self.clean()
+            except Exception as e:
+                logging.error("failed cleaning cache. error {}".format(str(e)))
+
+    def clean(self):
+        started_at = time.monotonic()
+        removed = self.database.clean_posts_cache()
+        removed += self.database.clean_accounts_full_cache()
+        removed += self.database.clean_short_links_cache()
+        self.runs += 1
+        self.last_duration_ms = round((time.monotonic() - started_at) * 1000)
+        self.last_rows_removed = removed
+        self.total_rows_removed += removed
+        logging.warning("cache cleanup removed {} rows in {}ms".format(removed, self.last_duration_ms))
+
+    def stats(self) -> dict:
+        return {"is_cleaning_process": self.lock.is_acquired(),
+                "runs": self.runs,
+                "last_duration_ms": self.last_duration_ms,
+                "last_rows_removed": self.last_rows_removed,
+                "total_rows_removed": self.total_rows_removed}
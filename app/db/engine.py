@@ -0,0 +1,41 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from config.application import SQLITE_WAL, SQLITE_SYNCHRONOUS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE, \
+    SQLITE_POOL_SIZE, SQLITE_POOL_OVERFLOW, SQLITE_CACHED_STATEMENTS
+
+
+def create_sqlite_engine(path: str, tuned: bool = True):
+    """! Create engine for sqlite database file shared by all worker processes.
+
+        Tuned engine keeps up to SQLITE_POOL_SIZE open connections in the pool, so sqlite statement cache
+        of a connection (`cached_statements`) is reused by the next queries instead of re-parsing them.
+        Every new connection is switched to WAL journal: readers don't block the writer and the writer
+        doesn't block readers, concurrent writers wait `busy_timeout` instead of "database is locked".
+        `tuned=False` gives engine with default settings, it's used by the benchmark only.
+    """
+    if not tuned:
+        return create_engine('sqlite:///{}'.format(path))
+
+    # connection is checked out by one thread at a time but threads share pooled connections,
+    # so `check_same_thread` is off. Queries beyond pool size and overflow wait for a free connection
+    engine = create_engine('sqlite:///{}'.format(path),
+                           poolclass=QueuePool,
+                           pool_size=SQLITE_POOL_SIZE,
+                           max_overflow=SQLITE_POOL_OVERFLOW,
+                           pool_timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           connect_args={"check_same_thread": False,
+                                         "timeout": SQLITE_BUSY_TIMEOUT_MS / 1000,
+                                         "cached_statements": SQLITE_CACHED_STATEMENTS})
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        if SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous={}".format(SQLITE_SYNCHRONOUS))
+        cursor.execute("PRAGMA busy_timeout={}".format(SQLITE_BUSY_TIMEOUT_MS))
+        cursor.execute("PRAGMA mmap_size={}".format(SQLITE_MMAP_SIZE))
+        cursor.close()
+
+    return engine
@@ -0,0 +1,534 @@
+import base64
+import json
+import logging
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+import redis
+
+from app.db.compact import pack_urls
+
+# rows of cached data are tuples with these columns. Storages get and return rows in this order
+ACCOUNT_COLUMNS = ("sec_user_id", "add_time", "username")
+ACCOUNT_FULL_COLUMNS = ("sec_user_id", "add_time", "username", "fullname", "followers", "following", "likes",
+                        "avatar_url", "secret", "earliest_urls_expire_time")
+# `urls` is blob of cover, animated cover, download and play links packed by app.db.compact.pack_urls
+POST_COLUMNS = ("aweme_id", "add_time", "create_time", "author_sec_user_id",
+                "urls", "share_link", "web_link", "short_link",
+                "comment_count", "digg_count", "download_count", "forward_count", "lose_comment_count", "lose_count",
+                "play_count", "share_count", "whatsapp_share_count", "description", "earliest_urls_expire_time")
+# short link of post never changes, it's kept longer than post itself
+SHORT_LINK_COLUMNS = ("aweme_id", "add_time", "short_link")
+
+
+def _is_valid_post(row, min_add_time: int, now: int) -> bool:
+    return row[1] > min_add_time and (row[18] is None or int(row[18]) > now)
+
+
+class CacheStorage(ABC):
+    """! Storage of cached users and posts behind Database.
+
+        `shared` storage is seen by all worker processes (and nodes), so it's cleaned by one of them.
+    """
+    shared = True
+
+    def create_tables(self):
+        pass
+
+    @abstractmethod
+    def put_users(self, rows: list):
+        """! Upsert ACCOUNT_COLUMNS rows. """
+
+    @abstractmethod
+    def get_sec_uid(self, username: str) -> Optional[str]:
+        pass
+
+    @abstractmethod
+    def put_users_full(self, rows: list):
+        """! Upsert ACCOUNT_FULL_COLUMNS rows. """
+
+    @abstractmethod
+    def get_user_full(self, sec_user_id: str) -> Optional[tuple]:
+        pass
+
+    @abstractmethod
+    def put_posts(self, rows: list):
+        """! Upsert POST_COLUMNS rows. """
+
+    @abstractmethod
+    def get_post(self, aweme_id: str) -> Optional[tuple]:
+        pass
+
+    @abstractmethod
+    def get_latest_posts(self, sec_user_id: str, amount: int, min_add_time: int, now: int) -> list:
+        """! Latest by create_time posts of user added after `min_add_time` which urls are valid at `now`. """
+
+    @abstractmethod
+    def clean_posts(self, min_add_time: int, now: int, batch_size: int) -> int:
+        """! Remove posts added before `min_add_time` or with urls expired at `now`. Returns removed count. """
+
+    @abstractmethod
+    def clean_users_full(self, min_add_time: int, batch_size: int) -> int:
+        """! Remove users added before `min_add_time`. Returns removed count. """
+
+    @abstractmethod
+    def put_short_links(self, rows: list):
+        """! Upsert SHORT_LINK_COLUMNS rows. """
+
+    @abstractmethod
+    def get_short_links(self, aweme_ids: list) -> dict:
+        """! Short links of posts found in storage by aweme_id. """
+
+    @abstractmethod
+    def clean_short_links(self, min_add_time: int, batch_size: int) -> int:
+        """! Remove short links added before `min_add_time`. Returns removed count. """
+
+
+class SQLiteCacheStorage(CacheStorage):
+    """! Cache tables in sqlite database file of the host. """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def create_tables(self):
+        self._migrate_posts_urls()
+        with self.engine.connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_accounts
+                           (sec_user_id varchar(256) primary key,
+                            add_time int,
+                            username varchar(256))''')
+            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_posts
+                                        (aweme_id varchar(256) primary key,
+                                        add_time int,
+                                        create_time int,
+                                        author_sec_user_id varchar(256),
+                                        urls blob,
+                                        share_link varchar(1024),
+                                        web_link varchar(1024),
+                                        short_link varchar(256),
+                                        comment_count int,
+                                        digg_count int,
+                                        download_count int,
+                                        forward_count int,
+                                        lose_comment_count int,
+                                        lose_count int,
+                                        play_count int,
+                                        share_count int,
+                                        whatsapp_share_count int,
+                                        description varchar(1024),
+                                        earliest_urls_expire_time int )''')
+            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_accounts_full
+                                       (sec_user_id varchar(256) primary key,
+                                        add_time int,
+                                        username varchar(256) unique,
+                                        fullname varchar(256),
+                                        followers int,
+                                        following int,
+                                        likes int,
+                                        avatar_url varchar(1024),
+                                        secret int,
+                                        earliest_urls_expire_time int)''')
+            # cached data survives restarts, expired rows are removed by DataCleaner using these indexes
+            con.execute('''CREATE INDEX IF NOT EXISTS tiktok_posts_add_time ON tiktok_posts (add_time)''')
+            con.execute('''CREATE INDEX IF NOT EXISTS tiktok_posts_urls_expire_time
+                           ON tiktok_posts (earliest_urls_expire_time)''')
+            con.execute('''CREATE INDEX IF NOT EXISTS tiktok_posts_author_create_time
+                           ON tiktok_posts (author_sec_user_id, create_time)''')
+            con.execute('''CREATE INDEX IF NOT EXISTS tiktok_accounts_full_add_time
+                           ON tiktok_accounts_full (add_time)''')
+            con.execute('''CREATE TABLE IF NOT EXISTS tiktok_short_links
+                           (aweme_id varchar(256) primary key,
+                            add_time int,
+                            short_link varchar(256))''')
+            con.execute('''CREATE INDEX IF NOT EXISTS tiktok_short_links_add_time
+                           ON tiktok_short_links (add_time)''')
+
+    def _migrate_posts_urls(self, batch_size: int = 1000):
+        """! Convert tiktok_posts with url columns (cover_url, download_url_1..3, ...) into `urls` blob.
+            Runs in one immediate transaction, so workers starting at the same time wait for the first one.
+        """
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            if not self._has_old_posts_table(cursor):
+                return
+            cursor.execute("BEGIN IMMEDIATE")
+            if not self._has_old_posts_table(cursor):
+                connection.rollback()
+                return
+            started_at = time.monotonic()
+            for index in ("tiktok_posts_add_time", "tiktok_posts_urls_expire_time", "tiktok_posts_author_create_time"):
+                cursor.execute("DROP INDEX IF EXISTS {}".format(index))
+            cursor.execute("ALTER TABLE tiktok_posts RENAME TO tiktok_posts_old")
+            cursor.execute('''CREATE TABLE tiktok_posts
+                              (aweme_id varchar(256) primary key, add_time int, create_time int,
+                               author_sec_user_id varchar(256), urls blob, share_link varchar(1024),
+                               web_link varchar(1024), short_link varchar(256), comment_count int, digg_count int,
+                               download_count int, forward_count int, lose_comment_count int, lose_count int,
+                               play_count int, share_count int, whatsapp_share_count int,
+                               description varchar(1024), earliest_urls_expire_time int)''')
+            select = connection.cursor()
+            select.execute('''
+                SELECT aweme_id, add_time, create_time, author_sec_user_id,
+                    cover_url, animated_cover_url, download_url_1, download_url_2, download_url_3,
+                    play_url_1, play_url_2, play_url_3, share_link, web_link, short_link,
+                    comment_count, digg_count, download_count, forward_count, lose_comment_count, lose_count,
+                    play_count, share_count, whatsapp_share_count, description, earliest_urls_expire_time
+                FROM tiktok_posts_old''')
+            migrated = 0
+            while True:
+                rows = select.fetchmany(batch_size)
+                if len(rows) == 0:
+                    break
+                cursor.executemany('''INSERT INTO tiktok_posts ({}) VALUES ({})'''.format(
+                    ", ".join(POST_COLUMNS), ",".join("?" * len(POST_COLUMNS))),
+                    [row[:4] + (pack_urls(row[4], row[5], [link for link in row[6:9] if link is not None],
+                                          [link for link in row[9:12] if link is not None]),) + row[12:]
+                     for row in rows])
+                migrated += len(rows)
+            cursor.execute("DROP TABLE tiktok_posts_old")
+            connection.commit()
+            logging.warning("migrated {} cached posts to packed urls in {:.0f}ms".format(
+                migrated, (time.monotonic() - started_at) * 1000))
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _has_old_posts_table(cursor) -> bool:
+        cursor.execute("PRAGMA table_info(tiktok_posts)")
+        return "download_url_1" in [column[1] for column in cursor.fetchall()]
+
+    def put_users(self, rows: list):
+        with self.engine.begin() as con:
+            con.execute('''
+                INSERT INTO tiktok_accounts (sec_user_id,
+                            add_time, username)
+                VALUES (?,?,?)
+                ON CONFLICT(sec_user_id) DO UPDATE SET
+                    add_time = excluded.add_time,
+                    username = excluded.username
+                ''', rows)
+
+    def get_sec_uid(self, username: str) -> Optional[str]:
+        with self.engine.connect() as con:
+            rows = con.execute('''
+                    SELECT sec_user_id
+                    FROM tiktok_accounts
+                    WHERE username=?''', (username,)).fetchall()
+        return rows[0][0] if len(rows) != 0 else None
+
+    def put_users_full(self, rows: list):
+        with self.engine.begin() as con:
+            con.execute('''
+                INSERT INTO tiktok_accounts_full (sec_user_id,
+                            add_time, username, fullname,
+                            followers, following, likes,
+                            avatar_url, secret, earliest_urls_expire_time)
+                VALUES (?,?,?,?,?,?,?,?,?,?)
+                ON CONFLICT(sec_user_id) DO UPDATE SET
+                    add_time = excluded.add_time,
+                    username = excluded.username,
+                    fullname = excluded.fullname,
+                    followers = excluded.followers,
+                    following = excluded.following,
+                    likes = excluded.likes,
+                    avatar_url = excluded.avatar_url,
+                    secret = excluded.secret,
+                    earliest_urls_expire_time = excluded.earliest_urls_expire_time
+                ''', rows)
+
+    def get_user_full(self, sec_user_id: str) -> Optional[tuple]:
+        with self.engine.connect() as con:
+            rows = con.execute('''
+                    SELECT {}
+                    FROM tiktok_accounts_full
+                    WHERE sec_user_id=?'''.format(", ".join(ACCOUNT_FULL_COLUMNS)), (sec_user_id,)).fetchall()
+        return tuple(rows[0]) if len(rows) != 0 else None
+
+    def put_posts(self, rows: list):
+        with self.engine.begin() as con:
+            con.execute('''
+                INSERT INTO tiktok_posts (aweme_id, add_time, create_time, author_sec_user_id,
+                    urls, share_link, web_link, short_link,
+                    comment_count, digg_count, download_count, forward_count, lose_comment_count, lose_count,
+                    play_count, share_count, whatsapp_share_count, description, earliest_urls_expire_time)
+                VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+                ON CONFLICT(aweme_id) DO UPDATE SET
+                    add_time = excluded.add_time,
+                    create_time = excluded.create_time,
+                    urls = excluded.urls,
+                    comment_count = excluded.comment_count,
+                    digg_count = excluded.digg_count,
+                    download_count = excluded.download_count,
+                    forward_count = excluded.forward_count,
+                    lose_comment_count = excluded.lose_comment_count,
+                    lose_count = excluded.lose_count,
+                    play_count = excluded.play_count,
+                    share_count = excluded.share_count,
+                    whatsapp_share_count = excluded.whatsapp_share_count,
+                    earliest_urls_expire_time = excluded.earliest_urls_expire_time,
+                    description = excluded.description
+                ''', rows)
+
+    def get_post(self, aweme_id: str) -> Optional[tuple]:
+        with self.engine.connect() as con:
+            rows = con.execute('''
+                    SELECT {}
+                    FROM tiktok_posts
+                    WHERE aweme_id = ?'''.format(", ".join(POST_COLUMNS)), (aweme_id,)).fetchall()
+        return tuple(rows[0]) if len(rows) != 0 else None
+
+    def get_latest_posts(self, sec_user_id: str, amount: int, min_add_time: int, now: int) -> list:
+        with self.engine.connect() as con:
+            rows = con.execute('''
+                    SELECT {}
+                    FROM tiktok_posts
+                    WHERE author_sec_user_id = ? AND add_time > ?
+                        AND (earliest_urls_expire_time IS NULL OR earliest_urls_expire_time > ?)
+                    ORDER by create_time desc
+                    LIMIT ?'''.format(", ".join(POST_COLUMNS)), (sec_user_id, min_add_time, now, amount)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def clean_posts(self, min_add_time: int, now: int, batch_size: int) -> int:
+        removed = self._delete_in_batches('''
+                    DELETE FROM tiktok_posts WHERE rowid IN
+                    (SELECT rowid FROM tiktok_posts WHERE add_time < ? LIMIT ?)''', min_add_time, batch_size)
+        removed += self._delete_in_batches('''
+                    DELETE FROM tiktok_posts WHERE rowid IN
+                    (SELECT rowid FROM tiktok_posts WHERE earliest_urls_expire_time < ? LIMIT ?)''', now, batch_size)
+        return removed
+
+    def clean_users_full(self, min_add_time: int, batch_size: int) -> int:
+        return self._delete_in_batches('''
+                    DELETE FROM tiktok_accounts_full WHERE rowid IN
+                    (SELECT rowid FROM tiktok_accounts_full WHERE add_time < ? LIMIT ?)''', min_add_time, batch_size)
+
+    def put_short_links(self, rows: list):
+        with self.engine.begin() as con:
+            con.execute('''
+                INSERT INTO tiktok_short_links (aweme_id, add_time, short_link)
+                VALUES (?,?,?)
+                ON CONFLICT(aweme_id) DO UPDATE SET
+                    add_time = excluded.add_time,
+                    short_link = excluded.short_link
+                ''', rows)
+
+    def get_short_links(self, aweme_ids: list) -> dict:
+        if len(aweme_ids) == 0:
+            return dict()
+        with self.engine.connect() as con:
+            rows = con.execute('''
+                    SELECT aweme_id, short_link
+                    FROM tiktok_short_links
+                    WHERE aweme_id IN ({})'''.format(", ".join("?" * len(aweme_ids))), tuple(aweme_ids)).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def clean_short_links(self, min_add_time: int, batch_size: int) -> int:
+        return self._delete_in_batches('''
+                    DELETE FROM tiktok_short_links WHERE rowid IN
+                    (SELECT rowid FROM tiktok_short_links WHERE add_time < ? LIMIT ?)''', min_add_time, batch_size)
+
+    def _delete_in_batches(self, query: str, threshold: int, batch_size: int) -> int:
+        """! Run delete `query` with (threshold, batch_size) parameters until it removes less than a batch.
+            Every batch is a short transaction, so writers are not blocked for the whole cleanup.
+        """
+        removed = 0
+        while True:
+            with self.engine.connect() as con:
+                count = con.execute(query, (threshold, batch_size)).rowcount
+            removed += count
+            if count < batch_size:
+                return removed
+            time.sleep(0.01)
+
+
+class MemoryCacheStorage(CacheStorage):
+    """! Cache in memory of the worker process. Nothing is shared or kept between restarts. """
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._accounts = dict()
+        self._accounts_full = dict()
+        self._posts = dict()
+        self._posts_by_author = dict()
+        self._short_links = dict()
+
+    def put_users(self, rows: list):
+        with self._lock:
+            for row in rows:
+                self._accounts[row[2]] = row
+
+    def get_sec_uid(self, username: str) -> Optional[str]:
+        row = self._accounts.get(username)
+        return row[0] if row is not None else None
+
+    def put_users_full(self, rows: list):
+        with self._lock:
+            for row in rows:
+                self._accounts_full[row[0]] = row
+
+    def get_user_full(self, sec_user_id: str) -> Optional[tuple]:
+        return self._accounts_full.get(sec_user_id)
+
+    def put_posts(self, rows: list):
+        with self._lock:
+            for row in rows:
+                self._posts[row[0]] = row
+                self._posts_by_author.setdefault(row[3], set()).add(row[0])
+
+    def get_post(self, aweme_id: str) -> Optional[tuple]:
+        return self._posts.get(aweme_id)
+
+    def get_latest_posts(self, sec_user_id: str, amount: int, min_add_time: int, now: int) -> list:
+        with self._lock:
+            rows = [self._posts[aweme_id] for aweme_id in self._posts_by_author.get(sec_user_id, ())]
+        rows = [row for row in rows if _is_valid_post(row, min_add_time, now)]
+        rows.sort(key=lambda row: row[2] or 0, reverse=True)
+        return rows[:amount]
+
+    def clean_posts(self, min_add_time: int, now: int, batch_size: int) -> int:
+        with self._lock:
+            expired = [row for row in self._posts.values() if not _is_valid_post(row, min_add_time - 1, now)]
+            for row in expired:
+                del self._posts[row[0]]
+                author_posts = self._posts_by_author.get(row[3], set())
+                author_posts.discard(row[0])
+                if len(author_posts) == 0:
+                    self._posts_by_author.pop(row[3], None)
+        return len(expired)
+
+    def clean_users_full(self, min_add_time: int, batch_size: int) -> int:
+        with self._lock:
+            expired = [key for key, row in self._accounts_full.items() if row[1] < min_add_time]
+            for key in expired:
+                del self._accounts_full[key]
+        return len(expired)
+
+    def put_short_links(self, rows: list):
+        with self._lock:
+            for row in rows:
+                self._short_links[row[0]] = row
+
+    def get_short_links(self, aweme_ids: list) -> dict:
+        rows = [self._short_links.get(aweme_id) for aweme_id in aweme_ids]
+        return {row[0]: row[2] for row in rows if row is not None}
+
+    def clean_short_links(self, min_add_time: int, batch_size: int) -> int:
+        with self._lock:
+            expired = [key for key, row in self._short_links.items() if row[1] < min_add_time]
+            for key in expired:
+                del self._short_links[key]
+        return len(expired)
+
+
+class RedisCacheStorage(CacheStorage):
+    """! Cache on a server speaking redis protocol, shared by all nodes.
+
+        Rows are stored as json with ttl, so the server removes expired data by itself and
+        cleanup has nothing to do. Latest posts of user are found by sorted set of aweme_ids
+        scored by create_time, ids of expired posts are removed from it on read.
+    """
+
+    def __init__(self, url: str, prefix: str, users_full_lifetime_sec: int, posts_lifetime_sec: int,
+                 short_links_lifetime_sec: int):
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.users_full_lifetime_sec = users_full_lifetime_sec
+        self.posts_lifetime_sec = posts_lifetime_sec
+        self.short_links_lifetime_sec = short_links_lifetime_sec
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(parts)
+
+    @staticmethod
+    def _ttl(add_time: int, lifetime_sec: int, urls_expire_time) -> int:
+        expire_at = add_time + lifetime_sec
+        if urls_expire_time is not None:
+            expire_at = min(expire_at, int(urls_expire_time))
+        return max(1, int(expire_at - time.time()))
+
+    @staticmethod
+    def _load(value) -> Optional[tuple]:
+        return tuple(json.loads(value)) if value is not None else None
+
+    @staticmethod
+    def _dump_post(row: tuple) -> str:
+        """! Post row as json, `urls` blob is base64 encoded. """
+        return json.dumps(row[:4] + (base64.b64encode(row[4]).decode() if row[4] is not None else None,) + row[5:])
+
+    @classmethod
+    def _load_post(cls, value) -> Optional[tuple]:
+        row = cls._load(value)
+        if row is None:
+            return None
+        return row[:4] + (base64.b64decode(row[4]) if row[4] is not None else None,) + row[5:]
+
+    def put_users(self, rows: list):
+        pipe = self.client.pipeline(transaction=False)
+        for row in rows:
+            pipe.set(self._key("account", row[2]), row[0])
+        pipe.execute()
+
+    def get_sec_uid(self, username: str) -> Optional[str]:
+        value = self.client.get(self._key("account", username))
+        return value.decode() if value is not None else None
+
+    def put_users_full(self, rows: list):
+        pipe = self.client.pipeline(transaction=False)
+        for row in rows:
+            pipe.set(self._key("user", row[0]), json.dumps(row), ex=self._ttl(row[1], self.users_full_lifetime_sec, None))
+        pipe.execute()
+
+    def get_user_full(self, sec_user_id: str) -> Optional[tuple]:
+        return self._load(self.client.get(self._key("user", sec_user_id)))
+
+    def put_posts(self, rows: list):
+        pipe = self.client.pipeline(transaction=False)
+        for row in rows:
+            pipe.set(self._key("post", row[0]), self._dump_post(row), ex=self._ttl(row[1], self.posts_lifetime_sec, row[18]))
+            author_key = self._key("author_posts", row[3])
+            pipe.zadd(author_key, {row[0]: row[2] or 0})
+            pipe.expire(author_key, self.posts_lifetime_sec)
+        pipe.execute()
+
+    def get_post(self, aweme_id: str) -> Optional[tuple]:
+        return self._load_post(self.client.get(self._key("post", aweme_id)))
+
+    def get_latest_posts(self, sec_user_id: str, amount: int, min_add_time: int, now: int) -> list:
+        author_key = self._key("author_posts", sec_user_id)
+        aweme_ids = [aweme_id.decode() for aweme_id in self.client.zrevrange(author_key, 0, -1)]
+        if len(aweme_ids) == 0:
+            return []
+        rows = [self._load_post(value) for value in self.client.mget([self._key("post", a) for a in aweme_ids])]
+        removed = [aweme_id for aweme_id, row in zip(aweme_ids, rows) if row is None]
+        if len(removed) != 0:
+            self.client.zrem(author_key, *removed)
+        return [row for row in rows if row is not None and _is_valid_post(row, min_add_time, now)][:amount]
+
+    def clean_posts(self, min_add_time: int, now: int, batch_size: int) -> int:
+        return 0
+
+    def clean_users_full(self, min_add_time: int, batch_size: int) -> int:
+        return 0
+
+    def put_short_links(self, rows: list):
+        pipe = self.client.pipeline(transaction=False)
+        for row in rows:
+            pipe.set(self._key("short_link", row[0]), row[2],
+                     ex=self._ttl(row[1], self.short_links_lifetime_sec, None))
+        pipe.execute()
+
+    def get_short_links(self, aweme_ids: list) -> dict:
+        if len(aweme_ids) == 0:
+            return dict()
+        values = self.client.mget([self._key("short_link", aweme_id) for aweme_id in aweme_ids])
+        return {aweme_id: value.decode() for aweme_id, value in zip(aweme_ids, values) if value is not None}
+
+    def clean_short_links(self, min_add_time: int, batch_size: int) -> int:
+        return 0
@@ -0,0 +1,150 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from app.db.database import Database
+from app.utils.user_search import PostInfo, UserInfo
+from app.utils.utils import singleton, format_except
+from config.application import WRITE_BEHIND, WRITE_BEHIND_MAX_QUEUE, WRITE_BEHIND_BATCH_SIZE, \
+    WRITE_BEHIND_FLUSH_INTERVAL_MS, WRITE_BEHIND_PUT_TIMEOUT_SEC
+
+KIND_USER = "user"
+KIND_USER_FULL = "user_full"
+KIND_POST = "post"
+KIND_SHORT_LINK = "short_link"
+
+
+@singleton
+class WriteBehindQueue(threading.Thread):
+    """! Takes cache writes off the request path.
+
+        Writes are queued and written by the background thread: everything that came within
+        WRITE_BEHIND_FLUSH_INTERVAL_MS goes to the database as one executemany upsert per table
+        in one transaction. When the queue is full, callers wait for free space up to
+        WRITE_BEHIND_PUT_TIMEOUT_SEC and then write by themselves, so writes are slowed down but not lost.
+        Queued writes are flushed at exit of the worker.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="write-behind", daemon=True)
+        self.database = Database()
+        self._queue = queue.Queue(maxsize=WRITE_BEHIND_MAX_QUEUE)
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.inline_writes = 0
+        self.failed = 0
+        self.last_batch_ms = None
+
+    def start(self):
+        atexit.register(self.stop)
+        threading.Thread.start(self)
+
+    def cache_user_info(self, username: str, sec_uid: str):
+        self._put(KIND_USER, (username, sec_uid))
+
+    def cache_user_full_info(self, user: UserInfo):
+        self._put(KIND_USER_FULL, user)
+
+    def cache_post_info(self, post: PostInfo):
+        self._put(KIND_POST, post)
+
+    def cache_posts_info(self, posts: list):
+        for post in posts:
+            self._put(KIND_POST, post)
+
+    def cache_short_links(self, short_links: dict):
+        for item in short_links.items():
+            self._put(KIND_SHORT_LINK, item)
+
+    def _put(self, kind: str, item):
+        if WRITE_BEHIND and self.is_alive() and not self._stopped:
+            try:
+                self._queue.put((kind, item), timeout=WRITE_BEHIND_PUT_TIMEOUT_SEC)
+                self.queued += 1
+                return
+            except queue.Full:
+                logging.warning("write-behind queue is full, writing {} inline".format(kind))
+        self.inline_writes += 1
+        self._write([(kind, item)])
+
+    def run(self):
+        while not self._stopped:
+            try:
+                batch = [self._queue.get(timeout=1)]
+            except queue.Empty:
+                continue
+            # collect everything that comes within flush interval into one batch
+            deadline = time.monotonic() + WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000
+            while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            with self._flush_lock:
+                self._write(batch)
+
+    def flush(self):
+        """! Write all queued items in calling thread. """
+        with self._flush_lock:
+            while True:
+                batch = []
+                while len(batch) < WRITE_BEHIND_BATCH_SIZE:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if len(batch) == 0:
+                    return
+                self._write(batch)
+
+    def stop(self):
+        self._stopped = True
+        # let the thread write batch it has already taken from the queue
+        if self.is_alive():
+            self.join(timeout=5)
+        self.flush()
+
+    def _write(self, batch: list):
+        """! Upsert batch grouped by table, the latest write of the same key wins. """
+        users, users_full, posts, short_links = dict(), dict(), dict(), dict()
+        for kind, item in batch:
+            if kind == KIND_USER:
+                users[item[0]] = item
+            elif kind == KIND_USER_FULL:
+                users_full[item.sid] = item
+            elif kind == KIND_POST:
+                posts[item.aweme_id] = item
+            elif kind == KIND_SHORT_LINK:
+                short_links[item[0]] = item
+
+        started_at = time.monotonic()
+        for write, items in ((self.database.cache_users_info, users),
+                             (self.database.cache_users_full_info, users_full),
+                             (self.database.cache_posts_info, posts),
+                             (self.database.cache_short_links, short_links)):
+            try:
+                write(list(items.values()))
+                self.written += len(items)
+            except Exception as e:
+                self.failed += len(items)
+                logging.error("failed writing {} cached items. error [{}]".format(len(items), format_except(e)))
+        self.batches += 1
+        self.last_batch_ms = round((time.monotonic() - started_at) * 1000)
+
+    def stats(self) -> dict:
+        return {"enabled": WRITE_BEHIND,
+                "queue_size": self._queue.qsize(),
+                "queued": self.queued,
+                "written": self.written,
+                "batches": self.batches,
+                "inline_writes": self.inline_writes,
+                "failed": self.failed,
+                "last_batch_ms": self.last_batch_ms}
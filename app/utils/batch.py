@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Iterable
+
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.utils import singleton
+from config.application import BATCH_MAX_WORKERS
+
+
+def unique(items: Iterable) -> list:
+    """! Items without duplicates in order of first appearance. """
+    return list(dict.fromkeys(items))
+
+
+@singleton
+class BatchExecutor:
+    """! Executor for items of batch requests.
+
+        Separate from flask executor, because every item hedges its upstream calls on another executor
+        and must not wait for threads of the same pool. Items have no request context, so their attempts
+        run on `RestExecutorWrapper().background_executor`.
+    """
+
+    def __init__(self, max_workers: int = BATCH_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch")
+
+    def as_completed(self, fn: Callable, items: list, max_parallel: int, deadline: Deadline = None):
+        """! Run `fn(item)` for every item with at most `max_parallel` of them at once.
+            Yields (item, result, exception) as soon as each item is done. When `deadline` runs out,
+            items which aren't done are yielded with DeadlineExceeded.
+        """
+        pending = iter(items)
+        in_flight = dict()
+
+        def submit_next() -> bool:
+            for item in pending:
+                in_flight[self.executor.submit(fn, item)] = item
+                return True
+            return False
+
+        try:
+            while len(in_flight) < max_parallel and submit_next():
+                pass
+            while len(in_flight) != 0:
+                done, _ = wait(in_flight, timeout=deadline.timeout() if deadline is not None else None,
+                               return_when=FIRST_COMPLETED)
+                if len(done) == 0:
+                    for item in list(in_flight.values()) + list(pending):
+                        yield item, None, DeadlineExceeded("batch item")
+                    return
+                for future in done:
+                    item = in_flight.pop(future)
+                    submit_next()
+                    if future.exception() is not None:
+                        yield item, None, future.exception()
+                    else:
+                        yield item, future.result(), None
+        finally:
+            # client went away, items that aren't started yet are dropped
+            for future in in_flight:
+                future.cancel()
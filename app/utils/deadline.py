@@ -0,0 +1,60 @@
+import logging
+import math
+import time
+from typing import Optional
+
+from flask import request
+
+from app.utils.user_search import SearchException
+from config.application import REQUEST_TIMEOUT_SEC, REQUEST_TIMEOUT_MAX_SEC, REQUEST_TIMEOUT_HEADER
+
+
+class DeadlineExceeded(SearchException):
+    """! Time budget of request ran out at some stage, answered with 504. """
+
+    def __init__(self, stage: str):
+        SearchException.__init__(self, "deadline exceeded: {}".format(stage), 504)
+
+
+class Deadline:
+    """! Time budget of one API request. It's passed to every stage of search, so blocking waits
+        are cut to the remaining time and stages stop instead of starting new upstream attempts.
+    """
+
+    def __init__(self, timeout_sec: float):
+        self.timeout_sec = timeout_sec
+        self.expires_at = time.monotonic() + timeout_sec
+
+    @classmethod
+    def from_request(cls) -> "Deadline":
+        """! Deadline of the current request: REQUEST_TIMEOUT_HEADER seconds up to REQUEST_TIMEOUT_MAX_SEC
+            or REQUEST_TIMEOUT_SEC when header is missing or isn't a finite number.
+        """
+        timeout = REQUEST_TIMEOUT_SEC
+        header = request.headers.get(REQUEST_TIMEOUT_HEADER)
+        if header:
+            try:
+                value = float(header)
+            except ValueError:
+                value = None
+            # nan would never expire and never leave time to wait either
+            if value is not None and math.isfinite(value):
+                timeout = min(value, REQUEST_TIMEOUT_MAX_SEC)
+            else:
+                logging.warning("invalid {} header [{}]".format(REQUEST_TIMEOUT_HEADER, header))
+        return cls(max(timeout, 0))
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, timeout: Optional[float] = None) -> float:
+        """! Timeout of blocking wait cut to the remaining time, None waits until the deadline. """
+        return self.remaining() if timeout is None else min(timeout, self.remaining())
+
+    def check(self, stage: str):
+        """! Raise DeadlineExceeded if there is no time left for `stage`. """
+        if self.expired():
+            raise DeadlineExceeded(stage)
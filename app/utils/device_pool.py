@@ -1,11 +1,15 @@
 import logging
 import os
-import sys
+import random
+import socket
 import threading
 import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Tuple
 
 import requests
+from tiktok_mobile.api.exceptions import EmptyResponseBodyError
 from tiktok_mobile.models.tiktok_phone import TikTokPhone
 from tiktok_mobile.utils.sender import HttpxSender
 from tiktok_utils.proxy.providers.simple import proxy_provider_from_file
@@ -13,10 +17,73 @@ from tiktok_utils.proxy.providers.zeta import ZetaBatchProxyProvider, ZetaProvid
 from tiktok_utils.proxy.utils import load_socks5, wrap_requests_proxy
 
 from app.db.database import Database
-from app.utils.user_search import current_milli_time, create_phone
+from app.utils.process_lock import ProcessLock
+from app.utils.proxy_health import ProxyTracker, ProxyAttempt, SenderProxies
+from app.utils.user_search import create_phone, SearchException, proxy_failure_kind
 from app.utils.utils import singleton, format_except
 from config.application import PROXY_FILE, DEVICES_SOURCE, DEFAULT_EXC_PAUSE, \
-    MAX_ATTEMPTS_DEVICE_CREATION
+    MAX_ATTEMPTS_DEVICE_CREATION, DEVICE_QUARANTINE_FAILURES, DEVICE_MIN_SUCCESS_RATE, DEVICE_HEALTH_EWMA_ALPHA, \
+    DEVICE_SPARES, DEVICE_MAX_AGE_MIN, DEVICE_MAINTENANCE_INTERVAL_SEC, SHARED_DEVICES_TOTAL, \
+    SHARED_DEVICES_LOCK_FILE, SHARED_DEVICES_WAIT_SEC, DEVICE_LEASE_SEC, FAST_START, DEVICE_WAIT_SEC
+
+# failures that tell nothing about device itself, f.e. searched user doesn't exist
+NEUTRAL_FAILURES = ("not_found",)
+# failures counted against proxy of device, tiktok returns empty body to flagged addresses
+PROXY_FAILURES = ("timeout", "socks", "ssl", "captcha", "unknown_page", "connection", "empty_response")
+
+
+def failure_kind(ex: Exception) -> str:
+    """! Kind of device failure reported to DevicePoll.release_device. """
+    if isinstance(ex, SearchException):
+        return "not_found"
+    if isinstance(ex, EmptyResponseBodyError):
+        return "empty_response"
+    return proxy_failure_kind(ex) or "error"
+
+
+class NoDeviceAvailable(SearchException):
+    """! Pool has no devices, f.e. they are still loading or all of them were quarantined. """
+
+    def __init__(self):
+        SearchException.__init__(self, "no devices available", 503)
+
+
+class DeviceHealth:
+    """! Outcomes of searches made by one device. """
+
+    def __init__(self):
+        self.success_rate = 1.0
+        self.latency_ms = None
+        self.in_flight = 0
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.recent_failures = deque(maxlen=10)
+
+    def record(self, latency_ms: float, failure: str = None):
+        self.requests += 1
+        if failure is not None:
+            self.recent_failures.append((time.time(), failure))
+            if failure in NEUTRAL_FAILURES:
+                return
+            self.consecutive_failures += 1
+            self.success_rate = (1 - DEVICE_HEALTH_EWMA_ALPHA) * self.success_rate
+            return
+
+        self.consecutive_failures = 0
+        self.success_rate = (1 - DEVICE_HEALTH_EWMA_ALPHA) * self.success_rate + DEVICE_HEALTH_EWMA_ALPHA
+        if self.latency_ms is None:
+            self.latency_ms = latency_ms
+        else:
+            self.latency_ms = (1 - DEVICE_HEALTH_EWMA_ALPHA) * self.latency_ms + DEVICE_HEALTH_EWMA_ALPHA * latency_ms
+
+    def is_bad(self) -> bool:
+        return self.consecutive_failures >= DEVICE_QUARANTINE_FAILURES or \
+            (self.requests >= DEVICE_QUARANTINE_FAILURES and self.success_rate < DEVICE_MIN_SUCCESS_RATE)
+
+    def load(self) -> float:
+        """! Expected cost of next request on device, less is better. Unknown latency is treated as good one. """
+        latency = self.latency_ms if self.latency_ms is not None else 1.0
+        return latency * (self.in_flight + 1) / max(self.success_rate, 0.01)
 
 
 @singleton
@@ -29,19 +96,36 @@ class DevicePoll:
         self._db_session = Database()
         self._thread_lock = threading.Lock()
         self.device_usage_lock = threading.Lock()
+        # notified when device is added to the pool
+        self.device_added = threading.Condition(self.device_usage_lock)
         self.device_pool_size = device_pool_size
         self.devices = []
-        self._cursor = 0
+        self.spares = []
+        self.device_added_at = dict()
+        self.health = dict()
+        # proxy switcher of every device sender, outcomes of device requests are recorded for its proxies
+        self.proxy_switchers = dict()
+        self.loading = False
+        # devices loaded from the database get their http session on first use
+        self._sessions_pending = set()
+        self._session_lock = threading.Lock()
+        self.quarantined = 0
+        self.replaced = 0
+        # devices being registered, they count as pool or spare devices when pool is refilled
+        self.registering = 0
+        # quarantined devices aren't taken from the database again
+        self.retired = set()
         self._thread_pool_executor = ThreadPoolExecutor(max_workers=10)
 
-        self.last_devices_reload_time = -1
-        self.devices_reload_interval_millis = 60 * 60 * 1000
+        # identity of worker in shared devices table and lock of the only worker registering devices
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.registration_lock = ProcessLock(SHARED_DEVICES_LOCK_FILE)
 
         if PROXY_FILE is not None and os.path.isfile(PROXY_FILE):
-            self.proxy_service = proxy_provider_from_file(
+            proxy_provider = proxy_provider_from_file(
                 PROXY_FILE, modifier=load_socks5)
         else:
-            self.proxy_service = ZetaBatchProxyProvider(
+            proxy_provider = ZetaBatchProxyProvider(
                 zeta_arguments=ZetaProviderArguments(
                     application_name="tiktokViewer",
                     country_name="Indonesia",
@@ -50,27 +134,69 @@ class DevicePoll:
                 ),
                 fetch_max_delay_ms=10 * 1000
             )
+        self.proxy_service = ProxyTracker(proxy_provider)
         self.load_devices()
 
     def load_devices(self):
         logging.warning("loading all devices")
         try:
-            self.devices.clear()
             if DEVICES_SOURCE == "CREATE_NEW":
                 self.create_devices(self.device_pool_size)
             elif DEVICES_SOURCE == "DATABASE":
-                devices_from_db = self._db_session.fetch_created_devices(self.device_pool_size)
-                for device in devices_from_db:
-                    device.update_session(self.get_sender())
-                self.devices.extend(devices_from_db)
+                devices_from_db = self._db_session.iter_created_devices(self.device_pool_size)
+                if FAST_START:
+                    for device in devices_from_db:
+                        self.add_device(device, lazy_session=True)
+                        break
+                    self.loading = True
+                    self._thread_pool_executor.submit(self._load_in_background, devices_from_db)
+                else:
+                    for device in devices_from_db:
+                        self.add_device(device, lazy_session=True)
+            elif DEVICES_SOURCE == "SHARED":
+                self.load_shared_devices()
             else:
                 raise ValueError("incorrect devices source")
-            self.last_devices_reload_time = sys.maxsize
         except Exception as e:
             logging.error(e)
 
-    def get_sender(self):
-        sender = HttpxSender(max_attempt=1, proxy_switcher=self.proxy_service)
+    def _load_in_background(self, devices):
+        try:
+            for device in devices:
+                self.add_device(device, lazy_session=True)
+        except Exception as e:
+            logging.error(format_except(e))
+        finally:
+            self.loading = False
+            logging.warning("{} devices loaded".format(len(self.devices)))
+
+    def load_shared_devices(self):
+        """! Registering worker fills shared devices table, others wait for it. Then all workers lease devices. """
+        if self.registration_lock.try_acquire():
+            self.fill_shared_devices()
+        else:
+            wait_until = time.time() + SHARED_DEVICES_WAIT_SEC
+            needed = 1 if FAST_START else min(self.device_pool_size, SHARED_DEVICES_TOTAL)
+            while self._db_session.count_devices() < needed and time.time() < wait_until:
+                time.sleep(1)
+
+        for device in self._db_session.lease_devices(self.owner, self.device_pool_size, DEVICE_LEASE_SEC):
+            self.add_device(device, lazy_session=True)
+        logging.warning("leased {} shared devices".format(len(self.devices)))
+
+    def fill_shared_devices(self):
+        """! Register devices until shared devices table has `SHARED_DEVICES_TOTAL` of them. """
+        missing = SHARED_DEVICES_TOTAL - self._db_session.count_devices()
+        if missing <= 0:
+            return
+        logging.warning("registering {} shared devices".format(missing))
+        wait([self._thread_pool_executor.submit(self.create_device) for _ in range(missing)])
+
+    def is_shared(self) -> bool:
+        return DEVICES_SOURCE == "SHARED"
+
+    def get_sender(self, switcher: SenderProxies = None):
+        sender = HttpxSender(max_attempt=1, proxy_switcher=switcher or self.proxy_service)
         #sender = Sender(max_attempt=1, proxy_switcher=self.proxy_service)
         # adapter = requests.adapters.HTTPAdapter(pool_connections=1000,
         #                                             pool_maxsize=1000)
@@ -79,39 +205,134 @@ class DevicePoll:
         return sender
 
     def get_device(self, proxy_on: bool = True) -> TikTokPhone:
-        """! Get any device from devices queue pool. """
+        """! Get the least loaded of two random devices of the pool (power of two choices).
+            Waits up to DEVICE_WAIT_SEC for a device when the pool is empty, then raises NoDeviceAvailable.
+        """
         self.device_usage_lock.acquire()
-        if current_milli_time() - self.last_devices_reload_time > self.devices_reload_interval_millis:
-            self.load_devices()
-
-        logging.debug("Pulling device from Queue with Length: [%2d]",
-                      len(self.devices))
+        try:
+            logging.debug("Pulling device from Queue with Length: [%2d]",
+                          len(self.devices))
 
-        device: TikTokPhone = self.devices[self._cursor % len(self.devices)]
-        self._cursor = (self._cursor + 1) % len(self.devices)
+            if len(self.devices) == 0 and not self.device_added.wait_for(lambda: len(self.devices) != 0,
+                                                                          DEVICE_WAIT_SEC):
+                raise NoDeviceAvailable()
+            if len(self.devices) == 1:
+                device = self.devices[0]
+            else:
+                device, other = random.sample(self.devices, 2)
+                if self._health(other).load() < self._health(device).load():
+                    device = other
+        finally:
+            self.device_usage_lock.release()
 
-        self.device_usage_lock.release()
+        if device.device_id in self._sessions_pending:
+            self._bind_session(device)
         return device
 
+    def _bind_session(self, device: TikTokPhone):
+        with self._session_lock:
+            if device.device_id in self._sessions_pending:
+                switcher = SenderProxies(self.proxy_service)
+                device.update_session(self.get_sender(switcher))
+                self.proxy_switchers[device.device_id] = switcher
+                self._sessions_pending.discard(device.device_id)
+
+    def readiness(self) -> dict:
+        return {"ready": len(self.devices) != 0,
+                "loading": self.loading,
+                "devices": len(self.devices),
+                "target": self.device_pool_size}
+
+    def acquire_device(self, proxy_on: bool = True) -> Tuple[TikTokPhone, ProxyAttempt]:
+        """! Get device for upstream request and attempt following proxy of its sender.
+            Outcome must be reported with `release_device`.
+        """
+        device = self.get_device(proxy_on=proxy_on)
+        with self.device_usage_lock:
+            self._health(device).in_flight += 1
+            switcher = self.proxy_switchers.get(device.device_id)
+        return device, switcher.start_attempt() if switcher is not None else ProxyAttempt(None)
+
+    def release_device(self, device: TikTokPhone, attempt: ProxyAttempt, latency_ms: float, failure: str = None):
+        """! Record outcome of request attempt made by device. Proxy outcome is recorded for the proxy
+            attempt went through. Bad devices are replaced in background.
+        """
+        with self.device_usage_lock:
+            switcher = self.proxy_switchers.get(device.device_id)
+        proxy = switcher.finish_attempt(attempt) if switcher is not None else attempt.proxy
+        if failure is None or failure in PROXY_FAILURES:
+            self.proxy_service.record(proxy, latency_ms, failure)
+        with self.device_usage_lock:
+            health = self._health(device)
+            health.in_flight = max(0, health.in_flight - 1)
+            health.record(latency_ms, failure)
+            if not health.is_bad() or device not in self.devices or len(self.devices) <= 1:
+                return
+            # device leaves the pool under the same lock, so concurrent releases quarantine it only once
+            self.quarantined += 1
+            self.retired.add(device.device_id)
+            spare = self._replace_locked(device)
+            if spare is None:
+                self._remove_locked(device)
+        logging.warning("device {} quarantined. recent failures {}".format(
+            device.device_id, [kind for _, kind in health.recent_failures]))
+        self._retire_device(device)
+        if spare is None:
+            self._thread_pool_executor.submit(self.register_device)
+        else:
+            logging.warning("device {} replaced with {}".format(device.device_id, spare.device_id))
+
+    def rotate_proxy(self, device: TikTokPhone):
+        """! Switch device to the next proxy chosen by proxy_service. """
+        device.session.update_proxy()
+
+    def _health(self, device: TikTokPhone) -> DeviceHealth:
+        health = self.health.get(device.device_id)
+        if health is None:
+            health = DeviceHealth()
+            self.health[device.device_id] = health
+        return health
+
+    def stats(self) -> dict:
+        with self.device_usage_lock:
+            return {"devices": len(self.devices),
+                    "spares": len(self.spares),
+                    "quarantined": self.quarantined,
+                    "replaced": self.replaced,
+                    "registering": self.registering,
+                    "in_flight": sum(self._health(device).in_flight for device in self.devices)}
+
     def update_device_proxy(self, device=TikTokPhone) -> TikTokPhone:
         """Updating proxy of device"""
-        proxy = self._get_proxy()
+        proxy = self._get_proxy(device)
         device.session.proxies.update(proxy)
         return device
 
-    def register_device(self):
-        """Updating device in devices queue pool """
+    def create_device(self):
+        """! Create and register new device. Returns None if all attempts have failed.
+            Shared devices are registered only by one worker, other workers lease one more device instead.
+            Devices loaded from the database are never registered, the next stored one is taken instead.
+        """
+        if DEVICES_SOURCE == "DATABASE":
+            return self._next_stored_device()
+
+        if self.is_shared() and not self.registration_lock.is_acquired():
+            for device in self._db_session.lease_devices(self.owner, 1, DEVICE_LEASE_SEC):
+                self._sessions_pending.add(device.device_id)
+                return device
+            return None
+
         for i in range(MAX_ATTEMPTS_DEVICE_CREATION):
             try:
-                sender = self.get_sender()
-                device = create_phone(sender)
+                switcher = SenderProxies(self.proxy_service)
+                device = create_phone(self.get_sender(switcher))
+                self.proxy_switchers[device.device_id] = switcher
                 logging.warning(
                     "new device {} created on proxy proxy {}".format(device.device_id, str(device.session.proxies)))
-                self.devices.append(device)
                 self._thread_lock.acquire(True)
                 self._db_session.insert_device(device)
                 self._thread_lock.release()
-                return
+                return device
 
             except requests.exceptions.ConnectionError:
                 logging.warning(
@@ -123,19 +344,175 @@ class DevicePoll:
                 continue
         logging.warning(
             "All attempts to create device have failed")
+        return None
+
+    def _next_stored_device(self):
+        """! Stored device which is neither used nor retired by this worker, None if there is no such. """
+        with self.device_usage_lock:
+            exclude_ids = [device.device_id for device in self.devices + self.spares] + list(self.retired)
+        for device in self._db_session.iter_created_devices(1, exclude_ids):
+            self._sessions_pending.add(device.device_id)
+            return device
+        logging.warning("no stored devices left")
+        return None
+
+    def register_device(self):
+        """! Register device and put it in the pool, in spares when the pool is full. Device is dropped
+            when spares are full too, f.e. pool has been refilled meanwhile. Returns None if it's not created.
+        """
+        with self.device_usage_lock:
+            self.registering += 1
+        device, placed = None, False
+        try:
+            device = self.create_device()
+        finally:
+            with self.device_usage_lock:
+                self.registering -= 1
+                if device is not None:
+                    placed = self._place_locked(device)
+        if device is not None and not placed:
+            logging.warning("device {} is not needed anymore, dropped".format(device.device_id))
+            self._sessions_pending.discard(device.device_id)
+            self.proxy_switchers.pop(device.device_id, None)
+            self._release_lease(device)
+        return device
+
+    def _place_locked(self, device: TikTokPhone) -> bool:
+        """! Put device in the pool or in spares, `device_usage_lock` must be held. False if both are full. """
+        if len(self.devices) < self.device_pool_size:
+            self._add_locked(device)
+            return True
+        if len(self.spares) < DEVICE_SPARES:
+            self.spares.append(device)
+            return True
+        return False
+
+    def refill(self):
+        """! Register devices until the pool and spares are full, counting devices being registered. """
+        while True:
+            with self.device_usage_lock:
+                missing = self.device_pool_size + DEVICE_SPARES - len(self.devices) - len(self.spares) - \
+                    self.registering
+            if missing <= 0 or self.register_device() is None:
+                return
+
+    def add_device(self, device: TikTokPhone, lazy_session: bool = False):
+        if lazy_session:
+            self._sessions_pending.add(device.device_id)
+        with self.device_usage_lock:
+            self._add_locked(device)
+
+    def _add_locked(self, device: TikTokPhone):
+        self.devices.append(device)
+        self.device_added_at[device.device_id] = time.time()
+        self.device_added.notify_all()
+
+    def remove_device(self, device: TikTokPhone):
+        with self.device_usage_lock:
+            self._remove_locked(device)
+        self._release_lease(device)
+
+    def replace_device(self, device: TikTokPhone) -> bool:
+        """! Swap device with registered spare one. Returns False if there are no spares. """
+        with self.device_usage_lock:
+            spare = self._replace_locked(device)
+        if spare is None:
+            return False
+        self._release_lease(device)
+        logging.warning("device {} replaced with {}".format(device.device_id, spare.device_id))
+        return True
+
+    def _forget_locked(self, device: TikTokPhone):
+        self.device_added_at.pop(device.device_id, None)
+        self.health.pop(device.device_id, None)
+        self.proxy_switchers.pop(device.device_id, None)
+
+    def _remove_locked(self, device: TikTokPhone):
+        """! Remove device from the pool, `device_usage_lock` must be held. """
+        if device in self.devices:
+            self.devices.remove(device)
+        self._forget_locked(device)
+
+    def _replace_locked(self, device: TikTokPhone):
+        """! Put spare device in place of device, `device_usage_lock` must be held. Returns spare or None. """
+        if len(self.spares) == 0 or device not in self.devices:
+            return None
+        spare = self.spares.pop()
+        self.devices[self.devices.index(device)] = spare
+        self._forget_locked(device)
+        self.device_added_at[spare.device_id] = time.time()
+        self.replaced += 1
+        return spare
+
+    def _retire_device(self, device: TikTokPhone):
+        """! Quarantined shared device is deleted, so no worker leases it again. Registering worker
+            registers another one on the next maintenance step.
+        """
+        if self.is_shared():
+            self._db_session.delete_device(device.device_id)
+
+    def _release_lease(self, device: TikTokPhone):
+        if self.is_shared():
+            self._db_session.release_device_lease(self.owner, device.device_id)
+
+    def maintain(self):
+        """! One maintenance step: refill pool and spares, then replace the oldest device if it's too old.
+            Devices are created out of `device_usage_lock`, so `get_device` is never blocked by registration.
+            Pool isn't refilled while initial devices are still being loaded.
+        """
+        if self.is_shared():
+            self._db_session.renew_device_leases(self.owner, DEVICE_LEASE_SEC)
+            # other worker takes registration over if registering one has died
+            if self.registration_lock.try_acquire():
+                self.fill_shared_devices()
+
+        if self.loading:
+            return
+        self.refill()
+
+        with self.device_usage_lock:
+            if len(self.devices) == 0:
+                return
+            oldest = min(self.devices, key=lambda d: self.device_added_at.get(d.device_id, 0))
+            age_sec = time.time() - self.device_added_at.get(oldest.device_id, 0)
+        if age_sec > DEVICE_MAX_AGE_MIN * 60:
+            self.replace_device(oldest)
 
     def create_devices(self, count: int):
+        """! Register `count` devices. Returns when enough of them are ready, the rest are added in background. """
         logging.info("Create [%2d] devices", count)
-        futures = [self._thread_pool_executor.submit(self.register_device) for _ in range(self.device_pool_size)]
+        futures = [self._thread_pool_executor.submit(self.register_device) for _ in range(count)]
         counter = 0
-        counter_completed_min_limit = 7
-        while counter < counter_completed_min_limit:
-            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
-            futures = not_done
-            if len(done) != 0:
-                future = done.pop()
-                if not future.cancelled() and not future.exception():
+        counter_completed_min_limit = 1 if FAST_START else min(7, count)
+        self.loading = True
+        while counter < counter_completed_min_limit and len(futures) != 0:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if not future.cancelled() and future.exception() is None and future.result() is not None:
                     counter += 1
+        self._thread_pool_executor.submit(self._finish_loading, futures)
+
+    def _finish_loading(self, futures):
+        wait(futures)
+        self.loading = False
 
-    def _get_proxy(self) -> dict:
-        return wrap_requests_proxy(self.proxy_service.next())
\ No newline at end of file
+    def _get_proxy(self, device: TikTokPhone) -> dict:
+        switcher = self.proxy_switchers.get(device.device_id)
+        return wrap_requests_proxy((switcher or self.proxy_service).next())
+
+
+@singleton
+class DevicePoolMaintainer(threading.Thread):
+    """! Keeps device pool filled and rolls old devices out one by one in background. """
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.device_pool = DevicePoll()
+
+    def run(self):
+        while True:
+            time.sleep(DEVICE_MAINTENANCE_INTERVAL_SEC)
+            try:
+                self.device_pool.maintain()
+            except Exception as e:
+                logging.error(format_except(e))
@@ -0,0 +1,38 @@
+import asyncio
+import logging
+import threading
+from typing import Coroutine
+
+from app.utils.utils import singleton
+
+
+@singleton
+class WorkerLoop:
+    """! One asyncio event loop per worker process running in a background thread.
+
+        Coroutines of all request threads are scheduled on this loop, so async upstream
+        calls (and clients bound to the loop) are shared instead of a new loop per call.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="worker-event-loop", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        logging.info("worker event loop started")
+        self.loop.run_forever()
+
+    def submit(self, coro: Coroutine):
+        """! Schedule coroutine on the loop and return concurrent future of it. """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Coroutine, timeout: float = None):
+        """! Run coroutine on the loop and block calling thread until it's done. """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
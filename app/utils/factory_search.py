@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import time
 from abc import ABC, abstractmethod
+from typing import Callable
 
 import logging
 
@@ -14,13 +15,20 @@ from app.api.types_.search import ApiSearchResponse, \
     ApiLikedPostSearchResponse, ApiBuildedRequest, \
     ApiPostSearchBuildRequest, ApiSearchBuildSidRequest, ApiScheduleViewsRequest
 from app.db.database import Database
-from app.utils.device_pool import DevicePoll
-
-from app.utils.user_search import get_user_info, \
-    get_post, get_posts, SearchException, get_liked_posts, \
+from app.db.write_behind import WriteBehindQueue
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.device_pool import DevicePoll, failure_kind, NEUTRAL_FAILURES
+from app.utils.fields import FieldMask
+from app.utils.hedging import hedged_call
+from app.utils.pagination import PageState
+from app.utils.prefetch import prefetch_pages
+from app.utils.revalidate import Revalidator
+
+from app.utils.user_search import UserInfo, PostInfo, get_user_info, \
+    get_post, SearchException, aweme_detail_to_post, get_user_posts_raw, get_user_liked_posts_raw, \
     get_post_build_request, get_user_info_build_request, get_user_posts_build_request
 from app.utils.utils import format_except
-from config.application import USE_CACHING
+from config.application import USE_CACHING, USERS_STALE_WHILE_REVALIDATE
 
 
 class SearchCreator(ABC):
@@ -52,30 +60,47 @@ class SearchCreator(ABC):
         params like a dict, with following keywords:
             - proxy_on: bool (on/off proxy for current search-request?)
             - device_return: bool (return/or no device from successfully search)
+            - deadline: Deadline (time budget of API request, product stops when it runs out)
         """
 
         device_return: bool = params.get("device_return", True)
         proxy_on: bool = params.get("proxy_on", True)
+        deadline: Deadline = params.get("deadline")
+        if deadline is not None:
+            deadline.check("search")
 
         # Getting factory product
         product = self.factory_method()
+        product.deadline = deadline
 
         # Updating TikTok device for next requests
-        device = DevicePoll().get_device(proxy_on=proxy_on)
+        device, attempt = DevicePoll().acquire_device(proxy_on=proxy_on)
+        started_at = time.monotonic()
 
         try:
             logging.warning(
                 "using device {}".format(device.device_id))
             result = product.operation(device, payload)
+            DevicePoll().release_device(device, attempt, (time.monotonic() - started_at) * 1000)
             return result
+        except DeadlineExceeded as ex:
+            # running out of time says nothing about device, client gets 504 instead of 404
+            DevicePoll().release_device(device, attempt, (time.monotonic() - started_at) * 1000, failure_kind(ex))
+            raise
         except (SearchException, EmptyResponseBodyError) as ex:
             logging.warning("Not found with payload [%s]. error [%s]", payload, str(ex))
-        except requests.exceptions.ConnectionError:
+            failure = failure_kind(ex)
+        except requests.exceptions.ConnectionError as ex:
             logging.warning("Connection error on payload [%s]", payload)
+            failure = failure_kind(ex)
         except Exception as e:
             logging.warning("Unhandled error, [%s]", format_except(e))
+            failure = failure_kind(e)
 
-        device.session.update_proxy()
+        DevicePoll().release_device(device, attempt, (time.monotonic() - started_at) * 1000, failure)
+        # missing item says nothing about proxy, otherwise device moves to another one
+        if failure not in NEUTRAL_FAILURES:
+            DevicePoll().rotate_proxy(device)
         raise SearchException("item not found", 404)
 
 
@@ -89,9 +114,19 @@ class SearchPostByShareLinkCreator(SearchCreator):
         return SearchPostByShareLink()
 
 
-class SearchLikedPostsCreator(SearchCreator):
+class SearchLikedPostsPageCreator(SearchCreator):
+    def factory_method(self) -> SearchProduct:
+        return SearchLikedPostsPage()
+
+
+class SearchPostsPageCreator(SearchCreator):
+    def factory_method(self) -> SearchProduct:
+        return SearchPostsPage()
+
+
+class RefreshUserBySidCreator(SearchCreator):
     def factory_method(self) -> SearchProduct:
-        return SearchLikedPosts()
+        return RefreshUserBySid()
 
 
 class BuildSearchBySidCreator(SearchCreator):
@@ -119,6 +154,7 @@ class SearchProduct(ABC):
     """
     Interface of all Search-products that's implemented all search logic
     """
+    deadline: Deadline = None
 
     @abstractmethod
     def operation(self, device,
@@ -126,9 +162,98 @@ class SearchProduct(ABC):
         pass
 
 
+def fetch_cached_user(sid: str):
+    """! Get user from cache. Expired user is returned with stale-while-revalidate and refreshed in background. """
+    user = Database().fetch_cached_user_full_info(sid, allow_stale=USERS_STALE_WHILE_REVALIDATE)
+    if user is not None and user.stale:
+        Revalidator().submit(("user", sid), lambda: RefreshUserBySidCreator().search({"sid": sid}))
+    return user
+
+
+def convert_aweme(aweme, fields: FieldMask = None) -> PostInfo:
+    """! Convert fetched aweme to post, it's done while the next page is fetched.
+        Conversion is local (short links are filled before response), so no device is taken for it.
+    """
+    return aweme_detail_to_post(aweme, None, fields)
+
+
+def cached_posts(sid: str, amount: int) -> tuple:
+    """! Cached latest posts of user and PageState to continue fetching the feed from.
+        State is None when feed has to be fetched from the start. Returns (posts, state, complete),
+        `complete` means that cached posts are enough and there is nothing to fetch.
+    """
+    cached = Database().fetch_latest_cached_posts(sid, amount)
+    state = Database().fetch_posts_cursor(sid)
+    if state is not None and not set(post.aweme_id for post in cached).issuperset(state.ids):
+        # posts before the cursor aren't cached anymore, feed is fetched from the start
+        state = None
+    complete = len(cached) >= amount or (state is not None and not state.has_more)
+    return cached, state, complete
+
+
+def cache_posts(sid: str, posts: list, state: PageState):
+    """! Cache fetched page of user posts and cursor after it. """
+    Database().cache_posts_cursor(sid, state)
+    WriteBehindQueue().cache_posts_info(posts)
+
+
+def hedged_page_fetcher(executor, creator: SearchCreator, sid: str, name: str,
+                        deadline: Deadline = None) -> Callable:
+    """! `fetch_page(cursor, count)` of feed of user `sid` for `iter_pages`. Every page is fetched by `creator`
+        with hedged attempts on `executor`, each attempt takes a device of the pool for this page only.
+    """
+    def fetch_page(cursor, count):
+        page = hedged_call(executor, lambda: creator.search({"sid": sid, "cursor": cursor, "count": count},
+                                                            proxy_on=True, deadline=deadline),
+                           name=name, deadline=deadline)
+        if page is None:
+            raise SearchException("posts not found", 404)
+        return page
+
+    return fetch_page
+
+
+def fetch_posts(fetch_raw_page: Callable, sid: str, amount: int, fields: FieldMask = None,
+                deadline: Deadline = None) -> tuple:
+    """! Latest `amount` posts of user, pages of the feed are fetched with `fetch_raw_page(cursor, count)`.
+        Posts are taken from cache, when there are not enough of them fetching continues from the cursor
+        where the previous fetch of the user stopped. Without caching only fields of `fields` mask are filled.
+        Paging stops when `deadline` runs out.
+        Returns (posts, partial), `partial` means that feed has more posts but there was no time for them.
+    """
+    if not USE_CACHING:
+        posts, state = list(), PageState()
+        for page, state in prefetch_pages(fetch_raw_page, lambda aweme: convert_aweme(aweme, fields), amount,
+                                          deadline=deadline):
+            posts += page
+        return sort_posts(posts)[:amount], is_partial(state, amount)
+
+    cached, state, complete = cached_posts(sid, amount)
+    if complete:
+        return cached[:amount], False
+
+    posts = list()
+    state = state if state is not None else PageState()
+    for page, state in prefetch_pages(fetch_raw_page, convert_aweme, amount, state, deadline=deadline):
+        posts += page
+        cache_posts(sid, page, state)
+    fetched_ids = set(post.aweme_id for post in posts)
+    posts = sort_posts(posts + [post for post in cached if post.aweme_id not in fetched_ids])[:amount]
+    return posts, is_partial(state, amount)
+
+
+def is_partial(state: PageState, amount: int) -> bool:
+    """! Whether paging stopped before `amount` items while feed has more, i.e. by deadline. """
+    return state.has_more and len(state.ids) < amount
+
+
+def sort_posts(posts: list) -> list:
+    return sorted(posts, key=lambda post: post.create_time or 0, reverse=True)
+
+
 class SearchBySid(SearchProduct):
     """
-        Implements search method by sid
+        Implements search method by sid, posts are fetched page by page by caller (see `fetch_posts`)
     """
 
     def operation(self, device,
@@ -136,25 +261,49 @@ class SearchBySid(SearchProduct):
         request = ApiSearchSidRequest(**payload)
         user = None
         if USE_CACHING:
-            user = Database().fetch_cached_user_full_info(request.sid)
+            user = fetch_cached_user(request.sid)
         if user is None:
             user = get_user_info(device, request.sid)
 
         if user.secret == 1:
             logging.warning("got response that this user is secret one")
 
-        posts = None
-        if request.amount_of_posts > 0 and user.secret != 1:
-            if USE_CACHING:
-                posts = Database().fetch_latest_cached_posts(request.sid, request.amount_of_posts)
-            if posts is None or len(posts) == 0:
-                posts = get_posts(device, request.sid,
-                                  request.amount_of_posts)[:request.amount_of_posts]
-                if USE_CACHING:
-                    for item in posts:
-                        Database().cache_post_info(item)
+        return ApiSearchResponse(user, None)
+
+
+class SearchPostsPage(SearchProduct):
+    """
+        Implements fetching one page of user posts feed by sid and cursor, awemes are converted by caller
+    """
+
+    def operation(self, device,
+                  payload: Namespace.payload) -> tuple:
+        return get_user_posts_raw(device, payload["sid"], payload["cursor"], payload["count"])
+
+
+class SearchLikedPostsPage(SearchProduct):
+    """
+        Implements fetching one page of liked posts feed by sid and cursor, awemes are converted by caller
+    """
+
+    def operation(self, device,
+                  payload: Namespace.payload) -> tuple:
+        return get_user_liked_posts_raw(device, payload["sid"], payload["cursor"], payload["count"])
+
+
+class RefreshUserBySid(SearchProduct):
+    """
+        Implements refreshing cached user by sid
+    """
 
-        return ApiSearchResponse(user, posts)
+    def operation(self, device,
+                  payload: Namespace.payload) -> UserInfo:
+        request = ApiSearchSidRequest(**payload)
+        user = get_user_info(device, request.sid)
+        # secret answer needs confirmation, so it's left for the usual search
+        if user.secret != 1:
+            WriteBehindQueue().cache_user_full_info(user)
+        return user
 
 
 class BuildSearchBySid(SearchProduct):
@@ -219,18 +368,16 @@ class BuildSearchPostByShareLink(SearchProduct):
         return ApiBuildedRequest(posts)
 
 
-class SearchLikedPosts(SearchProduct):
-    def operation(self, device,
-                  payload: Namespace.payload) -> ApiSearchResponse:
-        request = ApiSearchSidRequest(**payload)
-        posts = None
-        request.amount_of_posts = request.amount_of_posts if request.amount_of_posts > 0 else 20
-        posts = get_liked_posts(device,
-                                request.sid,
-                                request.amount_of_posts,
-                                full=True)[:request.amount_of_posts]
-
-        return ApiLikedPostSearchResponse(posts)
+def fetch_liked_posts(fetch_raw_page: Callable, amount: int, fields: FieldMask = None,
+                      deadline: Deadline = None) -> ApiLikedPostSearchResponse:
+    """! Up to `amount` liked posts (20 when it's not set), pages of the feed are fetched with
+        `fetch_raw_page(cursor, count)`. Only fields of `fields` mask are filled.
+    """
+    amount = amount if amount > 0 else 20
+    posts = [post for page, _ in prefetch_pages(fetch_raw_page, lambda aweme: convert_aweme(aweme, fields), amount,
+                                                deadline=deadline)
+             for post in page]
+    return ApiLikedPostSearchResponse(posts[:amount])
 
 
 def schedule_views(payload: Namespace.payload):
@@ -0,0 +1,54 @@
+from typing import Optional
+
+from flask import current_app, request
+from flask_restplus.mask import Mask, ParseError
+
+
+class FieldMask:
+    """! Parsed X-Fields mask of response. Empty mask means that all fields are returned.
+
+        Searches use it to skip fetching and computing fields which are cut by marshalling anyway.
+    """
+
+    def __init__(self, mask=None):
+        if isinstance(mask, str):
+            try:
+                mask = Mask(mask)
+            except ParseError:
+                # invalid mask is reported by marshal_with, everything is fetched meanwhile
+                mask = None
+        self._mask = mask or None
+
+    @property
+    def mask(self) -> Optional[Mask]:
+        """! Mask for `marshal` or None. """
+        return self._mask
+
+    def is_all(self) -> bool:
+        return self._mask is None
+
+    def wants(self, field: str) -> bool:
+        return self._mask is None or field in self._mask or "*" in self._mask
+
+    def nested(self, field: str) -> "FieldMask":
+        """! Mask of nested model (or list of models) in `field`. """
+        if self._mask is None:
+            return self
+        nested = self._mask.get(field, self._mask.get("*"))
+        return FieldMask(nested if isinstance(nested, Mask) else None)
+
+
+def _mask_header() -> str:
+    return current_app.config.get("RESTPLUS_MASK_HEADER", "X-Fields")
+
+
+def request_mask() -> Optional[str]:
+    """! X-Fields mask of the current request or None. """
+    return request.headers.get(_mask_header()) or None
+
+
+def fields_parameter_to_header():
+    """! `fields` query parameter works as X-Fields header, so it's used by marshal_with too. """
+    fields = request.args.get("fields")
+    if fields and not request.headers.get(_mask_header()):
+        request.environ["HTTP_" + _mask_header().upper().replace("-", "_")] = fields
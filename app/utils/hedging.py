@@ -0,0 +1,222 @@
+import asyncio
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from app.utils.deadline import Deadline
+from app.utils.user_search import SearchException
+from app.utils.utils import singleton
+from config.application import HEDGE_MAX_ATTEMPTS, HEDGE_MAX_IN_FLIGHT, HEDGE_DELAY_PERCENTILE, \
+    HEDGE_DEFAULT_DELAY_MS, HEDGE_MIN_DELAY_MS
+
+
+@dataclass
+class HedgePolicy:
+    """! Describes how one logical request is spread over several upstream attempts.
+
+        @param initial_attempts     attempts launched right away
+        @param max_attempts         total attempts for one logical request
+        @param max_in_flight        attempts allowed to run at the same time
+        @param delay_percentile     latency percentile used as hedge delay
+        @param default_delay_ms     hedge delay while there are not enough latency samples
+        @param min_delay_ms         lower bound of the hedge delay
+        @param confirmations        successful results required when `needs_confirmation` returns True
+    """
+    initial_attempts: int = 1
+    max_attempts: int = HEDGE_MAX_ATTEMPTS
+    max_in_flight: int = HEDGE_MAX_IN_FLIGHT
+    delay_percentile: int = HEDGE_DELAY_PERCENTILE
+    default_delay_ms: int = HEDGE_DEFAULT_DELAY_MS
+    min_delay_ms: int = HEDGE_MIN_DELAY_MS
+    confirmations: int = 2
+
+
+@singleton
+class LatencyTracker:
+    """! Keeps latest latencies of successful upstream attempts per operation. """
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self._lock = threading.Lock()
+        self._window = window
+        self._min_samples = min_samples
+        self._samples = collections.defaultdict(lambda: collections.deque(maxlen=self._window))
+
+    def record(self, name: str, latency_ms: float):
+        with self._lock:
+            self._samples[name].append(latency_ms)
+
+    def percentile(self, name: str, percentile: int) -> Optional[float]:
+        """! Returns latency percentile in millis or None if there are not enough samples. """
+        with self._lock:
+            samples = sorted(self._samples[name])
+        if len(samples) < self._min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+
+# shortest wait for attempts, waiting zero time when deadline is about to run out would spin the loop
+MIN_WAIT_SEC = 0.01
+
+
+def hedge_delay_ms(name: str, policy: HedgePolicy) -> float:
+    """! Delay after which next hedge attempt is launched. """
+    delay = LatencyTracker().percentile(name, policy.delay_percentile)
+    if delay is None:
+        delay = policy.default_delay_ms
+    return max(delay, policy.min_delay_ms)
+
+
+def is_unavailable(ex: BaseException) -> bool:
+    """! Attempt failed with 503, retrying it right away doesn't help. """
+    return isinstance(ex, SearchException) and ex.http_code == 503
+
+
+class _Hedge:
+    """! Attempts of one hedged call and decisions shared by `hedged_call` and `hedged_call_async`.
+        `launch_fn` starts attempt and returns its future or task, waiting for them is left to the caller.
+    """
+
+    def __init__(self, launch_fn: Callable, name: str, policy: HedgePolicy = None,
+                 needs_confirmation: Callable = None, deadline: Deadline = None):
+        self.launch_fn = launch_fn
+        self.name = name
+        self.policy = policy if policy is not None else HedgePolicy()
+        self.needs_confirmation = needs_confirmation
+        self.deadline = deadline
+        self.delay = hedge_delay_ms(name, self.policy) / 1000
+        self.in_flight = set()
+        self.started_at = dict()
+        self.launched = 0
+        self.confirmed = 0
+        self.unavailable = None
+
+    def launch(self):
+        attempt = self.launch_fn()
+        self.started_at[attempt] = time.monotonic()
+        self.in_flight.add(attempt)
+        self.launched += 1
+
+    def start(self):
+        for _ in range(min(self.policy.initial_attempts, self.policy.max_attempts)):
+            self.launch()
+
+    def can_hedge(self) -> bool:
+        return self.launched < self.policy.max_attempts and len(self.in_flight) < self.policy.max_in_flight
+
+    def timeout(self) -> Optional[float]:
+        """! How long to wait for attempts before the next decision. """
+        timeout = self.delay if self.can_hedge() else None
+        if self.deadline is not None:
+            timeout = max(self.deadline.timeout(timeout), MIN_WAIT_SEC)
+        return timeout
+
+    def on_timeout(self):
+        """! No attempt is done in time: launch hedge attempt or give up when deadline is over. """
+        if self.deadline is not None:
+            self.deadline.check(self.name)
+        if not self.can_hedge():
+            return
+        logging.warning("{}: no response in {:.0f}ms, launching hedge attempt {}".format(
+            self.name, self.delay * 1000, self.launched + 1))
+        self.launch()
+
+    def on_done(self, done) -> tuple:
+        """! Handle finished attempts. Returns (True, result) when result is accepted, otherwise (False, None)
+            and failed or unconfirmed attempts are replaced without waiting for the hedge delay.
+        """
+        replacements = 0
+        for attempt in done:
+            self.in_flight.discard(attempt)
+            if attempt.cancelled():
+                replacements += 1
+                continue
+            if attempt.exception() is not None:
+                logging.warning("{}: attempt failed. error [{}]".format(self.name, str(attempt.exception())))
+                if is_unavailable(attempt.exception()):
+                    # next attempt would fail the same way, f.e. there are no devices
+                    self.unavailable = attempt.exception()
+                    continue
+                replacements += 1
+                continue
+            result = attempt.result()
+            LatencyTracker().record(self.name, (time.monotonic() - self.started_at[attempt]) * 1000)
+            if self.needs_confirmation is not None and self.needs_confirmation(result):
+                self.confirmed += 1
+                if self.confirmed >= self.policy.confirmations:
+                    return True, result
+                replacements += 1
+                continue
+            return True, result
+
+        while replacements > 0 and self.can_hedge() and (self.deadline is None or not self.deadline.expired()):
+            self.launch()
+            replacements -= 1
+        return False, None
+
+    def give_up(self):
+        """! All attempts failed: DeadlineExceeded if deadline is over, error of attempt which found service
+            unavailable if there is such, otherwise None is returned.
+        """
+        if self.deadline is not None:
+            self.deadline.check(self.name)
+        if self.unavailable is not None:
+            raise self.unavailable
+        return None
+
+    def cancel(self):
+        for attempt in self.in_flight:
+            attempt.cancel()
+
+
+def hedged_call(executor, fn: Callable, name: str, policy: HedgePolicy = None,
+                needs_confirmation: Callable = None, deadline: Deadline = None):
+    """! Run `fn` on `executor` with hedging and return the first accepted result or None.
+
+        One attempt is started at first. Next attempt is started when the running ones
+        are slower than the hedge delay or as soon as one of them fails. Results for which
+        `needs_confirmation` returns True are accepted only after `policy.confirmations` of them.
+        Queued attempts are cancelled when the result is accepted, running ones are discarded.
+        No attempts are started after `deadline`, DeadlineExceeded is raised if it runs out without result.
+        Attempts failed with 503 (f.e. there are no devices) aren't replaced, their error is raised.
+    """
+    hedge = _Hedge(lambda: executor.submit(fn), name, policy, needs_confirmation, deadline)
+    try:
+        hedge.start()
+        while len(hedge.in_flight) != 0:
+            done, _ = wait(hedge.in_flight, timeout=hedge.timeout(), return_when=FIRST_COMPLETED)
+            if len(done) == 0:
+                hedge.on_timeout()
+                continue
+            accepted, result = hedge.on_done(done)
+            if accepted:
+                return result
+        return hedge.give_up()
+    finally:
+        hedge.cancel()
+
+
+async def hedged_call_async(coro_fn: Callable, name: str, policy: HedgePolicy = None,
+                            needs_confirmation: Callable = None, deadline: Deadline = None):
+    """! Same as `hedged_call` but attempts are coroutines created by `coro_fn` on the running loop.
+        Losers are cancelled for real instead of being discarded.
+    """
+    hedge = _Hedge(lambda: asyncio.ensure_future(coro_fn()), name, policy, needs_confirmation, deadline)
+    try:
+        hedge.start()
+        while len(hedge.in_flight) != 0:
+            done, _ = await asyncio.wait(hedge.in_flight, timeout=hedge.timeout(),
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if len(done) == 0:
+                hedge.on_timeout()
+                continue
+            accepted, result = hedge.on_done(done)
+            if accepted:
+                return result
+        return hedge.give_up()
+    finally:
+        hedge.cancel()
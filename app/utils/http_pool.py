@@ -0,0 +1,85 @@
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+from app.utils.utils import singleton
+from config.application import HTTP_POOL_MAX_CLIENTS, HTTP_POOL_MAX_CONNECTIONS, HTTP_POOL_IDLE_TIMEOUT_SEC
+
+
+@singleton
+class AsyncClientPool:
+    """! Keeps warm HTTP/2 clients keyed by proxy, so TLS and SOCKS handshakes are reused between requests.
+
+        Clients are bound to the worker event loop, so the pool must be used only from coroutines
+        running on `WorkerLoop`. Clients idle longer than `idle_timeout_sec` are closed, and when
+        there are more than `max_clients` of them the least recently used one is closed.
+    """
+
+    def __init__(self, max_clients: int = HTTP_POOL_MAX_CLIENTS,
+                 max_connections: int = HTTP_POOL_MAX_CONNECTIONS,
+                 idle_timeout_sec: int = HTTP_POOL_IDLE_TIMEOUT_SEC):
+        self._clients = OrderedDict()
+        self.max_clients = max_clients
+        self.max_connections = max_connections
+        self.idle_timeout_sec = idle_timeout_sec
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    @staticmethod
+    def _key(proxy) -> str:
+        return str(proxy) if proxy is not None else "direct"
+
+    def _create_client(self, proxy) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(5.0, connect=5.0, read=5.0, write=5.0, pool=5.0)
+        limits = httpx.Limits(max_connections=self.max_connections,
+                              max_keepalive_connections=self.max_connections,
+                              keepalive_expiry=self.idle_timeout_sec)
+        return httpx.AsyncClient(verify=False, http2=True, proxies=proxy, timeout=timeout, http1=False,
+                                 trust_env=True, limits=limits)
+
+    async def get(self, proxy) -> httpx.AsyncClient:
+        await self._evict_idle()
+        key = self._key(proxy)
+        entry = self._clients.get(key)
+        if entry is not None:
+            self._clients[key] = (entry[0], time.monotonic())
+            self._clients.move_to_end(key)
+            self.reused += 1
+            return entry[0]
+
+        client = self._create_client(proxy)
+        self._clients[key] = (client, time.monotonic())
+        self.created += 1
+        while len(self._clients) > self.max_clients:
+            _, (oldest, _) = self._clients.popitem(last=False)
+            await self._close(oldest)
+        return client
+
+    async def discard(self, proxy):
+        """! Close client of proxy, f.e. after connection error. """
+        entry = self._clients.pop(self._key(proxy), None)
+        if entry is not None:
+            await self._close(entry[0])
+
+    async def _evict_idle(self):
+        now = time.monotonic()
+        while len(self._clients) != 0:
+            key, (client, last_used) = next(iter(self._clients.items()))
+            if now - last_used < self.idle_timeout_sec:
+                break
+            del self._clients[key]
+            await self._close(client)
+
+    async def _close(self, client: httpx.AsyncClient):
+        self.evicted += 1
+        try:
+            await client.aclose()
+        except Exception as e:
+            logging.warning("failed closing http client. error [{}]".format(str(e)))
+
+    def stats(self) -> dict:
+        return {"clients": len(self._clients), "created": self.created, "reused": self.reused,
+                "evicted": self.evicted}
@@ -0,0 +1,51 @@
+import logging
+
+from tiktok_mobile.functional.utils import parse_share_url, parse_web_url, parse_short_url
+
+from app.db.database import LocalCache
+from config.application import SHORT_LINK_CACHE_MAX_ENTRIES, SHORT_LINK_CACHE_TTL_SEC
+
+# short link always points to the same post, so redirects are resolved once
+short_links_cache = LocalCache(SHORT_LINK_CACHE_MAX_ENTRIES, SHORT_LINK_CACHE_TTL_SEC)
+
+
+def resolve_short_link(short_link: str) -> str:
+    """! Resolve aweme_id of short link following its redirect. Resolved links are cached. """
+    aweme_id = short_links_cache.get(short_link)
+    if aweme_id is None:
+        aweme_id = parse_short_url(short_link)
+        if aweme_id is not None:
+            short_links_cache.put(short_link, aweme_id)
+    return aweme_id
+
+
+def link_to_aweme_id(link: str) -> str:
+    """! Normalize aweme_id, share link, web link or short link to aweme_id.
+        Share and web links are parsed locally, only short links need network call.
+    """
+    link = link.strip()
+    if link.isdigit():
+        return link
+    for parse in (parse_share_url, parse_web_url):
+        try:
+            aweme_id = parse(link)
+            if aweme_id is not None:
+                return aweme_id
+        except Exception as e:
+            logging.debug("link {} is not parsed by {}. error [{}]".format(link, parse.__name__, str(e)))
+    return resolve_short_link(link)
+
+
+def payload_to_aweme_id(payload) -> str:
+    """! aweme_id of post requested by /post payload or None if none of its links can be resolved. """
+    if payload.get("aweme_id"):
+        return payload["aweme_id"]
+    for field in ("share_link", "web_link", "short_link"):
+        if payload.get(field):
+            try:
+                aweme_id = link_to_aweme_id(payload[field])
+                if aweme_id is not None:
+                    return aweme_id
+            except Exception as e:
+                logging.warning("failed resolving {} {}. error [{}]".format(field, payload[field], str(e)))
+    return None
@@ -0,0 +1,48 @@
+from dataclasses import dataclass
+from typing import Callable, Iterator, Tuple
+
+# tiktok returns up to 20 items per feed page whatever count is asked
+PAGE_SIZE = 20
+
+
+@dataclass(frozen=True)
+class PageState:
+    """! Position in cursor paginated feed.
+
+        @param ids          keys of items collected so far, in feed order
+        @param cursor       cursor returned with the last page, the next page starts from it
+        @param has_more     False when the last page said that feed is over
+    """
+    ids: tuple = ()
+    cursor: int = 0
+    has_more: bool = True
+
+
+def iter_pages(fetch_page: Callable, amount: int, state: PageState = None, key: Callable = lambda item: item.aweme_id,
+               page_size: int = PAGE_SIZE, deadline=None) -> Iterator[Tuple[list, PageState]]:
+    """! Fetch pages of feed until there are `amount` items (with ones of `state`) or feed is over.
+
+        `fetch_page(cursor, count)` returns (items, next_cursor, has_more). The cursor is opaque: the one
+        returned by the page is passed to the next request as is. Items seen before are skipped and
+        pagination stops when page brings nothing new, so repeated pages don't cause endless requests.
+        Yields new items of every page (not cut to `amount`) with state to resume from right when page arrives.
+        No page is requested after `deadline` (Deadline of request), then the last state still has more.
+    """
+    state = state if state is not None else PageState()
+    ids = list(state.ids)
+    seen = set(ids)
+    cursor, has_more = state.cursor, state.has_more
+
+    while has_more and len(ids) < amount and (deadline is None or not deadline.expired()):
+        page, next_cursor, has_more = fetch_page(cursor, min(page_size, amount - len(ids)))
+        new = [item for item in page if key(item) not in seen]
+        for item in new:
+            seen.add(key(item))
+            ids.append(key(item))
+        if len(new) == 0 or next_cursor is None or next_cursor == cursor:
+            # feed doesn't move on, the next request would return the same
+            has_more = False
+        else:
+            cursor = next_cursor
+        yield new, PageState(tuple(ids), cursor, has_more)
+
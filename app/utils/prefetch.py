@@ -0,0 +1,119 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Iterator, Tuple
+
+from app.utils.pagination import PageState, iter_pages
+from app.utils.utils import singleton
+from config.application import PREFETCH_MAX_WORKERS, PREFETCH_BUDGET
+
+
+@singleton
+class PrefetchExecutor:
+    """! Executor converting fetched feed items while next pages are fetched.
+
+        Separate from flask and batch executors, because their tasks wait for conversions.
+        Pages are fetched on their own executor, so a fetch never waits behind conversions of other requests.
+    """
+
+    def __init__(self, max_workers: int = PREFETCH_MAX_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.fetch_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch-fetch")
+
+
+class BudgetedRunner:
+    """! Runs `fn(item)` on executor with at most `budget` items running at once, the rest wait in queue.
+        Queued items don't block the caller and don't occupy threads of the executor.
+    """
+
+    def __init__(self, executor, fn: Callable, budget: int):
+        self._executor = executor
+        self._fn = fn
+        self._budget = max(1, budget)
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._running = 0
+
+    def submit(self, item) -> Future:
+        future = Future()
+        with self._lock:
+            self._queue.append((item, future))
+            self._start_next()
+        return future
+
+    def _start_next(self):
+        while self._running < self._budget and len(self._queue) != 0:
+            item, future = self._queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self._running += 1
+            self._executor.submit(self._run, item, future)
+
+    def _run(self, item, future: Future):
+        try:
+            future.set_result(self._fn(item))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._start_next()
+
+
+def prefetch_pages(fetch_raw_page: Callable, convert: Callable, amount: int, state: PageState = None,
+                   budget: int = PREFETCH_BUDGET, deadline=None) -> Iterator[Tuple[list, PageState]]:
+    """! Pipeline version of `iter_pages`: raw items of page are converted with `convert(item)` on
+        PrefetchExecutor, while the next page is requested with the cursor of this one right away.
+
+        At most `budget` conversions of the request run at the same time, so a deep fetch can't take
+        the whole pool. Yields (converted items, state) per page in feed order as soon as page is converted,
+        paging stops at `deadline`. Pages are fetched on another thread without request context.
+        When fetch fails, pages fetched before it are yielded and then the error is raised.
+    """
+    runner = BudgetedRunner(PrefetchExecutor().executor, convert, budget)
+    pages = iter_pages(fetch_raw_page, amount, state, deadline=deadline)
+    pending = deque()
+    # at most one page is fetched ahead, it's requested again only when the generator is resumed
+    fetching = PrefetchExecutor().fetch_executor.submit(next, pages, None)
+
+    def collect(futures: list) -> list:
+        return [future.result() for future in futures]
+
+    def head_converted() -> bool:
+        return len(pending) != 0 and all(future.done() for future in pending[0][0])
+
+    try:
+        while fetching is not None or len(pending) != 0:
+            if head_converted():
+                futures, done_state = pending.popleft()
+                yield collect(futures), done_state
+                continue
+            waiting = set(pending[0][0]) if len(pending) != 0 else set()
+            if fetching is not None:
+                waiting.add(fetching)
+            wait(waiting, return_when=FIRST_COMPLETED)
+            if fetching is None or not fetching.done():
+                continue
+
+            try:
+                page = fetching.result()
+            except Exception:
+                # pages fetched before the failure are still sent
+                fetching = None
+                while len(pending) != 0:
+                    futures, done_state = pending.popleft()
+                    yield collect(futures), done_state
+                raise
+            if page is None:
+                fetching = None
+                continue
+            items, page_state = page
+            pending.append(([runner.submit(item) for item in items], page_state))
+            fetching = PrefetchExecutor().fetch_executor.submit(next, pages, None)
+    finally:
+        # request failed or client went away, conversions that aren't started yet are dropped
+        if fetching is not None:
+            fetching.cancel()
+        for futures, _ in pending:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,38 @@
+import fcntl
+import logging
+import os
+
+
+class ProcessLock:
+    """! Non-blocking exclusive lock on a file shared by all worker processes of the host.
+
+        Used to elect one process for a job (f.e. device registration). The lock is held until
+        `release` is called or the process dies, so another worker takes the job over after a crash.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        if self._file is not None:
+            return True
+        lock_file = open(self.path, "a+")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._file = lock_file
+        logging.warning("process {} acquired lock {}".format(os.getpid(), self.path))
+        return True
+
+    def is_acquired(self) -> bool:
+        return self._file is not None
+
+    def release(self):
+        if self._file is None:
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
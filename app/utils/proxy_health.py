@@ -0,0 +1,175 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from config.application import PROXY_CANDIDATES, PROXY_MAX_SKIPS, PROXY_BREAKER_FAILURES, PROXY_BACKOFF_MIN_SEC, \
+    PROXY_BACKOFF_MAX_SEC, PROXY_HEALTH_EWMA_ALPHA, PROXY_TRACKED_MAX
+
+
+class ProxyHealth:
+    """! Outcomes of requests made through one proxy and its circuit breaker.
+
+        Breaker opens after PROXY_BREAKER_FAILURES failures in a row. When it closes, proxy gets one trial:
+        failure opens breaker again with doubled backoff, success resets it.
+    """
+
+    def __init__(self):
+        self.success_rate = 1.0
+        self.latency_ms = None
+        self.requests = 0
+        self.consecutive_failures = 0
+        self.openings = 0
+        self.open_until = 0.0
+        self.failures = Counter()
+
+    def record(self, latency_ms: float, failure: str = None):
+        self.requests += 1
+        if failure is None:
+            self.consecutive_failures = 0
+            self.openings = 0
+            self.success_rate = (1 - PROXY_HEALTH_EWMA_ALPHA) * self.success_rate + PROXY_HEALTH_EWMA_ALPHA
+            if self.latency_ms is None:
+                self.latency_ms = latency_ms
+            else:
+                self.latency_ms = (1 - PROXY_HEALTH_EWMA_ALPHA) * self.latency_ms + PROXY_HEALTH_EWMA_ALPHA * latency_ms
+            return
+
+        self.failures[failure] += 1
+        self.consecutive_failures += 1
+        self.success_rate = (1 - PROXY_HEALTH_EWMA_ALPHA) * self.success_rate
+        now = time.time()
+        # requests started before breaker opened don't open it again
+        if not self.is_open(now) and (self.openings > 0 or self.consecutive_failures >= PROXY_BREAKER_FAILURES):
+            self.openings += 1
+            self.open_until = now + min(PROXY_BACKOFF_MIN_SEC * 2 ** (self.openings - 1), PROXY_BACKOFF_MAX_SEC)
+
+    def is_open(self, now: float) -> bool:
+        return now < self.open_until
+
+    def score(self) -> float:
+        """! Expected cost of request through proxy, lower is better. Unknown proxies go first to be measured. """
+        return (self.latency_ms or 0) / max(self.success_rate, 0.05)
+
+
+class ProxyTracker:
+    """! Proxy provider wrapper choosing healthy and fast proxies.
+
+        `next()` takes up to PROXY_CANDIDATES proxies with closed breaker from provider and returns the one
+        with the best score, proxies with open breaker are skipped. Callers report outcome of every request
+        with `record`. Can be used everywhere instead of provider, f.e. as `proxy_switcher` of senders.
+    """
+
+    def __init__(self, provider, candidates: int = PROXY_CANDIDATES):
+        self.provider = provider
+        self.candidates = candidates
+        self._lock = threading.Lock()
+        self._health = OrderedDict()
+        self.skipped = 0
+        self.exhausted = 0
+
+    @staticmethod
+    def key(proxy) -> str:
+        return str(proxy)
+
+    def _get_health(self, proxy) -> ProxyHealth:
+        key = self.key(proxy)
+        health = self._health.get(key)
+        if health is None:
+            health = ProxyHealth()
+            self._health[key] = health
+            while len(self._health) > PROXY_TRACKED_MAX:
+                self._health.popitem(last=False)
+        self._health.move_to_end(key)
+        return health
+
+    def next(self):
+        """! Best of candidate proxies. When breakers of all pulled proxies are open, the one closing first. """
+        best, best_score = None, None
+        fallback, fallback_until = None, None
+        found = 0
+        for _ in range(max(PROXY_MAX_SKIPS, self.candidates)):
+            proxy = self.provider.next()
+            now = time.time()
+            with self._lock:
+                health = self._get_health(proxy)
+                if health.is_open(now):
+                    self.skipped += 1
+                    if fallback is None or health.open_until < fallback_until:
+                        fallback, fallback_until = proxy, health.open_until
+                    continue
+                score = health.score()
+            if best is None or score < best_score:
+                best, best_score = proxy, score
+            found += 1
+            if found >= self.candidates:
+                break
+        if best is None:
+            with self._lock:
+                self.exhausted += 1
+            best = fallback
+        return best
+
+    def record(self, proxy, latency_ms: float, failure: str = None):
+        """! Record outcome of request through proxy, `failure` is kind of proxy failure or None for success. """
+        if proxy is None:
+            return
+        with self._lock:
+            self._get_health(proxy).record(latency_ms, failure)
+
+    def is_open(self, proxy) -> bool:
+        with self._lock:
+            health = self._health.get(self.key(proxy))
+            return health is not None and health.is_open(time.time())
+
+    def stats(self) -> dict:
+        now = time.time()
+        with self._lock:
+            failures = Counter()
+            for health in self._health.values():
+                failures.update(health.failures)
+            return {"tracked": len(self._health),
+                    "open": sum(1 for health in self._health.values() if health.is_open(now)),
+                    "skipped": self.skipped,
+                    "exhausted": self.exhausted,
+                    "failures": dict(failures)}
+
+
+class ProxyAttempt:
+    """! Request attempt made by sender, `proxy` is the one its requests went through last. """
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+
+
+class SenderProxies:
+    """! `proxy_switcher` of one sender taking proxies from ProxyTracker.
+
+        Knows the proxy sender uses now. Attempts in progress move to the proxy sender switches to,
+        so outcome of attempt is recorded for the proxy which served it, not the one sender has later.
+    """
+
+    def __init__(self, tracker: ProxyTracker):
+        self.tracker = tracker
+        self.proxy = None
+        self._lock = threading.Lock()
+        self._attempts = set()
+
+    def next(self):
+        proxy = self.tracker.next()
+        with self._lock:
+            self.proxy = proxy
+            for attempt in self._attempts:
+                attempt.proxy = proxy
+        return proxy
+
+    def start_attempt(self) -> ProxyAttempt:
+        with self._lock:
+            attempt = ProxyAttempt(self.proxy)
+            self._attempts.add(attempt)
+        return attempt
+
+    def finish_attempt(self, attempt: ProxyAttempt):
+        """! Stop following switches of sender, returns proxy attempt was made through. """
+        with self._lock:
+            self._attempts.discard(attempt)
+        return attempt.proxy
@@ -0,0 +1,43 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Hashable
+
+from app.utils.utils import singleton, format_except
+from config.application import REVALIDATE_MAX_WORKERS
+
+
+@singleton
+class Revalidator:
+    """! Refreshes stale cached items in background. The same item is refreshed only once at a time. """
+
+    def __init__(self, max_workers: int = REVALIDATE_MAX_WORKERS):
+        self._lock = threading.Lock()
+        self._in_progress = set()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="revalidate")
+        self.submitted = 0
+        self.failed = 0
+
+    def submit(self, key: Hashable, fn: Callable) -> bool:
+        """! Queue refresh of item. Returns False if it's already queued. """
+        with self._lock:
+            if key in self._in_progress:
+                return False
+            self._in_progress.add(key)
+            self.submitted += 1
+        self._executor.submit(self._run, key, fn)
+        return True
+
+    def _run(self, key: Hashable, fn: Callable):
+        try:
+            fn()
+        except Exception as e:
+            self.failed += 1
+            logging.warning("failed refreshing {}. error [{}]".format(key, format_except(e)))
+        finally:
+            with self._lock:
+                self._in_progress.discard(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"in_progress": len(self._in_progress), "submitted": self.submitted, "failed": self.failed}
@@ -0,0 +1,77 @@
+import logging
+import time
+from concurrent.futures import TimeoutError
+
+from app.db.database import Database
+from app.db.write_behind import WriteBehindQueue
+from app.utils.deadline import Deadline
+from app.utils.device_pool import DevicePoll, failure_kind
+from app.utils.fields import FieldMask
+from app.utils.prefetch import PrefetchExecutor, BudgetedRunner
+from app.utils.user_search import generate_short_link
+from app.utils.utils import format_except
+from config.application import SHORT_LINK_MODE, SHORT_LINK_BUDGET
+
+
+def short_link_requested(fields: FieldMask) -> bool:
+    """! Whether short links have to be resolved for posts with `fields` mask.
+        Without mask all fields are returned, in lazy mode that's not enough: short_link has to be in the mask.
+    """
+    if SHORT_LINK_MODE == "off":
+        return False
+    if fields.is_all():
+        return SHORT_LINK_MODE == "eager"
+    return fields.wants("short_link")
+
+
+def shorten_share_link(share_link: str) -> str:
+    """! Get short link by share link on device of the pool. """
+    device, attempt = DevicePoll().acquire_device(proxy_on=True)
+    started_at = time.monotonic()
+    try:
+        short_link = generate_short_link(device, share_link)
+    except Exception as e:
+        DevicePoll().release_device(device, attempt, (time.monotonic() - started_at) * 1000, failure_kind(e))
+        raise
+    DevicePoll().release_device(device, attempt, (time.monotonic() - started_at) * 1000)
+    return short_link
+
+
+def fill_short_links(posts: list, fields: FieldMask = FieldMask(), deadline: Deadline = None) -> list:
+    """! Set `short_link` of posts which don't have it yet.
+
+        Short links are looked up in cache by aweme_id at once, share link differs from device to device
+        but short link of post is always the same. Missing ones are resolved in parallel on devices of
+        the pool, at most SHORT_LINK_BUDGET at the same time, and cached. Post keeps `short_link` None
+        when it can't be resolved or there is no time left before `deadline`, the rest of the response
+        doesn't depend on it.
+    """
+    if not short_link_requested(fields):
+        return posts
+    missing = dict()
+    for post in posts:
+        if post is not None and post.short_link is None and post.share_link:
+            missing.setdefault(post.aweme_id, []).append(post)
+    if len(missing) == 0:
+        return posts
+
+    cached = Database().fetch_cached_short_links(list(missing.keys()))
+    runner = BudgetedRunner(PrefetchExecutor().executor, shorten_share_link, SHORT_LINK_BUDGET)
+    futures = {aweme_id: runner.submit(same_posts[0].share_link)
+               for aweme_id, same_posts in missing.items() if aweme_id not in cached}
+
+    resolved = dict()
+    for aweme_id, future in futures.items():
+        try:
+            resolved[aweme_id] = future.result(deadline.timeout() if deadline is not None else None)
+        except TimeoutError:
+            # out of time, links which aren't resolved yet are left empty
+            future.cancel()
+        except Exception as e:
+            logging.warning("failed generating short link of {}. error [{}]".format(aweme_id, format_except(e)))
+    WriteBehindQueue().cache_short_links(resolved)
+
+    for aweme_id, same_posts in missing.items():
+        for post in same_posts:
+            post.short_link = cached.get(aweme_id) or resolved.get(aweme_id)
+    return posts
@@ -0,0 +1,48 @@
+import threading
+from concurrent.futures import Future, TimeoutError
+from typing import Callable, Hashable
+
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.utils import singleton
+
+
+@singleton
+class SingleFlight:
+    """! Coalesces concurrent identical operations of the worker.
+
+        First caller with some key runs the operation, callers with the same key that come
+        while it is in flight wait for it and get the same result or exception, or until their `deadline`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()
+
+    def do(self, key: Hashable, fn: Callable, deadline: Deadline = None):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not is_leader:
+            try:
+                return future.result(deadline.remaining() if deadline is not None else None)
+            except TimeoutError:
+                raise DeadlineExceeded("waiting for {}".format(key[0] if isinstance(key, tuple) else key))
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
@@ -3,6 +3,7 @@ import collections
 import logging
 import socket
 import ssl
+import time
 
 import httpcore
 import socks
@@ -16,7 +17,10 @@ import httpx
 
 import tiktok_mobile.utils.sender as sender_module
 
+from app.utils.event_loop import WorkerLoop
+from app.utils.http_pool import AsyncClientPool
 from app.utils.utils import format_except
+from config.application import RESOLVE_MAX_ATTEMPTS, RESOLVE_DEADLINE_SEC
 
 sender_module.SENDER_DEFAULT_TIMEOUT = 10
 sender_module.SENDER_DEFAULT_PROXY_SWITCH_COUNT = 10
@@ -44,6 +48,8 @@ class UserInfo:
     avatar: str = None
     sid: str = None
     secret: int = 0
+    # None for user fetched from tiktok, False/True for fresh/expired user from cache
+    stale: bool = None
 
 
 @dataclass
@@ -156,92 +162,33 @@ def get_user_posts_build_request(phone: TikTokPhone, sec_user_id: str, cursor=0,
                                                 count=count)
 
 
-def get_user_posts(phone: TikTokPhone, sec_user_id: str, cursor, count,
-                   full) -> list:
-    """! Get users posts by sec_user_id. """
+def get_user_posts_raw(phone: TikTokPhone, sec_user_id: str, cursor, count) -> tuple:
+    """! Get page of users posts by sec_user_id without converting them.
+        Returns (awemes sorted by create_time, next_cursor, has_more).
+    """
     result = UserApi.user_post_list(phone,
                                     sec_user_id,
                                     max_cursor=cursor,
                                     count=count)
     if result is None or result.aweme_list is None:
-        return list()
+        return list(), None, False
 
     result.aweme_list.sort(key=lambda x: x.create_time, reverse=True)
-    if len(result.aweme_list) > count:
-        result.aweme_list = result.aweme_list[:10]
-
-    return [aweme_detail_to_post(aweme, phone) for aweme in result.aweme_list]
-
-
-def get_user_liked_posts(phone: TikTokPhone, sec_user_id: str, cursor: int,
-                         count: int, full: bool) -> list:
-    """! Get liked posts by sec_user_id.
-        @param phone            TiktokPhone
-        @param sec_user_id      secUserId of user
-        @param cursor           index from where get posts
-        @param count            number of posts 
-        @param full             return full description of posts or not
-        
-        @note that works only if user change privacy settings
-    """
-    posts = list()
+    return result.aweme_list, getattr(result, "max_cursor", None), bool(getattr(result, "has_more", False))
+
 
+def get_user_liked_posts_raw(phone: TikTokPhone, sec_user_id: str, cursor: int, count: int) -> tuple:
+    """! Get page of liked posts by sec_user_id without converting them.
+        Returns (awemes, next_cursor, has_more).
+    """
     result = UserApi.aweme_favorite(phone,
                                     sec_user_id,
                                     max_cursor=cursor,
                                     count=count)
     if result is None or result.aweme_list is None:
-        return posts
-
-    for aweme in result.aweme_list:
-        post = aweme_detail_to_post(aweme, phone)
-        posts.append(post)
-
-    return posts
+        return list(), None, False
 
-
-def get_liked_posts(phone: TikTokPhone,
-                    sec_user_id: str,
-                    number: int = 20,
-                    full: bool = False) -> list:
-    """! Get liked posts by sec_user_id. """
-    cursor = number // 20
-    last = number % 20
-
-    posts = list()
-
-    for cursor_i in range(0, cursor):
-        post = get_user_liked_posts(phone, sec_user_id, cursor_i * 20, 20,
-                                    full)
-        posts += post
-
-    if last:
-        post = get_user_liked_posts(phone, sec_user_id, cursor * 20, last,
-                                    full)
-        posts += post
-
-    return posts
-
-
-def get_posts(phone: TikTokPhone,
-              sec_user_id: str,
-              number: int = 20,
-              full: bool = False) -> list:
-    """! Get users posts by sec_user_id. """
-    cursor = number // 20
-    last = number % 20
-
-    posts = list()
-
-    for cursor_i in range(0, cursor):
-        post = get_user_posts(phone, sec_user_id, cursor_i * 20, 20, full)
-        posts += post
-
-    if last:
-        post = get_user_posts(phone, sec_user_id, cursor * 20, last, full)
-        posts += post
-
-    return posts
+    return result.aweme_list, getattr(result, "max_cursor", None), bool(getattr(result, "has_more", False))
 
 
 def get_post_by_aweme_id(phone: TikTokPhone, aweme_id: str) -> PostInfo:
@@ -252,38 +199,49 @@ def get_post_by_aweme_id(phone: TikTokPhone, aweme_id: str) -> PostInfo:
     return post
 
 
-def aweme_detail_to_post(aweme, phone) -> PostInfo:
+def aweme_detail_to_post(aweme, phone, fields=None) -> PostInfo:
+    """! Convert aweme to post locally. `short_link` needs request to tiktok, it's filled by app.utils.short_links.
+        With `fields` (FieldMask of post) only requested fields are filled, aweme_id, author and
+        create_time are always there. Posts going to cache must be converted without mask.
+    """
+    wants = fields.wants if fields is not None else lambda field: True
     post = PostInfo()
     post.aweme_id = aweme.aweme_id
-    if len(aweme.video.cover.url_list):
+    if wants("cover") and len(aweme.video.cover.url_list):
         post.cover = str(aweme.video.cover.url_list[-1])
     post.animated_cover = None
-    if aweme.video.animated_cover is not None and len(aweme.video.animated_cover.url_list):
+    if wants("animated_cover") and aweme.video.animated_cover is not None \
+            and len(aweme.video.animated_cover.url_list):
         post.animated_cover = str(aweme.video.animated_cover.url_list[-1])
 
-    post.download_links = list(aweme.video.download_addr.url_list)
-    post.play_links = list(aweme.video.play_addr.url_list)
-
-    post.share_link = aweme.share_info.share_url
-    post.web_link = generate_web_url(aweme.author.unique_id,
-                                     aweme.aweme_id).url
-    post.short_link = generate_short_url(phone, post.share_link).url
-    post.comment_count = aweme.statistics.comment_count
-    post.digg_count = aweme.statistics.digg_count
-    post.download_count = aweme.statistics.download_count
-    post.forward_count = aweme.statistics.forward_count
-    post.lose_comment_count = aweme.statistics.lose_comment_count
-    post.lose_count = aweme.statistics.lose_count
-    post.play_count = aweme.statistics.play_count
-    post.share_count = aweme.statistics.share_count
-    post.whatsapp_share_count = aweme.statistics.whatsapp_share_count
-    post.description = aweme.desc
+    if wants("download_links"):
+        post.download_links = list(aweme.video.download_addr.url_list)
+    if wants("play_links"):
+        post.play_links = list(aweme.video.play_addr.url_list)
+
+    # short link is resolved by share link
+    if wants("share_link") or wants("short_link"):
+        post.share_link = aweme.share_info.share_url
+    if wants("web_link"):
+        post.web_link = generate_web_url(aweme.author.unique_id,
+                                         aweme.aweme_id).url
+    for name in ("comment_count", "digg_count", "download_count", "forward_count", "lose_comment_count",
+                 "lose_count", "play_count", "share_count", "whatsapp_share_count"):
+        if wants(name):
+            setattr(post, name, getattr(aweme.statistics, name))
+    if wants("description"):
+        post.description = aweme.desc
     post.author_sec_user_id = aweme.author.sec_uid
     post.create_time = aweme.create_time
 
     return post
 
 
+def generate_short_link(phone: TikTokPhone, share_link: str) -> str:
+    """! Get short link (vm.tiktok.com) of post by its share link. """
+    return generate_short_url(phone, share_link).url
+
+
 def get_post(phone: TikTokPhone, link: str, web_link: str, short_link: str,
              aweme_id: str):
     """! Get post by link. """
@@ -356,130 +314,148 @@ def get_post_build_request(phone: TikTokPhone, link: str, web_link: str, short_l
     raise SearchException("Failed to find post")
 
 
-def get_user_liked_posts(phone: TikTokPhone, sec_user_id: str, cursor: int,
-                         count: int, full: bool) -> list:
-    """! Get liked posts by sec_user_id.
-        @param phone            TiktokPhone
-        @param sec_user_id      secUserId of user
-        @param cursor           index from where get posts
-        @param count            number of posts
-        @param full             return full description of posts or not
-
-        @note that works only if user change privacy settings
+# network errors after which username resolving is retried with another proxy
+RESOLVE_RETRY_EXCEPTIONS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.ProxyError,
+    socks.ProxyError,
+    httpx.ProxyError,
+    httpx.ConnectError,
+    httpx.RemoteProtocolError,
+    httpx.ReadError,
+    httpx.ProtocolError,
+    httpx.ConnectTimeout,
+    httpcore.RemoteProtocolError,
+    httpcore.ReadTimeout,
+    httpcore.ConnectTimeout,
+    socksio.exceptions.ProtocolError,
+    socket.timeout,
+    ConnectionResetError,
+    httpx.ReadTimeout,
+    ssl.SSLError,
+    asyncio.exceptions.TimeoutError
+)
+
+
+def proxy_failure_kind(ex: Exception):
+    """! Kind of failure caused by proxy (timeout, socks, ssl, captcha, unknown_page, connection)
+        or None if it isn't.
     """
-    posts = list()
-
-    result = UserApi.aweme_favorite(phone,
-                                    sec_user_id,
-                                    max_cursor=cursor,
-                                    count=count)
-
-    if result is None or result.aweme_list is None:
-        return posts
-
-    for aweme in result.aweme_list:
-        post = aweme_detail_to_post(aweme, phone)
-        posts.append(post)
-
-    return posts
-
-
-def get_liked_posts(phone: TikTokPhone,
-                    sec_user_id: str,
-                    number: int = 20,
-                    full: bool = False) -> list:
-    """! Get liked posts by sec_user_id. """
-    cursor = number // 20
-    last = number % 20
-
-    posts = list()
-
-    for cursor_i in range(0, cursor):
-        post = get_user_liked_posts(phone, sec_user_id, cursor_i * 20, 20,
-                                    full)
-        posts += post
-
-    if last:
-        post = get_user_liked_posts(phone, sec_user_id, cursor * 20, last,
-                                    full)
-        posts += post
-
-    return posts
-
+    if isinstance(ex, CaptchaException):
+        return "captcha"
+    if isinstance(ex, UnknownPageException):
+        return "unknown_page"
+    if isinstance(ex, ssl.SSLError):
+        return "ssl"
+    if isinstance(ex, (socks.ProxyError, socksio.exceptions.ProtocolError, httpx.ProxyError,
+                       requests.exceptions.ProxyError)):
+        return "socks"
+    if isinstance(ex, (httpx.TimeoutException, httpcore.TimeoutException, socket.timeout,
+                       asyncio.exceptions.TimeoutError, requests.exceptions.Timeout)):
+        return "timeout"
+    if isinstance(ex, RESOLVE_RETRY_EXCEPTIONS):
+        return "connection"
+    return None
+
+
+async def fetch_sec_uid(username: str, proxy: Proxy = None) -> str:
+    """! Single attempt to resolve sec_uid of user by tiktok web page using warm client of the proxy. """
+    quoted_username = quote(username)
+
+    timeout = httpx.Timeout(5.0, connect=5.0, read=5.0, write=5.0, pool=5.0)
+    client = await AsyncClientPool().get(proxy)
+    try:
+        response = await asyncio.wait_for(
+            client.get("https://www.tiktok.com/@{}?lang=en".format(quoted_username), headers={
+                "User-Agent": "Mozilla/5.0 (Linux; Android 9; Mi A1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.115 Mobile Safari/537.36",
+                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
+                "path": "/@{}".format(quoted_username),
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive"
+            }, timeout=timeout),
+            10.0)
+    except RESOLVE_RETRY_EXCEPTIONS:
+        # connections of this client may be broken, next attempt on the proxy starts from scratch
+        await AsyncClientPool().discard(proxy)
+        raise
+    return parse_sec_uid_response(response, username)
+
+
+def parse_sec_uid_response(response, username: str) -> str:
+    if response.status_code == 404:
+        raise NotFoundException(
+            "TikTok user with username {} does not exist".format(username)
+        )
+    data, method = extract_tag_contents(response.text)
+    user = json.loads(data)
+    user_props = dict()
+    if user.get("props") is not None and user.get("props").get("pageProps") is not None:
+        user_props = user["props"]["pageProps"]
+        if user_props.get("serverCode") == 404:
+            raise NotFoundException(
+                "TikTok user with username {} does not exist".format(username)
+            )
 
-def get_sec_uid_by_username(device: TikTokPhone, username: str, proxy: Proxy = None, proxy_service=None):
-    while True:
+    sec_uid = None
+    if method == 'SIGI_STATE':
+        sec_uid = (user.get("MobileUserPage") or dict()).get("secUid")
+    elif method == 'NEXT_DATA':
+        sec_uid = ((user_props.get("userInfo") or dict()).get("user") or dict()).get("secUid")
+    if not sec_uid:
+        # tiktok serves pages without user to some addresses, the next proxy may get the real one
+        raise UnknownPageException("TikTok page of {} has no secUid, method {}".format(username, method))
+    logging.warning("resolved {} using method {}".format(sec_uid, method))
+    return sec_uid
+
+
+async def get_sec_uid_by_username_async(username: str, proxy: Proxy = None, proxy_service=None, deadline=None):
+    """! Resolve sec_uid by username retrying proxy failures (network errors, captcha) with next proxy
+        of `proxy_service` (ProxyTracker), which gets outcome of every attempt. There are at most
+        RESOLVE_MAX_ATTEMPTS attempts and all of them have to fit in RESOLVE_DEADLINE_SEC
+        and in `deadline` (Deadline of request) if it's passed.
+    """
+    # deadline module depends on this one
+    from app.utils.deadline import DeadlineExceeded
+
+    expires_at = time.monotonic() + RESOLVE_DEADLINE_SEC
+    if deadline is not None:
+        expires_at = min(expires_at, deadline.expires_at)
+    last_error = None
+    for _ in range(RESOLVE_MAX_ATTEMPTS):
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            break
+        if proxy_service is not None:
+            proxy = proxy_service.next()
+        started_at = time.monotonic()
         try:
-            if proxy_service is not None:
-                proxy = proxy_service.next()
-            # proxies = wrap_requests_proxy(proxy) if proxy else device.session.proxies
-            quoted_username = quote(username)
-
-            timeout = httpx.Timeout(5.0, connect=5.0, read=5.0, write=5.0, pool=5.0)
-
-            async def make_request():
-                async with httpx.AsyncClient(verify=False, http2=True, proxies=proxy, timeout=timeout, http1=False,
-                                           trust_env=True) as client:
-                    return await client.get("https://www.tiktok.com/@{}?lang=en".format(quoted_username), headers={
-                        "User-Agent": "Mozilla/5.0 (Linux; Android 9; Mi A1) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/92.0.4515.115 Mobile Safari/537.36",
-                        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,image/apng,*/*;q=0.8,application/signed-exchange;v=b3;q=0.9",
-                        "path": "/@{}".format(quoted_username),
-                        "Accept-Encoding": "gzip, deflate",
-                        "Connection": "keep-alive"
-                    }, timeout=timeout)
-
-            response = asyncio.run(
-                asyncio.wait_for(
-                    make_request(), 10.0)
-            )
-            if response.status_code == 404:
-                raise NotFoundException(
-                    "TikTok user with username {} does not exist".format(username)
-                )
-            else:
-                data, method = extract_tag_contents(response.text)
-                user = json.loads(data)
-                if user.get("props") is not None and user.get("props").get("pageProps") is not None:
-                    user_props = user["props"]["pageProps"]
-                    if user_props["serverCode"] == 404:
-                        raise NotFoundException(
-                            "TikTok user with username {} does not exist".format(username)
-                        )
-
-                if method == 'SIGI_STATE':
-                    logging.warning("resolved {} using method {}".format(user["MobileUserPage"]["secUid"], method))
-                    return user["MobileUserPage"]["secUid"]
-                elif method == 'NEXT_DATA':
-                    logging.warning(
-                        "resolved {} using method {}".format(user_props["userInfo"]["user"]["secUid"], method))
-                    return user_props["userInfo"]["user"]["secUid"]
-
-        except (
-                requests.exceptions.ConnectionError,
-                requests.exceptions.ProxyError,
-                socks.ProxyError,
-                httpx.ProxyError,
-                httpx.ConnectError,
-                httpx.RemoteProtocolError,
-                httpx.ReadError,
-                httpx.ProtocolError,
-                httpx.ConnectTimeout,
-                httpcore.RemoteProtocolError,
-                httpcore.ReadTimeout,
-                httpcore.ConnectTimeout,
-                socksio.exceptions.ProtocolError,
-                socks.ProxyError,
-                socket.timeout,
-                ConnectionResetError,
-                httpx.ReadTimeout,
-                ssl.SSLError,
-                asyncio.exceptions.TimeoutError
-        ) as e:
-            logging.warning(f"{type(e)} exception processing search. moving to new iteration")
-            continue
+            sec_uid = await asyncio.wait_for(fetch_sec_uid(username, proxy), remaining)
         except Exception as e:
-            logging.error(format_except(e))
-            raise SearchException(f"Failed to get sec_uid. Caused by: {str(e)}")
+            if isinstance(e, asyncio.TimeoutError) and time.monotonic() >= expires_at:
+                # attempt was cut short by the budget, that says nothing about proxy
+                last_error = e
+                break
+            failure = proxy_failure_kind(e)
+            if proxy_service is not None and failure is not None:
+                proxy_service.record(proxy, (time.monotonic() - started_at) * 1000, failure)
+            if failure is None:
+                logging.error(format_except(e))
+                raise SearchException(f"Failed to get sec_uid. Caused by: {str(e)}")
+            logging.warning(f"{failure} failure of proxy resolving {username}, trying another one")
+            last_error = e
+            continue
+        if proxy_service is not None:
+            proxy_service.record(proxy, (time.monotonic() - started_at) * 1000)
+        return sec_uid
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded("sec_uid_by_username")
+    raise SearchException(f"Failed to get sec_uid, proxies failed. Caused by: {str(last_error)}")
+
+
+def get_sec_uid_by_username(device: TikTokPhone, username: str, proxy: Proxy = None, proxy_service=None,
+                            deadline=None):
+    """! Blocking version of `get_sec_uid_by_username_async` running on the worker event loop. """
+    return WorkerLoop().run(get_sec_uid_by_username_async(username, proxy, proxy_service, deadline))
 
 
 class TikTokException(Exception):
@@ -497,6 +473,10 @@ class NotFoundException(TikTokException):
     """TikTok indicated that this object does not exist."""
 
 
+class UnknownPageException(TikTokException):
+    """TikTok returned page without user data"""
+
+
 def extract_tag_contents(html):
     next_json = re.search(
         r"id=\"__NEXT_DATA__\"\s+type=\"application\/json\"\s*[^>]+>\s*(?P<next_data>[^<]+)",
@@ -5,6 +5,123 @@ DEFAULT_EXC_PAUSE = int(os.getenv("DEFAULT_EXC_PAUSE", 3))
 PROXY_FILE = "app/proxy/socks5_proxies.txt"
 MAX_ATTEMPTS_DEVICE_CREATION = 10
 DEVICES_SOURCE = os.getenv("DEVICES_SOURCE", "CREATE_NEW")
+# Start serving as soon as the first device is ready, load other devices in background
+FAST_START = os.getenv("FAST_START", "0") == "1"
+# DEVICES_SOURCE=SHARED: one worker registers devices into devices table, all workers lease them from it
+SHARED_DEVICES_TOTAL = int(os.getenv("SHARED_DEVICES_TOTAL", DEVICES_IN_POOL))
+SHARED_DEVICES_LOCK_FILE = os.getenv("SHARED_DEVICES_LOCK_FILE", "devices.lock")
+SHARED_DEVICES_WAIT_SEC = int(os.getenv("SHARED_DEVICES_WAIT_SEC", 5 * 60))
+DEVICE_LEASE_SEC = int(os.getenv("DEVICE_LEASE_SEC", 2 * 60))
+# Device is quarantined and replaced after that many failures in a row or when its success rate drops below
+DEVICE_QUARANTINE_FAILURES = int(os.getenv("DEVICE_QUARANTINE_FAILURES", 5))
+DEVICE_MIN_SUCCESS_RATE = float(os.getenv("DEVICE_MIN_SUCCESS_RATE", 0.3))
+DEVICE_HEALTH_EWMA_ALPHA = float(os.getenv("DEVICE_HEALTH_EWMA_ALPHA", 0.2))
+# Request waits that long for a device when the pool is empty, then it's answered with 503
+DEVICE_WAIT_SEC = float(os.getenv("DEVICE_WAIT_SEC", 2))
+# Background device pool maintenance: registered spare devices, rolling replacement of old devices
+DEVICE_SPARES = int(os.getenv("DEVICE_SPARES", 2))
+DEVICE_MAX_AGE_MIN = int(os.getenv("DEVICE_MAX_AGE_MIN", 60))
+DEVICE_MAINTENANCE_INTERVAL_SEC = int(os.getenv("DEVICE_MAINTENANCE_INTERVAL_SEC", 10))
 USE_CACHING = os.getenv("USE_POSTS_CACHING", True)
 
+# Proxies are scored by latency and success rate, the best of PROXY_CANDIDATES proxies of provider is used.
+# After PROXY_BREAKER_FAILURES failures in a row proxy is skipped for PROXY_BACKOFF_MIN_SEC, doubled on every
+# next failure up to PROXY_BACKOFF_MAX_SEC, until it succeeds again
+PROXY_CANDIDATES = int(os.getenv("PROXY_CANDIDATES", 3))
+PROXY_MAX_SKIPS = int(os.getenv("PROXY_MAX_SKIPS", 20))
+PROXY_BREAKER_FAILURES = int(os.getenv("PROXY_BREAKER_FAILURES", 3))
+PROXY_BACKOFF_MIN_SEC = int(os.getenv("PROXY_BACKOFF_MIN_SEC", 30))
+PROXY_BACKOFF_MAX_SEC = int(os.getenv("PROXY_BACKOFF_MAX_SEC", 15 * 60))
+PROXY_HEALTH_EWMA_ALPHA = float(os.getenv("PROXY_HEALTH_EWMA_ALPHA", 0.2))
+PROXY_TRACKED_MAX = int(os.getenv("PROXY_TRACKED_MAX", 10000))
+# Username resolving is retried with other proxies at most RESOLVE_MAX_ATTEMPTS times within RESOLVE_DEADLINE_SEC
+RESOLVE_MAX_ATTEMPTS = int(os.getenv("RESOLVE_MAX_ATTEMPTS", 5))
+RESOLVE_DEADLINE_SEC = float(os.getenv("RESOLVE_DEADLINE_SEC", 20))
+
+# End-to-end time budget of API request. Client may ask for another one (up to the max) with the header, in seconds.
+# Every stage of search stops when it runs out: partial result or 504 is returned
+REQUEST_TIMEOUT_SEC = float(os.getenv("REQUEST_TIMEOUT_SEC", 30))
+REQUEST_TIMEOUT_MAX_SEC = float(os.getenv("REQUEST_TIMEOUT_MAX_SEC", 120))
+REQUEST_TIMEOUT_HEADER = os.getenv("REQUEST_TIMEOUT_HEADER", "X-Request-Timeout")
+
+# Run async upstream calls (username resolving) as coroutines on one event loop per worker
+ASYNC_MODE = os.getenv("ASYNC_MODE", "1") == "1"
+
+# Warm httpx.AsyncClient per proxy for tiktok web requests
+HTTP_POOL_MAX_CLIENTS = int(os.getenv("HTTP_POOL_MAX_CLIENTS", 100))
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("HTTP_POOL_MAX_CONNECTIONS", 10))
+HTTP_POOL_IDLE_TIMEOUT_SEC = int(os.getenv("HTTP_POOL_IDLE_TIMEOUT_SEC", 60))
+
+# SQLite cache database shared by all workers: WAL journal, pooled connections with statement cache.
+# SQLITE_POOL_SIZE connections are kept open, up to SQLITE_POOL_OVERFLOW more are opened under load
+DATABASE_PATH = os.getenv("DATABASE_PATH", "cached_data.db")
+SQLITE_WAL = os.getenv("SQLITE_WAL", "1") == "1"
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 10 * 1000))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 16))
+SQLITE_POOL_OVERFLOW = int(os.getenv("SQLITE_POOL_OVERFLOW", 48))
+SQLITE_CACHED_STATEMENTS = int(os.getenv("SQLITE_CACHED_STATEMENTS", 256))
+
+# Storage of cached users and posts: sqlite (file of the host), memory (of the worker)
+# or redis (any server speaking redis protocol, shared by all nodes)
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "sqlite")
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+CACHE_REDIS_PREFIX = os.getenv("CACHE_REDIS_PREFIX", "tiktok:")
+
+# In-process L1 cache in front of cache storage
+L1_CACHE_MAX_ENTRIES = int(os.getenv("L1_CACHE_MAX_ENTRIES", 10000))
+L1_ACCOUNTS_TTL_SEC = int(os.getenv("L1_ACCOUNTS_TTL_SEC", 60 * 60))
+L1_ACCOUNTS_FULL_TTL_SEC = int(os.getenv("L1_ACCOUNTS_FULL_TTL_SEC", 5 * 60))
+L1_POSTS_TTL_SEC = int(os.getenv("L1_POSTS_TTL_SEC", 5 * 60))
+
+# Expired cache rows are removed in batches by one worker
+CLEANER_INTERVAL_SEC = int(os.getenv("CLEANER_INTERVAL_SEC", 5 * 60))
+CLEANER_BATCH_SIZE = int(os.getenv("CLEANER_BATCH_SIZE", 500))
+CLEANER_LOCK_FILE = os.getenv("CLEANER_LOCK_FILE", "cleaner.lock")
+
+# Cache writes are queued and written in batches by background thread of the worker
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", 10000))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 500))
+WRITE_BEHIND_FLUSH_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_MS", 50))
+WRITE_BEHIND_PUT_TIMEOUT_SEC = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT_SEC", 1))
+
+# Cached post is fresh until its signed urls expire minus margin. With stale-while-revalidate
+# post is served after that until urls really expire, while it's refreshed in background
+POST_CACHE_SAFETY_MARGIN_SEC = int(os.getenv("POST_CACHE_SAFETY_MARGIN_SEC", 5 * 60))
+POSTS_STALE_WHILE_REVALIDATE = os.getenv("POSTS_STALE_WHILE_REVALIDATE", "0") == "1"
+# Cached user is served for USER_STALE_SEC more after it expires (marked `stale`), while it's refreshed in background
+USERS_STALE_WHILE_REVALIDATE = os.getenv("USERS_STALE_WHILE_REVALIDATE", "0") == "1"
+USER_STALE_SEC = int(os.getenv("USER_STALE_SEC", 60 * 60))
+REVALIDATE_MAX_WORKERS = int(os.getenv("REVALIDATE_MAX_WORKERS", 4))
+
+# Batch endpoints: max items per request and items fetched upstream in parallel
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 100))
+BATCH_MAX_PARALLEL = int(os.getenv("BATCH_MAX_PARALLEL", 4))
+BATCH_MAX_WORKERS = int(os.getenv("BATCH_MAX_WORKERS", 16))
+
+# Deep post listings: posts of fetched page are converted on other devices while the next page is fetched.
+# PREFETCH_BUDGET is max conversions of one request running at the same time
+PREFETCH_MAX_WORKERS = int(os.getenv("PREFETCH_MAX_WORKERS", 32))
+PREFETCH_BUDGET = int(os.getenv("PREFETCH_BUDGET", 4))
+
+# Resolved short links (vm.tiktok.com) -> aweme_id
+SHORT_LINK_CACHE_MAX_ENTRIES = int(os.getenv("SHORT_LINK_CACHE_MAX_ENTRIES", 100000))
+SHORT_LINK_CACHE_TTL_SEC = int(os.getenv("SHORT_LINK_CACHE_TTL_SEC", 24 * 60 * 60))
+
+# Short links of posts (aweme_id -> vm.tiktok.com link) are kept in cache storage and resolved in parallel on
+# devices of the pool before response. eager: always, lazy: only when X-Fields mask asks for short_link,
+# off: never resolved. SHORT_LINK_BUDGET is max resolutions of one request running at the same time
+SHORT_LINK_MODE = os.getenv("SHORT_LINK_MODE", "eager")
+SHORT_LINK_BUDGET = int(os.getenv("SHORT_LINK_BUDGET", 8))
+SHORT_LINK_LIFETIME_SEC = int(os.getenv("SHORT_LINK_LIFETIME_SEC", 30 * 24 * 60 * 60))
+
+# Hedged upstream requests (see app/utils/hedging.py)
+HEDGE_MAX_ATTEMPTS = int(os.getenv("HEDGE_MAX_ATTEMPTS", 4))
+HEDGE_MAX_IN_FLIGHT = int(os.getenv("HEDGE_MAX_IN_FLIGHT", 2))
+HEDGE_DELAY_PERCENTILE = int(os.getenv("HEDGE_DELAY_PERCENTILE", 95))
+HEDGE_DEFAULT_DELAY_MS = int(os.getenv("HEDGE_DEFAULT_DELAY_MS", 3000))
+HEDGE_MIN_DELAY_MS = int(os.getenv("HEDGE_MIN_DELAY_MS", 300))
+
 print(os.getcwd())
\ No newline at end of file
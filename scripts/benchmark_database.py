@@ -0,0 +1,113 @@
+"""! Concurrent read/write throughput of the cache database with default and tuned sqlite engine.
+
+    Every process imitates a gunicorn worker: `--threads` threads upsert posts and read latest posts
+    of random authors like Database.cache_post_info / fetch_latest_cached_posts do.
+
+    PYTHONPATH=. python scripts/benchmark_database.py --processes 4 --threads 16 --seconds 10
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app.db.engine import create_sqlite_engine
+
+AUTHORS = 1000
+
+UPSERT_POST = '''
+    INSERT INTO tiktok_posts (aweme_id, add_time, create_time, author_sec_user_id, cover_url, play_count)
+    VALUES (?,?,?,?,?,?)
+    ON CONFLICT(aweme_id) DO UPDATE SET
+        add_time = excluded.add_time,
+        cover_url = excluded.cover_url,
+        play_count = excluded.play_count'''
+
+SELECT_POSTS = '''
+    SELECT aweme_id, add_time, author_sec_user_id, cover_url, play_count
+    FROM tiktok_posts
+    WHERE author_sec_user_id = ? AND add_time > ?
+    ORDER by create_time desc
+    LIMIT ?'''
+
+
+def create_tables(path: str):
+    engine = create_sqlite_engine(path, tuned=False)
+    with engine.connect() as con:
+        con.execute('''CREATE TABLE IF NOT EXISTS tiktok_posts
+                       (aweme_id varchar(256) primary key, add_time int, create_time int,
+                        author_sec_user_id varchar(256), cover_url varchar(1024), play_count int)''')
+        con.execute('''CREATE INDEX IF NOT EXISTS tiktok_posts_author_create_time
+                       ON tiktok_posts (author_sec_user_id, create_time)''')
+    engine.dispose()
+
+
+def run_worker(path: str, tuned: bool, threads: int, seconds: float, write_ratio: float) -> dict:
+    engine = create_sqlite_engine(path, tuned=tuned)
+    counters = {"reads": 0, "writes": 0, "locked": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def work():
+        reads = writes = locked = 0
+        while time.monotonic() < deadline:
+            author = "author_{}".format(random.randrange(AUTHORS))
+            try:
+                if random.random() < write_ratio:
+                    with engine.connect() as con:
+                        con.execute(UPSERT_POST, ("{}_{}".format(author, random.randrange(30)), round(time.time()),
+                                                  random.randrange(10 ** 9), author,
+                                                  "https://example.com/cover?x-expires=0" * 4, random.randrange(10 ** 6)))
+                    writes += 1
+                else:
+                    with engine.connect() as con:
+                        con.execute(SELECT_POSTS, (author, round(time.time()) - 15 * 60, 30)).fetchall()
+                    reads += 1
+            except OperationalError:
+                locked += 1
+        with lock:
+            counters["reads"] += reads
+            counters["writes"] += writes
+            counters["locked"] += locked
+
+    pool = [threading.Thread(target=work) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    engine.dispose()
+    return counters
+
+
+def benchmark(tuned: bool, args) -> dict:
+    path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+    create_tables(path)
+    with multiprocessing.Pool(args.processes) as pool:
+        results = pool.starmap(run_worker, [(path, tuned, args.threads, args.seconds, args.write_ratio)] * args.processes)
+    total = {key: sum(result[key] for result in results) for key in ("reads", "writes", "locked")}
+    total["ops_per_sec"] = (total["reads"] + total["writes"]) / args.seconds
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--write-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    print("{} processes x {} threads, {:.0f}% writes, {}s per run".format(
+        args.processes, args.threads, args.write_ratio * 100, args.seconds))
+    for name, tuned in (("default", False), ("tuned", True)):
+        result = benchmark(tuned, args)
+        print("{:>8}: {:>9.0f} ops/s  reads {:>8}  writes {:>8}  locked errors {:>6}".format(
+            name, result["ops_per_sec"], result["reads"], result["writes"], result["locked"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""! Bytes per cached post of the old url columns and of the packed `urls` blob.
+
+    Old format is calculated from the unpacked urls: cover, animated cover and the first three download
+    and play links as separate text columns. Full link lists are reported too, they are what is stored now.
+    Tables with old format are migrated on start of the app, VACUUM returns freed pages to filesystem.
+
+    PYTHONPATH=. python scripts/report_post_storage.py cached_data.db
+"""
+import argparse
+import os
+import sqlite3
+
+from app.db.compact import unpack_urls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("database", nargs="?", default="cached_data.db")
+    parser.add_argument("--limit", type=int, default=10000, help="posts to sample")
+    args = parser.parse_args()
+
+    connection = sqlite3.connect(args.database)
+    rows = connection.execute("SELECT urls FROM tiktok_posts WHERE urls IS NOT NULL LIMIT ?", (args.limit,)).fetchall()
+    if len(rows) == 0:
+        print("no cached posts")
+        return
+
+    old_bytes = full_bytes = packed_bytes = 0
+    for (blob,) in rows:
+        cover, animated_cover, download_links, play_links = unpack_urls(blob)
+        old_columns = [cover, animated_cover] + download_links[:3] + play_links[:3]
+        old_bytes += sum(len(url.encode()) for url in old_columns if url is not None)
+        full_bytes += sum(len(url.encode()) for url in [cover, animated_cover] + download_links + play_links
+                          if url is not None)
+        packed_bytes += len(blob)
+
+    posts = len(rows)
+    total = connection.execute("SELECT count(*) FROM tiktok_posts").fetchone()[0]
+    print("sampled {} of {} posts, database file {:.1f} MB".format(
+        posts, total, os.path.getsize(args.database) / 1024 / 1024))
+    print("url columns (first 3 links): {:>7.0f} bytes per post".format(old_bytes / posts))
+    print("all links uncompressed:      {:>7.0f} bytes per post".format(full_bytes / posts))
+    print("packed urls blob:            {:>7.0f} bytes per post ({:.1f}x smaller than url columns)".format(
+        packed_bytes / posts, old_bytes / packed_bytes))
+
+
+if __name__ == "__main__":
+    main()
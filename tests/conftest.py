@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+# tests don't register devices and don't touch cache database of the host, config is read on import
+os.environ.setdefault("DEVICES_SOURCE", "DATABASE")
+os.environ.setdefault("DATABASE_PATH", os.path.join(tempfile.mkdtemp(), "cached_data.db"))
+os.environ.setdefault("CACHE_BACKEND", "memory")
+os.environ.setdefault("WRITE_BEHIND", "0")
+
+import pytest
+
+from app.db.database import Database
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    Database().create_tables()
+    return Database()
+
+
+@pytest.fixture(scope="session")
+def app():
+    """! Application with api namespace and flask executor as in `create_app`, without device pool. """
+    from flask import Flask
+    from flask_executor import Executor
+    from flask_restplus import Api
+
+    from app.api.base import ns, RestExecutorWrapper
+    from app.utils.fields import fields_parameter_to_header
+
+    app = Flask(__name__)
+    app.config['EXECUTOR_TYPE'] = 'thread'
+    app.config['EXECUTOR_MAX_WORKERS'] = 8
+    executor = Executor(app)
+    app.before_request(fields_parameter_to_header)
+    api = Api(app)
+    api.add_namespace(ns)
+    RestExecutorWrapper(executor).executor = executor
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
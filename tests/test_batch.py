@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from app.api import base
+from app.api.types_.search import ApiSearchResponse
+from app.utils.factory_search import SearchBySidCreator
+from app.utils.user_search import UserInfo
+
+
+def ndjson(response) -> list:
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+@pytest.fixture
+def upstream_search(monkeypatch):
+    """! Nothing is cached, users are found upstream. Returns sids searched upstream. """
+    searched = list()
+
+    def search(self, payload, **params):
+        searched.append(payload["sid"])
+        return ApiSearchResponse(UserInfo(login_name="user_" + payload["sid"], sid=payload["sid"]), None)
+
+    monkeypatch.setattr(base, "fetch_cached_search_by_sid", lambda *args: None)
+    monkeypatch.setattr(SearchBySidCreator, "search", search)
+    return searched
+
+
+def test_search_by_sid_batch_searches_uncached_sid_upstream(client, upstream_search):
+    response = client.post("/api/search_by_sid_batch", json={"sids": ["sid1"], "amount_of_posts": 0})
+
+    assert response.status_code == 200
+    lines = ndjson(response)
+    assert lines == [{"input": "sid1", "result": {"user": {"login_name": "user_sid1", "sid": "sid1", "secret": 0}}}]
+    assert upstream_search == ["sid1"]
+
+
+def test_search_batch_searches_uncached_user_upstream(client, database, upstream_search):
+    database.cache_user_info("username2", "sid2")
+
+    response = client.post("/api/search_batch", json={"usernames": ["username2"], "amount_of_posts": 0})
+
+    lines = ndjson(response)
+    assert [line["input"] for line in lines] == ["username2"]
+    assert lines[0]["result"]["user"]["sid"] == "sid2"
+    assert upstream_search == ["sid2"]
+
+
+@pytest.mark.parametrize("url, payload", [
+    ("/api/search_by_sid_batch", {"sid": "sid1"}),
+    ("/api/search_by_sid_batch", {"sids": "sid1"}),
+    ("/api/search_batch", {"usernames": ["username1"], "amount_of_posts": "many"}),
+    ("/api/search_batch", ["username1"]),
+])
+def test_malformed_batch_request_is_rejected(client, upstream_search, url, payload):
+    response = client.post(url, json=payload)
+
+    assert response.status_code == 400
+    assert upstream_search == []
+
+
+def test_unknown_keys_of_batch_request_are_ignored(client, upstream_search):
+    response = client.post("/api/search_by_sid_batch", json={"sids": ["sid3"], "fields": "user"})
+
+    assert response.status_code == 200
+    assert [line["input"] for line in ndjson(response)] == ["sid3"]
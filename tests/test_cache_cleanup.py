@@ -0,0 +1,88 @@
+"""! Cleanup removes expired cached rows in batches and keeps fresh ones. """
+import time
+
+import pytest
+
+from app.db.database import _post_to_row
+from app.db.engine import create_sqlite_engine
+from app.db.storage import MemoryCacheStorage, SQLiteCacheStorage
+from app.utils.user_search import PostInfo
+
+LIFETIME_SEC = 60 * 60
+
+
+@pytest.fixture(params=["sqlite", "memory"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        storage = SQLiteCacheStorage(create_sqlite_engine(str(tmp_path / "cache.db")))
+    else:
+        storage = MemoryCacheStorage()
+    storage.create_tables()
+    return storage
+
+
+@pytest.fixture
+def batch_pauses(monkeypatch):
+    """! Pauses between full batches of sqlite cleanup, one less than the number of batches. """
+    pauses = []
+    monkeypatch.setattr("app.db.storage.time.sleep", pauses.append)
+    return pauses
+
+
+def post_row(aweme_id: str, create_time: int, urls_expire_time: int = None) -> tuple:
+    cover = "https://p16.tiktokcdn.com/{}?x-expires={}".format(
+        aweme_id, urls_expire_time or int(time.time()) + LIFETIME_SEC)
+    return _post_to_row(PostInfo(aweme_id=aweme_id, author_sec_user_id="author", create_time=create_time,
+                                 cover=cover))
+
+
+def old_post_row(aweme_id: str, age_sec: int) -> tuple:
+    row = post_row(aweme_id, 100)
+    return (row[0], row[1] - age_sec) + row[2:]
+
+
+def user_row(sec_user_id: str, add_time: int) -> tuple:
+    return (sec_user_id, add_time, "user" + sec_user_id, "User", 1, 1, 1, None, 0, None)
+
+
+def test_clean_posts_removes_old_rows_in_batches(storage, batch_pauses):
+    storage.put_posts([old_post_row(str(i), LIFETIME_SEC + 60) for i in range(25)])
+    storage.put_posts([post_row("fresh", 200)])
+    now = int(time.time())
+
+    assert storage.clean_posts(now - LIFETIME_SEC, now, 10) == 25
+    assert storage.get_post("0") is None
+    assert storage.get_post("fresh") is not None
+    if isinstance(storage, SQLiteCacheStorage):
+        assert len(batch_pauses) == 2
+
+
+def test_clean_posts_removes_expired_urls(storage, batch_pauses):
+    now = int(time.time())
+    storage.put_posts([post_row(str(i), 100, now - 1) for i in range(5)])
+    storage.put_posts([post_row("fresh", 200)])
+
+    assert storage.clean_posts(now - LIFETIME_SEC, now, 2) == 5
+    assert [row[0] for row in storage.get_latest_posts("author", 10, now - LIFETIME_SEC, now)] == ["fresh"]
+
+
+def test_clean_users_full_in_batches(storage, batch_pauses):
+    now = int(time.time())
+    storage.put_users_full([user_row(str(i), now - LIFETIME_SEC - 60) for i in range(7)])
+    storage.put_users_full([user_row("fresh", now)])
+
+    assert storage.clean_users_full(now - LIFETIME_SEC, 3) == 7
+    assert storage.get_user_full("0") is None
+    assert storage.get_user_full("fresh") is not None
+    if isinstance(storage, SQLiteCacheStorage):
+        assert len(batch_pauses) == 2
+
+
+def test_clean_short_links_exact_batch(storage, batch_pauses):
+    now = int(time.time())
+    storage.put_short_links([(str(i), now - LIFETIME_SEC - 60, "https://vm.tiktok.com/{}/".format(i))
+                             for i in range(4)])
+
+    assert storage.clean_short_links(now - LIFETIME_SEC, 2) == 4
+    assert storage.clean_short_links(now - LIFETIME_SEC, 2) == 0
+    assert storage.get_short_links(["0", "3"]) == {}
@@ -0,0 +1,112 @@
+"""! Cache storages keep the same contract. Redis storage runs on fakeredis, or on a real server
+    when CACHE_REDIS_TEST_URL is set (its keys under the test prefix are removed).
+"""
+import os
+import time
+import uuid
+
+import pytest
+
+from app.db.database import _post_to_row, _user_to_row
+from app.db.engine import create_sqlite_engine
+from app.db.storage import MemoryCacheStorage, RedisCacheStorage, SQLiteCacheStorage
+from app.utils.user_search import PostInfo, UserInfo
+
+LIFETIME_SEC = 60 * 60
+
+
+@pytest.fixture
+def redis_storage():
+    url = os.getenv("CACHE_REDIS_TEST_URL")
+    storage = RedisCacheStorage(url or "redis://localhost:6379/0", "test:{}:".format(uuid.uuid4().hex),
+                                LIFETIME_SEC, LIFETIME_SEC, LIFETIME_SEC)
+    if url is None:
+        fakeredis = pytest.importorskip("fakeredis")
+        storage.client = fakeredis.FakeRedis()
+    yield storage
+    keys = list(storage.client.scan_iter(storage.prefix + "*"))
+    if len(keys) != 0:
+        storage.client.delete(*keys)
+
+
+@pytest.fixture(params=["sqlite", "memory", "redis"])
+def storage(request, tmp_path):
+    if request.param == "sqlite":
+        storage = SQLiteCacheStorage(create_sqlite_engine(str(tmp_path / "cache.db")))
+    elif request.param == "memory":
+        storage = MemoryCacheStorage()
+    else:
+        storage = request.getfixturevalue("redis_storage")
+    storage.create_tables()
+    return storage
+
+
+def post_row(aweme_id: str, author: str, create_time: int, urls_expire_time: int = None) -> tuple:
+    urls_expire_time = urls_expire_time or int(time.time()) + LIFETIME_SEC
+    cover = "https://p16.tiktokcdn.com/{}?x-expires={}".format(aweme_id, urls_expire_time)
+    return _post_to_row(PostInfo(aweme_id=aweme_id, author_sec_user_id=author, create_time=create_time,
+                                 cover=cover, download_links=[cover + "&d=1"], play_links=[cover + "&p=1"],
+                                 play_count=10, description="post " + aweme_id))
+
+
+def latest_posts(storage, author: str, amount: int) -> list:
+    now = int(time.time())
+    return storage.get_latest_posts(author, amount, now - LIFETIME_SEC, now)
+
+
+def test_users(storage):
+    storage.put_users([("sid1", int(time.time()), "user1")])
+    row = _user_to_row(UserInfo(sid="sid1", login_name="user1", name="User", followers=5, secret=0,
+                                avatar="https://p16.tiktokcdn.com/avatar?x-expires={}".format(int(time.time()) + 60)))
+    storage.put_users_full([row])
+
+    assert storage.get_sec_uid("user1") == "sid1"
+    assert storage.get_sec_uid("missing") is None
+    assert tuple(storage.get_user_full("sid1")) == row
+    assert storage.get_user_full("missing") is None
+
+
+def test_post_round_trip(storage):
+    row = post_row("1", "author", 100)
+    storage.put_posts([row])
+
+    assert tuple(storage.get_post("1")) == row
+    assert storage.get_post("missing") is None
+
+
+def test_latest_posts_are_sorted_and_limited(storage):
+    storage.put_posts([post_row("1", "author", 100), post_row("2", "author", 300), post_row("3", "author", 200),
+                       post_row("4", "other", 400)])
+
+    assert [row[0] for row in latest_posts(storage, "author", 2)] == ["2", "3"]
+    assert [row[0] for row in latest_posts(storage, "author", 10)] == ["2", "3", "1"]
+
+
+def test_latest_posts_skip_expired_urls(storage):
+    storage.put_posts([post_row("1", "author", 100), post_row("2", "author", 200, int(time.time()) - 1)])
+
+    assert [row[0] for row in latest_posts(storage, "author", 10)] == ["1"]
+
+
+def test_short_links(storage):
+    storage.put_short_links([("1", int(time.time()), "https://vm.tiktok.com/1/")])
+
+    assert storage.get_short_links(["1", "2"]) == {"1": "https://vm.tiktok.com/1/"}
+    assert storage.get_short_links([]) == {}
+
+
+def test_redis_rows_expire_with_urls(redis_storage):
+    storage = redis_storage
+    storage.put_posts([post_row("1", "author", 100, int(time.time()) + 30)])
+
+    assert 0 < storage.client.ttl(storage._key("post", "1")) <= 30
+
+
+def test_redis_latest_posts_forget_removed_posts(redis_storage):
+    storage = redis_storage
+    storage.put_posts([post_row("1", "author", 100), post_row("2", "author", 200)])
+    # the server removes expired post by its ttl
+    storage.client.delete(storage._key("post", "2"))
+
+    assert [row[0] for row in latest_posts(storage, "author", 10)] == ["1"]
+    assert storage.client.zrange(storage._key("author_posts", "author"), 0, -1) == [b"1"]
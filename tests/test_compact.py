@@ -0,0 +1,66 @@
+"""! Packed post urls and migration of cached posts with url columns. """
+import sqlite3
+import time
+
+import pytest
+
+from app.db.compact import pack_urls, unpack_urls
+from app.db.engine import create_sqlite_engine
+from app.db.storage import SQLiteCacheStorage
+
+COVER = "https://p16-sign-va.tiktokcdn.com/obj/tos-maliva-p-0068/cover.jpeg?x-expires=1700000000&x-signature=a%3D"
+PLAY = "https://v16-webapp.tiktok.com/video/tos/useast2a/tos-useast2a-pve-0068/{}/?a=1233&mime_type=video_mp4"
+OLD_POSTS_COLUMNS = ("aweme_id", "add_time", "create_time", "author_sec_user_id",
+                     "cover_url", "animated_cover_url", "download_url_1", "download_url_2", "download_url_3",
+                     "play_url_1", "play_url_2", "play_url_3", "share_link", "web_link", "short_link",
+                     "comment_count", "digg_count", "download_count", "forward_count", "lose_comment_count",
+                     "lose_count", "play_count", "share_count", "whatsapp_share_count", "description",
+                     "earliest_urls_expire_time")
+
+
+def test_urls_round_trip():
+    play_links = [PLAY.format(i) for i in range(5)]
+
+    blob = pack_urls(COVER, None, [PLAY.format("d")], play_links)
+
+    assert unpack_urls(blob) == (COVER, None, [PLAY.format("d")], play_links)
+    assert len(blob) < len(COVER) + sum(len(link) for link in play_links)
+
+
+def test_empty_urls_round_trip():
+    assert unpack_urls(pack_urls(None, None, None, None)) == (None, None, [], [])
+    assert unpack_urls(None) == (None, None, [], [])
+
+
+def test_unknown_urls_version():
+    blob = pack_urls(COVER, None, [], [])
+
+    with pytest.raises(ValueError):
+        unpack_urls(bytes([0]) + blob[1:])
+
+
+def test_migrate_posts_urls(tmp_path):
+    path = str(tmp_path / "cache.db")
+    now = int(time.time())
+    with sqlite3.connect(path) as con:
+        con.execute("CREATE TABLE tiktok_posts ({})".format(", ".join(OLD_POSTS_COLUMNS)))
+        con.execute("CREATE INDEX tiktok_posts_add_time ON tiktok_posts (add_time)")
+        rows = [(str(i), now, 100 + i, "author", COVER, None, PLAY.format("d"), None, None,
+                 PLAY.format(1), PLAY.format(2), None, "share", "web", None,
+                 1, 2, 3, 4, 5, 6, 7, 8, 9, "post {}".format(i), now + 60) for i in range(5)]
+        con.executemany("INSERT INTO tiktok_posts VALUES ({})".format(",".join("?" * len(OLD_POSTS_COLUMNS))),
+                        rows)
+    con.close()
+    storage = SQLiteCacheStorage(create_sqlite_engine(path))
+
+    storage._migrate_posts_urls(batch_size=2)
+    storage.create_tables()
+
+    row = tuple(storage.get_post("3"))
+    assert row[:4] == ("3", now, 103, "author")
+    assert unpack_urls(row[4]) == (COVER, None, [PLAY.format("d")], [PLAY.format(1), PLAY.format(2)])
+    assert row[5:] == ("share", "web", None, 1, 2, 3, 4, 5, 6, 7, 8, 9, "post 3", now + 60)
+    assert [row[0] for row in storage.get_latest_posts("author", 10, now - 60, now)] == ["4", "3", "2", "1", "0"]
+    # second start finds nothing to migrate
+    storage.create_tables()
+    assert storage.get_post("0") is not None
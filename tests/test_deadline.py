@@ -0,0 +1,45 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils import hedging
+from app.utils.deadline import Deadline
+from app.utils.hedging import hedged_call, HedgePolicy
+from config.application import REQUEST_TIMEOUT_SEC, REQUEST_TIMEOUT_MAX_SEC, REQUEST_TIMEOUT_HEADER
+
+
+@pytest.mark.parametrize("header, timeout_sec", [
+    ("5", 5.0),
+    ("100000", REQUEST_TIMEOUT_MAX_SEC),
+    ("-1", 0),
+    ("soon", REQUEST_TIMEOUT_SEC),
+    ("nan", REQUEST_TIMEOUT_SEC),
+    ("inf", REQUEST_TIMEOUT_SEC),
+])
+def test_deadline_from_request_header(app, header, timeout_sec):
+    with app.test_request_context(headers={REQUEST_TIMEOUT_HEADER: header}):
+        deadline = Deadline.from_request()
+
+    assert deadline.timeout_sec == timeout_sec
+
+
+def test_hedged_call_waits_instead_of_spinning_without_remaining_time(monkeypatch):
+    waits = []
+
+    def counting_wait(*args, **kwargs):
+        waits.append(kwargs.get("timeout"))
+        return wait(*args, **kwargs)
+
+    wait = hedging.wait
+    monkeypatch.setattr(hedging, "wait", counting_wait)
+    # deadline with no time left which hasn't expired, like the one of nan timeout
+    deadline = Deadline(float("nan"))
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        result = hedged_call(executor, lambda: time.sleep(0.2) or "done", "test_spin",
+                             HedgePolicy(max_attempts=1), deadline=deadline)
+
+    assert result == "done"
+    assert len(waits) < 50
+    assert all(timeout > 0 for timeout in waits)
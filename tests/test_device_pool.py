@@ -0,0 +1,231 @@
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils import device_pool
+from app.utils.device_pool import DevicePoll, NoDeviceAvailable
+from app.utils.hedging import hedged_call
+from app.utils.proxy_health import ProxyAttempt, ProxyTracker, SenderProxies
+from config.application import DEVICE_QUARANTINE_FAILURES, DEVICE_SPARES
+
+
+class FakeDevice:
+    def __init__(self, device_id):
+        self.device_id = device_id
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = DevicePoll()
+    ids = itertools.count()
+    monkeypatch.setattr(pool, "device_pool_size", 3)
+    monkeypatch.setattr(pool, "devices", [FakeDevice("device-{}".format(i)) for i in range(3)])
+    monkeypatch.setattr(pool, "spares", [])
+    monkeypatch.setattr(pool, "health", dict())
+    monkeypatch.setattr(pool, "device_added_at", dict())
+    monkeypatch.setattr(pool, "proxy_switchers", dict())
+    monkeypatch.setattr(pool, "quarantined", 0)
+    monkeypatch.setattr(pool, "replaced", 0)
+    monkeypatch.setattr(pool, "registering", 0)
+    monkeypatch.setattr(pool, "retired", set())
+    monkeypatch.setattr(pool, "loading", False)
+    monkeypatch.setattr(pool, "create_device", lambda: FakeDevice("new-{}".format(next(ids))))
+    monkeypatch.setattr(pool, "_thread_pool_executor", ThreadPoolExecutor(max_workers=4))
+    return pool
+
+
+def release_concurrently(pool, device, workers: int = 16):
+    """! Make device one failure away from quarantine and report the failure from `workers` threads at once. """
+    for _ in range(DEVICE_QUARANTINE_FAILURES - 1):
+        pool._health(device).record(10, "error")
+    barrier = threading.Barrier(workers)
+
+    def release():
+        barrier.wait()
+        pool.release_device(device, ProxyAttempt(None), 10, "error")
+
+    threads = [threading.Thread(target=release) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool._thread_pool_executor.shutdown(wait=True)
+
+
+def test_concurrent_release_replaces_device_with_spare_once(pool):
+    bad = pool.devices[0]
+    pool.spares.extend([FakeDevice("spare-1"), FakeDevice("spare-2")])
+
+    release_concurrently(pool, bad)
+
+    assert bad not in pool.devices
+    assert len(pool.devices) == 3
+    assert pool.quarantined == 1
+    assert pool.replaced == 1
+    assert len(pool.spares) == 1
+
+
+def test_concurrent_release_without_spares_keeps_pool_size(pool):
+    bad = pool.devices[0]
+
+    release_concurrently(pool, bad)
+
+    assert bad not in pool.devices
+    assert len(pool.devices) == 3
+    assert pool.quarantined == 1
+    assert len(pool.spares) == 0
+
+
+def test_registered_device_goes_to_spares_when_pool_is_full(pool):
+    device = pool.register_device()
+
+    assert len(pool.devices) == 3
+    assert pool.spares == [device]
+
+
+def test_registered_device_is_dropped_when_spares_are_full(pool):
+    for _ in range(DEVICE_SPARES):
+        pool.register_device()
+
+    pool.register_device()
+
+    assert len(pool.devices) == 3
+    assert len(pool.spares) == DEVICE_SPARES
+
+
+def test_refill_counts_devices_being_registered(pool, monkeypatch):
+    pool.devices.pop()
+    registered = threading.Event()
+    created = []
+
+    def create_device():
+        created.append(FakeDevice("slow-{}".format(len(created))))
+        registered.wait(5)
+        return created[-1]
+
+    monkeypatch.setattr(pool, "create_device", create_device)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first = executor.submit(pool.refill)
+        while pool.registering == 0:
+            time.sleep(0.01)
+        # another refill meanwhile only registers what is still missing
+        second = executor.submit(pool.refill)
+        time.sleep(0.1)
+        registered.set()
+        first.result(), second.result()
+
+    assert len(created) == 1 + DEVICE_SPARES
+    assert len(pool.devices) == 3
+    assert len(pool.spares) == DEVICE_SPARES
+
+
+def test_maintain_does_not_refill_while_loading(pool, monkeypatch):
+    pool.devices.pop()
+    monkeypatch.setattr(pool, "loading", True)
+
+    pool.maintain()
+
+    assert len(pool.devices) == 2
+    assert len(pool.spares) == 0
+
+
+def test_database_device_is_replaced_with_next_stored_one(pool, monkeypatch):
+    stored = [FakeDevice("device-{}".format(i)) for i in range(5)]
+    monkeypatch.setattr(device_pool, "DEVICES_SOURCE", "DATABASE")
+    monkeypatch.setattr(pool, "create_device", type(pool).create_device.__get__(pool))
+    monkeypatch.setattr(pool._db_session, "iter_created_devices", lambda size, exclude_ids: iter(
+        [device for device in stored if device.device_id not in exclude_ids][:size]))
+    pool.retired.add("device-3")
+
+    device = pool.register_device()
+
+    assert device.device_id == "device-4"
+    assert pool.spares == [device]
+
+
+class FakeProvider:
+    def __init__(self):
+        self.proxies = itertools.count()
+
+    def next(self):
+        return "proxy-{}".format(next(self.proxies))
+
+
+@pytest.fixture
+def tracker(pool, monkeypatch):
+    tracker = ProxyTracker(FakeProvider(), candidates=1)
+    monkeypatch.setattr(pool, "proxy_service", tracker)
+    return tracker
+
+
+def bind_switcher(pool, tracker, device) -> SenderProxies:
+    switcher = SenderProxies(tracker)
+    pool.proxy_switchers[device.device_id] = switcher
+    switcher.next()
+    return switcher
+
+
+def test_failure_is_recorded_for_proxy_attempt_was_switched_to(pool, tracker, monkeypatch):
+    device = pool.devices[0]
+    switcher = bind_switcher(pool, tracker, device)
+    monkeypatch.setattr(pool, "get_device", lambda proxy_on=True: device)
+
+    _, attempt = pool.acquire_device()
+    # sender switches proxy in the middle of attempt, f.e. after connection error
+    first, second = switcher.proxy, switcher.next()
+    pool.release_device(device, attempt, 10, "timeout")
+
+    assert tracker._get_health(first).requests == 0
+    assert tracker._get_health(second).failures["timeout"] == 1
+
+
+def test_attempt_keeps_its_proxy_when_other_device_switches(pool, tracker, monkeypatch):
+    device, other = pool.devices[0], pool.devices[1]
+    switcher = bind_switcher(pool, tracker, device)
+    other_switcher = bind_switcher(pool, tracker, other)
+    monkeypatch.setattr(pool, "get_device", lambda proxy_on=True: device)
+
+    _, attempt = pool.acquire_device()
+    proxy = switcher.proxy
+    other_switcher.next()
+    pool.release_device(device, attempt, 10, "socks")
+
+    assert tracker._get_health(proxy).failures["socks"] == 1
+    assert tracker._get_health(other_switcher.proxy).requests == 0
+
+
+def test_empty_pool_answers_503(pool, monkeypatch):
+    monkeypatch.setattr(pool, "devices", [])
+    monkeypatch.setattr(device_pool, "DEVICE_WAIT_SEC", 0.05)
+
+    with pytest.raises(NoDeviceAvailable) as error:
+        pool.get_device()
+
+    assert error.value.http_code == 503
+
+
+def test_empty_pool_waits_for_added_device(pool, monkeypatch):
+    monkeypatch.setattr(pool, "devices", [])
+    device = FakeDevice("late")
+    timer = threading.Timer(0.05, pool.add_device, [device])
+    timer.start()
+
+    assert pool.get_device() is device
+    timer.join()
+
+
+def test_hedged_call_does_not_retry_without_devices():
+    attempts = []
+
+    def search():
+        attempts.append(1)
+        raise NoDeviceAvailable()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        with pytest.raises(NoDeviceAvailable):
+            hedged_call(executor, search, "test_no_device")
+
+    assert len(attempts) == 1
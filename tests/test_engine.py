@@ -0,0 +1,28 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from app.db.engine import create_sqlite_engine
+from config.application import SQLITE_POOL_SIZE
+
+
+def test_threads_share_pooled_connections(tmp_path):
+    engine = create_sqlite_engine(os.path.join(str(tmp_path), "pool.db"))
+    with engine.begin() as con:
+        con.execute('''CREATE TABLE items (id int primary key)''')
+
+    def work(i):
+        for j in range(20):
+            with engine.begin() as con:
+                con.execute('''INSERT INTO items (id) VALUES (?)''', (i * 100 + j,))
+            with engine.connect() as con:
+                con.execute('''SELECT count(*) FROM items''').fetchone()
+
+    # more threads than kept connections, none of them loses its connection to another one
+    with ThreadPoolExecutor(max_workers=SQLITE_POOL_SIZE * 2) as executor:
+        list(executor.map(work, range(SQLITE_POOL_SIZE * 2)))
+
+    with engine.connect() as con:
+        assert con.execute('''SELECT count(*) FROM items''').fetchone()[0] == SQLITE_POOL_SIZE * 2 * 20
+        assert con.execute('''PRAGMA journal_mode''').fetchone()[0] == "wal"
+    assert engine.pool.checkedin() <= SQLITE_POOL_SIZE
+    engine.dispose()
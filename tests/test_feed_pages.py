@@ -0,0 +1,62 @@
+from app.api import base
+from app.api.types_.search import ApiSearchResponse
+from app.utils import factory_search
+from app.utils.factory_search import SearchBySidCreator, SearchPostsPageCreator, SearchLikedPostsPageCreator
+from app.utils.user_search import UserInfo, PostInfo
+
+
+class Aweme:
+    def __init__(self, aweme_id: str, create_time: int):
+        self.aweme_id = aweme_id
+        self.create_time = create_time
+
+
+def feed_pages(creator_class, monkeypatch, pages: int = 3, page_size: int = 2) -> list:
+    """! Feed of `pages` pages served by `creator_class` one page per search. Returns payloads of searches. """
+    searched = list()
+
+    def search(self, payload, **params):
+        searched.append(payload)
+        cursor = payload["cursor"]
+        awemes = [Aweme("{}-{}-{}".format(payload["sid"], cursor, i), 1000 - cursor * page_size - i)
+                  for i in range(page_size)]
+        return awemes, cursor + 1, cursor + 1 < pages
+
+    monkeypatch.setattr(creator_class, "search", search)
+    monkeypatch.setattr(factory_search, "convert_aweme", lambda aweme, fields=None: PostInfo(
+        aweme_id=aweme.aweme_id, create_time=aweme.create_time))
+    return searched
+
+
+def test_search_by_sid_fetches_every_page_with_own_search(app, monkeypatch):
+    searched = feed_pages(SearchPostsPageCreator, monkeypatch)
+    monkeypatch.setattr(SearchBySidCreator, "search", lambda self, payload, **params: ApiSearchResponse(
+        UserInfo(login_name="paged", sid=payload["sid"]), None))
+
+    result = base.search_by_sid({"sid": "paged-sid", "amount_of_posts": 5})
+
+    assert [payload["cursor"] for payload in searched] == [0, 1, 2]
+    assert [post.aweme_id for post in result.posts] == ["paged-sid-0-0", "paged-sid-0-1", "paged-sid-1-0",
+                                                        "paged-sid-1-1", "paged-sid-2-0"]
+    assert not result.partial
+
+
+def test_secret_user_posts_are_not_fetched(app, monkeypatch):
+    searched = feed_pages(SearchPostsPageCreator, monkeypatch)
+    monkeypatch.setattr(SearchBySidCreator, "search", lambda self, payload, **params: ApiSearchResponse(
+        UserInfo(login_name="secret", sid=payload["sid"], secret=1), None))
+
+    result = base.search_by_sid({"sid": "secret-sid", "amount_of_posts": 5})
+
+    assert result.posts is None
+    assert searched == []
+
+
+def test_liked_posts_are_fetched_page_by_page(client, monkeypatch):
+    searched = feed_pages(SearchLikedPostsPageCreator, monkeypatch)
+
+    response = client.post("/api/liked", json={"sid": "liker", "amount_of_posts": 3})
+
+    assert response.status_code == 200
+    assert [post["aweme_id"] for post in response.get_json()["posts"]] == ["liker-0-0", "liker-0-1", "liker-1-0"]
+    assert [payload["cursor"] for payload in searched] == [0, 1]
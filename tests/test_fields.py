@@ -0,0 +1,107 @@
+"""! X-Fields mask is pushed down to searches, so cut fields are not fetched or computed. """
+from types import SimpleNamespace
+
+from app.api import base
+from app.api.types_.search import ApiSearchResponse
+from app.utils import factory_search
+from app.utils.factory_search import SearchBySidCreator, SearchPostsPageCreator
+from app.utils.fields import FieldMask
+from app.utils.user_search import PostInfo, UserInfo, aweme_detail_to_post
+
+
+def aweme(aweme_id: str = "1") -> SimpleNamespace:
+    urls = SimpleNamespace(url_list=["https://p16.tiktokcdn.com/" + aweme_id])
+    statistics = SimpleNamespace(comment_count=1, digg_count=2, download_count=3, forward_count=4,
+                                 lose_comment_count=5, lose_count=6, play_count=7, share_count=8,
+                                 whatsapp_share_count=9)
+    return SimpleNamespace(aweme_id=aweme_id, create_time=100, desc="post " + aweme_id, statistics=statistics,
+                           video=SimpleNamespace(cover=urls, animated_cover=None, download_addr=urls,
+                                                 play_addr=urls),
+                           share_info=SimpleNamespace(share_url="https://www.tiktok.com/share/" + aweme_id),
+                           author=SimpleNamespace(sec_uid="author", unique_id="user"))
+
+
+def test_empty_mask_wants_everything():
+    for fields in (FieldMask(), FieldMask(""), FieldMask("{broken")):
+        assert fields.is_all()
+        assert fields.wants("posts")
+        assert fields.nested("posts").is_all()
+
+
+def test_mask_wants_listed_fields():
+    fields = FieldMask("user{login_name},posts{aweme_id,cover}")
+
+    assert not fields.is_all()
+    assert fields.wants("user") and fields.wants("posts")
+    assert not fields.wants("partial")
+    assert fields.nested("posts").wants("cover")
+    assert not fields.nested("posts").wants("description")
+    # nested field without its own mask is returned whole
+    assert FieldMask("user,posts").nested("posts").is_all()
+
+
+def test_post_is_converted_with_masked_fields_only():
+    post = aweme_detail_to_post(aweme(), None, FieldMask("aweme_id,cover,play_count"))
+
+    assert post.cover == "https://p16.tiktokcdn.com/1"
+    assert post.play_count == 7
+    assert post.description is None and post.download_links is None and post.share_link is None
+    assert post.digg_count is None
+    # identity of post is always there
+    assert (post.aweme_id, post.author_sec_user_id, post.create_time) == ("1", "author", 100)
+
+
+def test_short_link_needs_share_link():
+    post = aweme_detail_to_post(aweme(), None, FieldMask("short_link"))
+
+    assert post.share_link == "https://www.tiktok.com/share/1"
+
+
+def fake_search_by_sid(monkeypatch) -> tuple:
+    """! Returns payloads of posts page searches and masks posts were converted with. """
+    searched, masks = list(), list()
+
+    def search(self, payload, **params):
+        searched.append(payload)
+        return [aweme(payload["sid"])], 1, False
+
+    def convert_aweme(aweme, fields=None):
+        masks.append(fields)
+        return PostInfo(aweme_id=aweme.aweme_id, create_time=aweme.create_time)
+
+    monkeypatch.setattr(SearchPostsPageCreator, "search", search)
+    monkeypatch.setattr(factory_search, "convert_aweme", convert_aweme)
+    monkeypatch.setattr(SearchBySidCreator, "search", lambda self, payload, **params: ApiSearchResponse(
+        UserInfo(login_name="masked", sid=payload["sid"]), None))
+    return searched, masks
+
+
+def test_posts_cut_by_mask_are_not_fetched(app, monkeypatch):
+    searched, masks = fake_search_by_sid(monkeypatch)
+
+    result = base.search_by_sid({"sid": "mask-user-sid", "amount_of_posts": 5, "fields": "user{login_name}"})
+
+    assert result.user.login_name == "masked"
+    assert result.posts is None
+    assert searched == []
+
+
+def test_posts_are_converted_with_nested_mask(app, monkeypatch):
+    searched, masks = fake_search_by_sid(monkeypatch)
+    monkeypatch.setattr(factory_search, "USE_CACHING", False)
+
+    result = base.search_by_sid({"sid": "mask-posts-sid", "amount_of_posts": 5, "fields": "posts{aweme_id,cover}"})
+
+    assert [post.aweme_id for post in result.posts] == ["mask-posts-sid"]
+    assert len(searched) == 1
+    assert masks[0].wants("cover") and not masks[0].wants("description")
+
+
+def test_cached_posts_are_converted_whole(app, monkeypatch):
+    searched, masks = fake_search_by_sid(monkeypatch)
+    monkeypatch.setattr(factory_search, "USE_CACHING", True)
+
+    base.search_by_sid({"sid": "mask-cached-sid", "amount_of_posts": 5, "fields": "posts{aweme_id}"})
+
+    assert len(searched) == 1
+    assert masks == [None]
@@ -0,0 +1,101 @@
+import asyncio
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils.hedging import hedged_call, hedged_call_async, HedgePolicy
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def attempts(*behaviours):
+    """! fn whose n-th call does `behaviours[n]`: returns value, raises exception or sleeps (value, seconds). """
+    calls = itertools.count()
+    lock = threading.Lock()
+
+    def fn():
+        with lock:
+            behaviour = behaviours[min(next(calls), len(behaviours) - 1)]
+        if isinstance(behaviour, Exception):
+            raise behaviour
+        if isinstance(behaviour, tuple):
+            time.sleep(behaviour[1])
+            return behaviour[0]
+        return behaviour
+
+    fn.calls = calls
+    return fn
+
+
+def test_slow_attempt_is_hedged_after_delay(executor):
+    fn = attempts(("slow", 1), "fast")
+    started_at = time.monotonic()
+
+    result = hedged_call(executor, fn, "test_hedge_delay", HedgePolicy(default_delay_ms=50, min_delay_ms=50))
+
+    assert result == "fast"
+    assert time.monotonic() - started_at < 0.5
+    assert next(fn.calls) == 2
+
+
+def test_failed_attempt_is_replaced_without_waiting_for_delay(executor):
+    fn = attempts(ValueError("broken device"), "ok")
+    started_at = time.monotonic()
+
+    result = hedged_call(executor, fn, "test_hedge_failure", HedgePolicy(default_delay_ms=5000))
+
+    assert result == "ok"
+    assert time.monotonic() - started_at < 1
+
+
+def test_none_is_returned_when_all_attempts_fail(executor):
+    fn = attempts(ValueError("broken device"))
+
+    assert hedged_call(executor, fn, "test_hedge_all_fail", HedgePolicy(max_attempts=3)) is None
+    assert next(fn.calls) == 3
+
+
+def test_result_needing_confirmation_is_accepted_when_confirmed(executor):
+    fn = attempts({"secret": 1}, {"secret": 1})
+
+    result = hedged_call(executor, fn, "test_hedge_confirm", needs_confirmation=lambda r: r["secret"] == 1)
+
+    assert result == {"secret": 1}
+    assert next(fn.calls) == 2
+
+
+def test_confirmation_is_not_needed_when_other_attempt_disagrees(executor):
+    fn = attempts({"secret": 1}, {"secret": 0})
+
+    result = hedged_call(executor, fn, "test_hedge_disagree", needs_confirmation=lambda r: r["secret"] == 1)
+
+    assert result == {"secret": 0}
+
+
+def test_async_losers_are_cancelled():
+    cancelled = []
+    calls = itertools.count()
+
+    async def attempt():
+        if next(calls) == 0:
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+        return "fast"
+
+    async def run():
+        result = await hedged_call_async(attempt, "test_hedge_async", HedgePolicy(default_delay_ms=50, min_delay_ms=50))
+        await asyncio.sleep(0)
+        return result
+
+    assert asyncio.run(run()) == "fast"
+    assert cancelled == [True]
@@ -0,0 +1,78 @@
+import time
+
+import pytest
+
+from app.db import database as database_module
+from app.db.database import LocalCache
+from app.utils.user_search import PostInfo
+
+
+class Clock:
+    def __init__(self):
+        self.now = time.time()
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(database_module, "time", clock)
+    return clock
+
+
+def test_entry_expires_after_ttl(clock):
+    cache = LocalCache(max_entries=10, ttl_sec=60)
+    cache.put("key", "value")
+
+    clock.now += 59
+    assert cache.get("key") == "value"
+    clock.now += 1
+    assert cache.get("key") is None
+
+
+def test_entry_expires_at_its_own_time_before_ttl(clock):
+    cache = LocalCache(max_entries=10, ttl_sec=60)
+    cache.put("key", "value", expire_at=clock.now + 10)
+
+    clock.now += 10
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = LocalCache(max_entries=2, ttl_sec=60)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cached_post_expires_with_its_urls(clock, database):
+    aweme_id = "7000000000000000100"
+    urls_expire_time = int(clock.now) + 120
+    database.cache_post_info(PostInfo(aweme_id=aweme_id, play_count=1,
+                                      cover="https://p16.tiktokcdn.com/cover?x-expires={}".format(urls_expire_time)))
+
+    post, expire_time = database.fetch_cached_post(aweme_id)
+    assert post.play_count == 1
+    assert expire_time == urls_expire_time
+
+    # row is still in L1 and storage, but its urls are expired
+    clock.now = urls_expire_time
+    assert database.fetch_cached_post(aweme_id) is None
+
+
+def test_cached_post_is_invalidated_on_update(clock, database):
+    aweme_id = "7000000000000000101"
+    cover = "https://p16.tiktokcdn.com/cover?x-expires={}".format(int(clock.now) + 3600)
+    database.cache_post_info(PostInfo(aweme_id=aweme_id, play_count=1, cover=cover))
+    database.fetch_cached_post(aweme_id)
+
+    database.cache_post_info(PostInfo(aweme_id=aweme_id, play_count=2, cover=cover))
+
+    assert database.fetch_cached_post(aweme_id)[0].play_count == 2
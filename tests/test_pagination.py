@@ -0,0 +1,68 @@
+from app.utils.deadline import Deadline
+from app.utils.pagination import iter_pages, PageState
+
+
+class Item:
+    def __init__(self, aweme_id: str):
+        self.aweme_id = aweme_id
+
+
+class Feed:
+    """! Feed of `pages` served by cursor, `cursors[i]` is the cursor page i returns. """
+
+    def __init__(self, pages: list, cursors: list = None):
+        self.pages = pages
+        self.cursors = cursors if cursors is not None else [100 * (i + 1) for i in range(len(pages))]
+        self.requests = []
+
+    def fetch_page(self, cursor, count):
+        self.requests.append(cursor)
+        i = 0 if cursor == 0 else self.cursors.index(cursor) + 1
+        return [Item(aweme_id) for aweme_id in self.pages[i]], self.cursors[i], i + 1 < len(self.pages)
+
+
+def collect(feed: Feed, amount: int, state: PageState = None, deadline=None) -> tuple:
+    items = []
+    for new, state in iter_pages(feed.fetch_page, amount, state, page_size=2, deadline=deadline):
+        items += [item.aweme_id for item in new]
+    return items, state
+
+
+def test_cursor_returned_by_page_is_followed():
+    feed = Feed([["1", "2"], ["3", "4"], ["5"]], cursors=[7, 42, 99])
+
+    items, state = collect(feed, 10)
+
+    assert items == ["1", "2", "3", "4", "5"]
+    assert feed.requests == [0, 7, 42]
+    assert not state.has_more
+
+
+def test_repeated_items_are_skipped_and_stuck_feed_stops():
+    feed = Feed([["1", "2"], ["2", "3"], ["3"], ["4"]])
+
+    items, state = collect(feed, 10)
+
+    assert items == ["1", "2", "3"]
+    assert feed.requests == [0, 100, 200]
+    assert not state.has_more
+
+
+def test_paging_resumes_from_state():
+    feed = Feed([["1", "2"], ["3", "4"], ["5", "6"]])
+    _, state = collect(feed, 2)
+
+    items, state = collect(feed, 4, state)
+
+    assert items == ["3", "4"]
+    assert state.ids == ("1", "2", "3", "4")
+    assert state.has_more
+
+
+def test_no_page_is_requested_after_deadline():
+    feed = Feed([["1", "2"], ["3", "4"]])
+
+    items, _ = collect(feed, 4, deadline=Deadline(0))
+
+    assert items == []
+    assert feed.requests == []
@@ -0,0 +1,41 @@
+import pytest
+
+from app.api.types_.search import ApiPostSearchResponse
+from app.utils import links
+from app.utils.factory_search import SearchPostByShareLinkCreator
+from app.utils.user_search import PostInfo
+
+
+@pytest.fixture
+def upstream_post(monkeypatch):
+    """! Posts aren't cached and are found upstream. Returns aweme ids searched upstream. """
+    searched = list()
+
+    def search(self, payload, **params):
+        searched.append(payload["aweme_id"])
+        return ApiPostSearchResponse(PostInfo(aweme_id=payload["aweme_id"], play_count=100,
+                                              cover="https://p16.tiktokcdn.com/cover?x-expires=4102444800"))
+
+    monkeypatch.setattr(SearchPostByShareLinkCreator, "search", search)
+    monkeypatch.setattr(links, "parse_short_url", lambda link: "7000000000000000002")
+    return searched
+
+
+def test_post_batch_fetches_uncached_posts_upstream(client, upstream_post):
+    response = client.post("/api/post_batch", json={"links": ["7000000000000000001",
+                                                              "https://vm.tiktok.com/ZMuncached/"]})
+
+    assert response.status_code == 200
+    items = response.get_json()["posts"]
+    assert [item["aweme_id"] for item in items] == ["7000000000000000001", "7000000000000000002"]
+    assert [item["post"]["play_count"] for item in items] == [100, 100]
+    assert all("error" not in item for item in items)
+    assert sorted(upstream_post) == ["7000000000000000001", "7000000000000000002"]
+
+
+@pytest.mark.parametrize("payload", [{"link": "7000000000000000001"}, {"links": "7000000000000000001"}, [1, 2]])
+def test_malformed_post_batch_request_is_rejected(client, upstream_post, payload):
+    response = client.post("/api/post_batch", json=payload)
+
+    assert response.status_code == 400
+    assert upstream_post == []
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from app.utils.prefetch import prefetch_pages
+from app.utils.user_search import SearchException
+
+
+class Item:
+    def __init__(self, aweme_id):
+        self.aweme_id = aweme_id
+
+
+def feed(pages: int, page_size: int = 2, fetch_sec: float = 0, fail_on: int = None):
+    """! fetch_raw_page of feed with `pages` pages, fetch of page number `fail_on` raises SearchException. """
+    def fetch_raw_page(cursor, count):
+        time.sleep(fetch_sec)
+        if cursor == fail_on:
+            raise SearchException("posts not found", 404)
+        items = [Item("{}-{}".format(cursor, i)) for i in range(page_size)]
+        return items, cursor + 1, cursor + 1 < pages
+    return fetch_raw_page
+
+
+def test_pages_are_converted_in_feed_order():
+    pages = list(prefetch_pages(feed(3), lambda item: item.aweme_id, 6))
+
+    assert [items for items, _ in pages] == [["0-0", "0-1"], ["1-0", "1-1"], ["2-0", "2-1"]]
+    assert [state.cursor for _, state in pages] == [1, 2, 3]
+    assert not pages[-1][1].has_more
+
+
+def test_page_is_sent_without_waiting_for_next_fetch():
+    started_at = time.monotonic()
+    pages = prefetch_pages(feed(3, fetch_sec=0.3), lambda item: item.aweme_id, 6)
+
+    first, _ = next(pages)
+    first_at = time.monotonic() - started_at
+    second, _ = next(pages)
+    second_at = time.monotonic() - started_at
+    pages.close()
+
+    assert first == ["0-0", "0-1"]
+    # page comes right after its own fetch, not after the fetch of the next one
+    assert first_at < 0.5
+    assert second == ["1-0", "1-1"]
+    assert second_at < 0.8
+
+
+def test_next_page_is_fetched_while_page_is_sent():
+    pages = prefetch_pages(feed(2, fetch_sec=0.3), lambda item: item.aweme_id, 4)
+    next(pages)
+    # client is busy with the first page meanwhile
+    time.sleep(0.3)
+    started_at = time.monotonic()
+    next(pages)
+
+    assert time.monotonic() - started_at < 0.2
+
+
+def test_pages_before_failed_fetch_are_sent():
+    received = list()
+    with pytest.raises(SearchException):
+        for items, _ in prefetch_pages(feed(5, fail_on=2), lambda item: item.aweme_id, 10):
+            received.append(items)
+
+    assert received == [["0-0", "0-1"], ["1-0", "1-1"]]
+
+
+def test_failed_conversion_is_raised():
+    def convert(item):
+        if item.aweme_id == "1-1":
+            raise ValueError("broken item")
+        return item.aweme_id
+
+    pages = prefetch_pages(feed(3), convert, 6)
+
+    assert next(pages)[0] == ["0-0", "0-1"]
+    with pytest.raises(ValueError):
+        next(pages)
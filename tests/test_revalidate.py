@@ -0,0 +1,37 @@
+import time
+
+from app.api import base
+from app.api.types_.search import ApiPostSearchResponse
+from app.utils.factory_search import SearchPostByShareLinkCreator
+from app.utils.user_search import PostInfo
+
+
+def post(aweme_id: str, play_count: int, urls_expire_time: int) -> PostInfo:
+    return PostInfo(aweme_id=aweme_id, play_count=play_count,
+                    cover="https://p16.tiktokcdn.com/cover?x-expires={}".format(urls_expire_time))
+
+
+def wait_for(condition, timeout_sec: float = 5) -> bool:
+    wait_until = time.time() + timeout_sec
+    while time.time() < wait_until:
+        if condition():
+            return True
+        time.sleep(0.05)
+    return condition()
+
+
+def test_stale_post_is_served_and_refreshed_in_background(client, database, monkeypatch):
+    aweme_id = "7000000000000000010"
+    fresh_until = int(time.time()) + 24 * 60 * 60
+    monkeypatch.setattr(base, "POSTS_STALE_WHILE_REVALIDATE", True)
+    monkeypatch.setattr(SearchPostByShareLinkCreator, "search",
+                        lambda self, payload, **params: ApiPostSearchResponse(post(aweme_id, 200, fresh_until)))
+    # urls expire within the safety margin, so the post is stale
+    database.cache_post_info(post(aweme_id, 100, int(time.time()) + 60))
+
+    response = client.post("/api/post", json={"aweme_id": aweme_id})
+
+    assert response.status_code == 200
+    assert response.get_json()["posts"]["play_count"] == 100
+    assert wait_for(lambda: database.fetch_cached_post(aweme_id)[0].play_count == 200)
+    assert database.fetch_cached_post(aweme_id)[1] == fresh_until
@@ -0,0 +1,56 @@
+import base64
+import json
+import time
+
+import pytest
+
+from app.utils import device_pool
+from app.utils.device_pool import DevicePoll
+
+
+@pytest.fixture
+def devices_table(database):
+    with database.engine.begin() as con:
+        con.execute('''DELETE FROM device_leases''')
+        con.execute('''DELETE FROM devices''')
+        apk = base64.b64encode(json.dumps({}).encode('ascii'))
+        for i in range(3):
+            con.execute('''INSERT INTO devices (apk, install_id, device_id) VALUES (?, ?, ?)''',
+                        (apk, "install-{}".format(i), "shared-{}".format(i)))
+    yield database
+    with database.engine.begin() as con:
+        con.execute('''DELETE FROM device_leases''')
+        con.execute('''DELETE FROM devices''')
+
+
+def test_deleted_device_is_not_leased_again(devices_table):
+    leased = devices_table.lease_devices("worker-1", 3, 60)
+    bad = leased[0].device_id
+
+    devices_table.delete_device(bad)
+
+    assert devices_table.count_devices() == 2
+    assert bad not in [device.device_id for device in devices_table.lease_devices("worker-2", 3, 60)]
+    assert devices_table.lease_devices("worker-1", 3, 60) == []
+
+
+def test_quarantined_shared_device_is_deleted(devices_table, monkeypatch):
+    pool = DevicePoll()
+    devices = devices_table.lease_devices(pool.owner, 2, 60)
+    monkeypatch.setattr(device_pool, "DEVICES_SOURCE", "SHARED")
+    monkeypatch.setattr(pool, "devices", list(devices))
+    monkeypatch.setattr(pool, "spares", [])
+    monkeypatch.setattr(pool, "health", dict())
+    monkeypatch.setattr(pool, "device_added_at", {device.device_id: time.time() for device in devices})
+    monkeypatch.setattr(pool, "quarantined", 0)
+    monkeypatch.setattr(pool, "retired", set())
+    monkeypatch.setattr(pool, "register_device", lambda: None)
+    bad = devices[0]
+
+    for _ in range(device_pool.DEVICE_QUARANTINE_FAILURES):
+        pool.release_device(bad, device_pool.ProxyAttempt(None), 10, "error")
+    pool._thread_pool_executor.submit(lambda: None).result()
+
+    assert pool.quarantined == 1
+    assert devices_table.count_devices() == 2
+    assert bad.device_id not in [device.device_id for device in devices_table.lease_devices("other", 3, 60)]
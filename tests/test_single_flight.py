@@ -0,0 +1,78 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.single_flight import SingleFlight
+
+
+def run_concurrently(key, fn, callers: int = 4, deadline: Deadline = None) -> list:
+    """! Call `SingleFlight().do(key, fn)` from `callers` threads, followers come while the leader runs. """
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        futures = [executor.submit(SingleFlight().do, key, fn, deadline) for _ in range(callers)]
+    return futures
+
+
+def test_concurrent_callers_share_result():
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        return {"user": "shared"}
+
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    futures = run_concurrently(("test_share", 1), fn)
+    timer.join()
+
+    results = [future.result() for future in futures]
+    assert calls == [1]
+    assert all(result is results[0] for result in results)
+    assert SingleFlight().in_flight() == 0
+
+
+def test_concurrent_callers_share_error():
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(5)
+        raise ValueError("upstream failed")
+
+    timer = threading.Timer(0.1, release.set)
+    timer.start()
+    futures = run_concurrently(("test_error", 1), fn)
+    timer.join()
+
+    for future in futures:
+        with pytest.raises(ValueError):
+            future.result()
+    assert calls == [1]
+
+
+def test_next_call_after_completion_runs_again():
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return len(calls)
+
+    assert SingleFlight().do(("test_again", 1), fn) == 1
+    assert SingleFlight().do(("test_again", 1), fn) == 2
+
+
+def test_follower_stops_waiting_at_its_deadline():
+    release = threading.Event()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        leader = executor.submit(SingleFlight().do, ("test_deadline", 1), lambda: release.wait(5))
+        while SingleFlight().in_flight() == 0:
+            release.wait(0.01)
+
+        with pytest.raises(DeadlineExceeded):
+            SingleFlight().do(("test_deadline", 1), lambda: None, Deadline(0.05))
+        release.set()
+        assert leader.result() is True
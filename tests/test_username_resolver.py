@@ -0,0 +1,69 @@
+import asyncio
+import itertools
+import json
+
+import pytest
+
+from app.utils import user_search
+from app.utils.deadline import Deadline, DeadlineExceeded
+from app.utils.proxy_health import ProxyTracker
+from app.utils.user_search import parse_sec_uid_response, get_sec_uid_by_username_async, UnknownPageException
+
+
+class FakeResponse:
+    def __init__(self, state: dict, status_code: int = 200):
+        self.status_code = status_code
+        self.text = '<script id="SIGI_STATE" type="application/json">{}</script>'.format(json.dumps(state))
+
+
+class FakeProvider:
+    def __init__(self):
+        self.proxies = itertools.count()
+
+    def next(self):
+        return "proxy-{}".format(next(self.proxies))
+
+
+def test_page_without_user_is_unknown_page():
+    with pytest.raises(UnknownPageException):
+        parse_sec_uid_response(FakeResponse({"AppContext": {}}), "someone")
+
+
+def test_sec_uid_is_parsed():
+    assert parse_sec_uid_response(FakeResponse({"MobileUserPage": {"secUid": "MS4w"}}), "someone") == "MS4w"
+
+
+def test_unknown_page_is_retried_with_next_proxy(monkeypatch):
+    pages = iter([{"AppContext": {}}, {"MobileUserPage": {"secUid": "MS4w"}}])
+    used = []
+
+    async def fetch_sec_uid(username, proxy=None):
+        used.append(proxy)
+        return parse_sec_uid_response(FakeResponse(next(pages)), username)
+
+    monkeypatch.setattr(user_search, "fetch_sec_uid", fetch_sec_uid)
+    tracker = ProxyTracker(FakeProvider(), candidates=1)
+
+    sec_uid = asyncio.run(get_sec_uid_by_username_async("someone", proxy_service=tracker))
+
+    assert sec_uid == "MS4w"
+    assert len(used) == 2
+    assert tracker._get_health(used[0]).failures["unknown_page"] == 1
+    assert tracker._get_health(used[1]).failures == {}
+
+
+def test_deadline_cut_is_not_charged_to_proxy(monkeypatch):
+    used = []
+
+    async def fetch_sec_uid(username, proxy=None):
+        used.append(proxy)
+        await asyncio.sleep(1)
+
+    monkeypatch.setattr(user_search, "fetch_sec_uid", fetch_sec_uid)
+    tracker = ProxyTracker(FakeProvider(), candidates=1)
+
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(get_sec_uid_by_username_async("someone", proxy_service=tracker, deadline=Deadline(0.1)))
+
+    assert used == ["proxy-0"]
+    assert tracker._get_health("proxy-0").requests == 0